@@ -16,9 +16,15 @@ indices into kpts{1,2} indicating a match
 */
 #include <cmath>
 #include <cstdio>
+#include <cstring>
 #include <opencv2/core/core.hpp>
 #include <vector>
 #include <iostream>
+#include <algorithm>
+#include <limits>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 
 //#if WIN32
@@ -26,6 +32,10 @@ indices into kpts{1,2} indicating a match
 //#else
 //#endif
 
+// Bump whenever an exported signature changes so the python wrapper refuses
+// to call a libsver built from older source (see sver_c_wrapper.SVER_ABI_VERSION)
+#define SVER_ABI_VERSION 2
+
 #define DEBUG_SVER 0
 #if DEBUG_SVER
 #define printDBG_SVER(msg) std::cerr << "[sver.cpp] " << msg << std::endl;
@@ -62,11 +72,11 @@ template <class T> T ensure_0toTau(T x)
 {
     if(x < 0)
     {
-        return ensure_0toTau(x + M_TAU);
+        return ensure_0toTau<T>(x + (T)M_TAU);
     }
-    else if(x >= M_TAU)
+    else if(x >= (T)M_TAU)
     {
-        return ensure_0toTau(x - M_TAU);
+        return ensure_0toTau<T>(x - (T)M_TAU);
     }
     else
     {
@@ -76,7 +86,7 @@ template <class T> T ensure_0toTau(T x)
 
 template<typename T> Matx<T, 3, 3> get_invV_mat(T x, T y, T a, T c, T d, T theta)
 {
-    T ct = (T)cos(theta), st = (T)sin(theta);
+    T ct = std::cos(theta), st = std::sin(theta);
     // https://github.com/aweinstock314/haskell-stuff/blob/master/ExpressionSimplifier.hs
     return Matx<T, 3, 3>(
                     (a * ct),            (a * (-st)),    x,
@@ -133,229 +143,888 @@ template<typename T> inline T ori_distance(const Matx<T, 3, 3>& kpt1, const Matx
     // ktool.get_invVR_mats_oris
     T a1 = kpt1(0, 0), b1 = kpt1(0, 1);
     T a2 = kpt2(0, 0), b2 = kpt2(0, 1);
-    T ori1 = ensure_0toTau(-atan2(b1, a1));
-    T ori2 = ensure_0toTau(-atan2(b2, a2));
+    T ori1 = ensure_0toTau(-std::atan2(b1, a1));
+    T ori2 = ensure_0toTau(-std::atan2(b2, a2));
     // ltool.ori_distance
-    T delta = fabs(ori1 - ori2);
+    T delta = std::fabs(ori1 - ori2);
     delta = ensure_0toTau(delta);
-    return std::min(delta, M_TAU - delta);
+    return std::min(delta, (T)M_TAU - delta);
 }
 
 template<typename T> inline Matx<T, 3, 3> get_Aff_mat(const Matx<T, 3, 3>& invVR1_m,
         const Matx<T, 3, 3>& invVR2_m)
 {
-    //const Matx<double, 3, 3> V1_m = invVR1_m.inv();
-    //const Matx<double, 3, 3> Aff_mat = invVR2_m * V1_m;
-    const Matx<double, 3, 3> Aff_mat = invVR2_m * invVR1_m.inv();
+    //const Matx<T, 3, 3> V1_m = invVR1_m.inv();
+    //const Matx<T, 3, 3> Aff_mat = invVR2_m * V1_m;
+    const Matx<T, 3, 3> Aff_mat = invVR2_m * invVR1_m.inv();
     return Aff_mat;
 }
 
-extern "C" {
-    void get_affine_inliers(double* kpts1, size_t kpts1_len,
-                            double* kpts2, size_t kpts2_len,
-                            size_t* fm, double* fs, size_t nMatch,
-                            double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
-                            // memory is expected to by allocated by the caller (i.e. via numpy.empty)
-                            bool* out_inlier_flags, double* out_errors_list, double* out_matrices_list)
-    {
-        printDBG_SVER("get_affine_inliers");
-        printDBG_SVER(" * kpts1_len = " << kpts1_len);
-        printDBG_SVER(" * kpts2_len = " << kpts2_len);
-        printDBG_SVER(" * nMatch = " << nMatch);
-        printDBG_SVER(" * xy_thresh_sqrd = " << xy_thresh_sqrd);
-        printDBG_SVER(" * scale_thresh_sqrd = " << scale_thresh_sqrd);
-        printDBG_SVER(" * ori_thresh = " << ori_thresh);
-        printDBG_SVER(" * sizeof(size_t) = " << sizeof(size_t));
-        MARKUSED(kpts1_len);
-        MARKUSED(kpts2_len);
-        CHECK_FM_BOUNDS(fm, nMatch, kpts1_len, kpts2_len);
-        // remove some redundancy in a possibly-ugly way
+// Number of OpenMP threads to use for the hypothesis loops. A non-positive
+// request means "use the OpenMP default" (i.e. OMP_NUM_THREADS).
+static int resolve_num_threads(int num_threads)
+{
+    #ifdef _OPENMP
+    if(num_threads <= 0)
+    {
+        num_threads = omp_get_max_threads();
+    }
+    #else
+    num_threads = 1;
+    #endif
+    return num_threads;
+}
+
+// remove some redundancy in a possibly-ugly way
+// (expects the floating point type of the keypoints to be named T)
 #define SETUP_invVRs(idx, prefix) \
-double* prefix##kpt1 = &kpts1[6*fm[(idx)+0]]; \
-double* prefix##kpt2 = &kpts2[6*fm[(idx)+1]]; \
-Matx<double, 3, 3> prefix##invVR1_m = get_invV_mat( \
+const T* prefix##kpt1 = &kpts1[6*fm[(idx)+0]]; \
+const T* prefix##kpt2 = &kpts2[6*fm[(idx)+1]]; \
+Matx<T, 3, 3> prefix##invVR1_m = get_invV_mat( \
     prefix##kpt1[0], prefix##kpt1[1], prefix##kpt1[2], \
     prefix##kpt1[3], prefix##kpt1[4], prefix##kpt1[5]); \
-Matx<double, 3, 3> prefix##invVR2_m = get_invV_mat( \
+Matx<T, 3, 3> prefix##invVR2_m = get_invV_mat( \
     prefix##kpt2[0], prefix##kpt2[1], prefix##kpt2[2], \
     prefix##kpt2[3], prefix##kpt2[4], prefix##kpt2[5]);
-        //vector<Matx<double, 3, 3> > Aff_mats;
-        // MATRIX_REF(i) should be the same as Aff_mats[i], but
-        //  directly operating on the numpy-allocated memory
-        //   (less allocation == faster code)
-#define MATRIX_REF(i) (*((i)+((Matx<double, 3, 3>*)out_matrices_list)))
-        //vector<vector<double> > xy_errs, scale_errs, ori_errs;
-        for(size_t fm_ind = 0; fm_ind < nMatch * 2; fm_ind += 2)
+
+// Orders hypotheses by decreasing inlier weight, ties by increasing index
+struct WeightGreater
+{
+    const double* weights;
+    bool operator()(size_t a, size_t b) const
+    {
+        return (weights[a] > weights[b]) || (weights[a] == weights[b] && a < b);
+    }
+};
+
+// Tests one hypothesis against every match and returns its inlier weight.
+// The inlier flags and the (3, nMatch) errors are only written if the output
+// pointers are not NULL.
+template<typename T>
+static double test_affine_hypothesis(const Matx<T, 3, 3>& Aff_mat,
+                                     const vector<Matx<T, 3, 3> >& invVR1s,
+                                     const vector<Matx<T, 3, 3> >& invVR2s,
+                                     const T* fs, size_t nMatch,
+                                     double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+                                     size_t* out_count, bool* out_inliers, T* out_errors)
+{
+    double inlier_weight = 0;
+    size_t count = 0;
+    for(size_t j = 0; j < nMatch; j++)
+    {
+        Matx<T, 3, 3> invVR1_mt = Aff_mat * invVR1s[j];
+        T    xy_err =  xy_distance(invVR1_mt, invVR2s[j]);
+        T   ori_err = ori_distance(invVR1_mt, invVR2s[j]);
+        T scale_err = det_distance(invVR1_mt, invVR2s[j]);
+        bool is_inlier = (xy_err    <    xy_thresh_sqrd) &&
+                         (scale_err < scale_thresh_sqrd) &&
+                         (ori_err   <        ori_thresh);
+        if(is_inlier)
         {
-            SETUP_invVRs(fm_ind,)
-            //Aff_mats.push_back(get_Aff_mat(invVR1_m, invVR2_m));
-            MATRIX_REF(fm_ind / 2) = get_Aff_mat(invVR1_m, invVR2_m);
+            inlier_weight += fs[j];
+            count++;
+        }
+        if(out_inliers != NULL)
+        {
+            out_inliers[j] = is_inlier;
+        }
+        if(out_errors != NULL)
+        {
+            out_errors[(0 * nMatch) + j] = xy_err;
+            out_errors[(1 * nMatch) + j] = ori_err;
+            out_errors[(2 * nMatch) + j] = scale_err;
         }
-        //const size_t num_matches = nMatch / 2;
-        const size_t num_matches = nMatch;
-        for(size_t i = 0; i < num_matches; i++)
+    }
+    *out_count = count;
+    return inlier_weight;
+}
+
+// Tests every affine hypothesis against every match and writes the inliers,
+// errors, and matrix of the hypothesis with the largest inlier weight into the
+// output buffers. Shared by the single pair and batched entry points. T is
+// the floating point type of the keypoints, scores, errors, and matrix; the
+// inlier weights are always accumulated in double.
+// The winner is picked in a critical section as the threads finish; ties go
+// to the smallest hypothesis index (like argmax), so the result does not
+// depend on the thread schedule.
+template<typename T>
+static double best_affine_inliers(const T* kpts1, const T* kpts2,
+                                  const size_t* fm, const T* fs, size_t nMatch,
+                                  double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+                                  int num_threads,
+                                  bool* out_inliers, T* out_errors, T* out_matrix)
+{
+    //const size_t num_matches = nMatch / 2;
+    const size_t num_matches = nMatch;
+    double current_max_inlier_weight = 0;
+    // index of the current best hypothesis (nMatch * 2 until one is found)
+    size_t current_best_i1 = nMatch * 2;
+    #define USE_PAR_SVER
+
+    #ifndef USE_PAR_SVER
+    const bool parallel_flag = 0;
+    bool* tmp_inliers = new bool[num_matches];
+    T* tmp_errors = new T[num_matches * 3];
+    #else
+    const bool parallel_flag = num_threads != 1;
+    #endif
+    printDBG_SVER(" * parallel_flag = " << parallel_flag);
+    printDBG_SVER(" * num_threads = " << num_threads);
+    MARKUSED(num_threads);
+
+    {
+        //(max : max_val)
+        #pragma omp parallel for num_threads(num_threads) if(parallel_flag)
+        for(size_t i1 = 0; i1 < nMatch * 2; i1 += 2)
         {
-            //xy_errs.push_back(vector<double>());
-            //scale_errs.push_back(vector<double>());
-            //ori_errs.push_back(vector<double>());
-            Matx<double, 3, 3> Aff_mat = MATRIX_REF(i);
-            for(size_t fm_ind = 0; fm_ind < nMatch * 2; fm_ind += 2)
+            #ifdef USE_PAR_SVER
+            bool* tmp_inliers = new bool[num_matches];
+            T* tmp_errors = new T[num_matches * 3];
+            #endif
+            SETUP_invVRs(i1, i1_)
+                Matx<T, 3, 3> Aff_mat = get_Aff_mat(i1_invVR1_m, i1_invVR2_m);
+            double inlier_weight_for_i1 = 0;
+            for(size_t i2 = 0; i2 < nMatch * 2; i2 += 2)
             {
-                SETUP_invVRs(fm_ind,)
-                // _test_hypothesis_inliers
-                Matx<double, 3, 3> invVR1_mt = Aff_mat * invVR1_m;
-                double xy_err = xy_distance(invVR1_mt, invVR2_m);
-                double scale_err = det_distance(invVR1_mt, invVR2_m);
-                double ori_err = ori_distance(invVR1_mt, invVR2_m);
-                //xy_errs[i].push_back(xy_err);
-                //scale_errs[i].push_back(scale_err);
-                //ori_errs[i].push_back(ori_err);
-                // poke the error values directly into the output array with pointer voodoo to
-                //  avoid intermediate allocations (the explicit structure is shown by the
-                //   commented xy_errs, scale_errs, and ori_errs variables).
-#define PACKED_INSERT(OFFSET, VAR) \
-*(out_errors_list+(num_matches*3*i)+(num_matches*(OFFSET))+(fm_ind/2)) = (VAR)
-                PACKED_INSERT(0, xy_err);
-                PACKED_INSERT(1, ori_err);
-                PACKED_INSERT(2, scale_err);
-#undef PACKED_INSERT
-                bool is_inlier = (xy_err < xy_thresh_sqrd) &&
+                SETUP_invVRs(i2, i2_)
+                    Matx<T, 3, 3> i2_invVR1_mt = Aff_mat * i2_invVR1_m;
+                T    xy_err = tmp_errors[(0 * num_matches) + (i2 / 2)] =  xy_distance(i2_invVR1_mt, i2_invVR2_m);
+                T   ori_err = tmp_errors[(1 * num_matches) + (i2 / 2)] = ori_distance(i2_invVR1_mt, i2_invVR2_m);
+                T scale_err = tmp_errors[(2 * num_matches) + (i2 / 2)] = det_distance(i2_invVR1_mt, i2_invVR2_m);
+                bool is_inlier = (xy_err    <    xy_thresh_sqrd) &&
                                  (scale_err < scale_thresh_sqrd) &&
-                                 (ori_err < ori_thresh);
-                *(out_inlier_flags + (num_matches * i) + (fm_ind / 2)) = is_inlier;
-                //printf("errs[%u][%u]: %f, %f, %f\n", fm_ind, i, xy_err, scale_err, ori_err);
+                                 (ori_err   <        ori_thresh);
+                if(is_inlier)
+                {
+                    //inlier_weight_for_i1++;
+                    inlier_weight_for_i1 += fs[i2 / 2];
+                }
+                tmp_inliers[i2 / 2] = is_inlier;
+            }
+            #pragma omp critical(current_max_inlier_weight)
+            {
+                if(inlier_weight_for_i1 > current_max_inlier_weight ||
+                   (inlier_weight_for_i1 == current_max_inlier_weight && i1 < current_best_i1))
+                {
+                    printDBG_SVER(" * inlier_weight_for_i1 = " << inlier_weight_for_i1);
+                    printDBG_SVER(" * i1 = " << i1);
+                    printDBG_SVER(" * current_max_inlier_weight = " << current_max_inlier_weight);
+                    current_max_inlier_weight = inlier_weight_for_i1;
+                    current_best_i1 = i1;
+                    // reuse the output space for the current maximum (since
+                    //  the final "current maximum" is the intended output)
+                    memcpy(out_inliers, tmp_inliers, num_matches * sizeof(bool));
+                    memcpy(out_errors,   tmp_errors, num_matches * 3 * sizeof(T));
+                    memcpy(out_matrix, &Aff_mat, sizeof(Matx<T, 3, 3>));
+                }
             }
+            #ifdef USE_PAR_SVER
+            delete [] tmp_inliers;
+            delete [] tmp_errors;
+            #endif
         }
-#undef MATRIX_REF
-        /*
-        #define SHOW_ERRVEC(vec) \
-        for(size_t i = 0; i < vec.size(); i++) { \
-            putchar('['); \
-            for(size_t j = 0; j < vec[i].size(); j++) { \
-                printf("%f, ", vec[i][j]); \
-            } \
-            puts("]"); \
+    }
+    #ifndef USE_PAR_SVER
+    delete [] tmp_inliers;
+    delete [] tmp_errors;
+    #endif
+    return current_max_inlier_weight;
+}
+
+// Same result as best_affine_inliers with less memory. The weight of every
+// hypothesis is summed in match order into its own slot, and the hypothesis
+// with the largest weight is then chosen serially (ties go to the smallest
+// index, like argmax). The inliers and errors of the winner are recomputed
+// at the end instead of being copied out of a critical section, so no
+// per-thread inlier and error buffers are needed.
+template<typename T>
+static double best_affine_inliers_ordered(const T* kpts1, const T* kpts2,
+                                          const size_t* fm, const T* fs, size_t nMatch,
+                                          double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+                                          int num_threads,
+                                          bool* out_inliers, T* out_errors, T* out_matrix)
+{
+    if(nMatch == 0)
+    {
+        return 0;
+    }
+    vector<Matx<T, 3, 3> > invVR1s(nMatch), invVR2s(nMatch);
+    for(size_t j = 0; j < nMatch; j++)
+    {
+        SETUP_invVRs(2 * j,)
+        invVR1s[j] = invVR1_m;
+        invVR2s[j] = invVR2_m;
+    }
+    vector<double> weights(nMatch);
+    MARKUSED(num_threads);
+    #pragma omp parallel for num_threads(num_threads) if(num_threads != 1)
+    for(long i = 0; i < (long)nMatch; i++)
+    {
+        const Matx<T, 3, 3> Aff_mat = get_Aff_mat(invVR1s[i], invVR2s[i]);
+        size_t count;
+        weights[i] = test_affine_hypothesis(
+            Aff_mat, invVR1s, invVR2s, fs, nMatch,
+            xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+            &count, (bool*)NULL, (T*)NULL);
+    }
+    size_t best_index = 0;
+    for(size_t i = 1; i < nMatch; i++)
+    {
+        if(weights[i] > weights[best_index])
+        {
+            best_index = i;
         }
-                puts("-----");
-                SHOW_ERRVEC(xy_errs)
-                puts("-----");
-                SHOW_ERRVEC(scale_errs)
-                puts("-----");
-                SHOW_ERRVEC(ori_errs)
-                puts("-----");
-        #undef SHOW_ERRVEC
-        */
-        // Code for copying Aff_mats into the output is redundant now
-        //  that the output is operated on directly (via MATRIX_REF)
-        /*
-        //printf("%lu\n", Aff_mats.size());
-        for(size_t i = 0; i < Aff_mats.size(); i++) {
-            const size_t mat_size = 3*3*sizeof(double);
-            //char msg[] = {'M', 'a', 't', 0x30+i%10, 0};
-            //debug_print_mat3x3(msg, Aff_mats[i]);
-            double* dest = (out_matrices_list+(3*3*i));
-            //char* destc = (char*)(out_matrices_list+(3*3*i));
-            //printf("%x\n", dest);
-            //printf("before: "); for(size_t j=0; j < 9; j++) {printf("%f ", *(dest+j)); }
-            //printf("\nbefore: "); for(size_t j=0; j < mat_size; j+=8) {printf("0x%08x ", *(destc+j)); }
-            memcpy(dest, &Aff_mats[i], mat_size);
-            //printf("\nafter: "); for(size_t j=0; j < 9; j++) {printf("%f ", *(dest+j)); }
-            //printf("\nafter: "); for(size_t j=0; j < mat_size; j+=8) {printf("0x%08x ", *(destc+j)); }
-            //puts("\n");
+    }
+    const Matx<T, 3, 3> Aff_mat = get_Aff_mat(invVR1s[best_index], invVR2s[best_index]);
+    size_t count;
+    test_affine_hypothesis(
+        Aff_mat, invVR1s, invVR2s, fs, nMatch,
+        xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+        &count, out_inliers, out_errors);
+    memcpy(out_matrix, &Aff_mat, sizeof(Matx<T, 3, 3>));
+    return weights[best_index];
+}
+
+// Matches bucketed by the grid cells of both of their keypoints. Cells in
+// image 2 are as wide as the spatial threshold; cells in image 1 are rescaled
+// by the median scale change so a hypothesis maps a cell in image 1 to about
+// one cell in image 2. Each bucket stores the bounding box of its members
+// (always in double, whatever the type of the keypoints).
+template<typename T>
+struct MatchGrid
+{
+    vector<Matx<T, 3, 3> > invVR1s, invVR2s;
+    vector<size_t> sortx;    // match indexes sorted by bucket
+    vector<size_t> offsets;  // bucket k holds sortx[offsets[k]:offsets[k + 1]]
+    vector<double> center1x, center1y, radius1;
+    vector<double> low2x, low2y, high2x, high2y;
+};
+
+struct CellKeyLess
+{
+    const vector<long long>* keys;
+    bool operator()(size_t a, size_t b) const
+    {
+        const long long* ka = &(*keys)[4 * a];
+        const long long* kb = &(*keys)[4 * b];
+        return std::lexicographical_compare(ka, ka + 4, kb, kb + 4);
+    }
+};
+
+template<typename T>
+static void build_match_grid(const T* kpts1, const T* kpts2,
+                             const size_t* fm, size_t nMatch, double xy_thresh,
+                             MatchGrid<T>& grid)
+{
+    grid.invVR1s.resize(nMatch);
+    grid.invVR2s.resize(nMatch);
+    vector<double> det_ratios(nMatch);
+    double min1x = 0, min1y = 0, min2x = 0, min2y = 0;
+    for(size_t j = 0; j < nMatch; j++)
+    {
+        SETUP_invVRs(2 * j,)
+        grid.invVR1s[j] = invVR1_m;
+        grid.invVR2s[j] = invVR2_m;
+        double det1 = (double)invVR1_m(0, 0) * invVR1_m(1, 1) - (double)invVR1_m(0, 1) * invVR1_m(1, 0);
+        double det2 = (double)invVR2_m(0, 0) * invVR2_m(1, 1) - (double)invVR2_m(0, 1) * invVR2_m(1, 0);
+        det_ratios[j] = det1 / det2;
+        if(j == 0 || invVR1_m(0, 2) < min1x) { min1x = invVR1_m(0, 2); }
+        if(j == 0 || invVR1_m(1, 2) < min1y) { min1y = invVR1_m(1, 2); }
+        if(j == 0 || invVR2_m(0, 2) < min2x) { min2x = invVR2_m(0, 2); }
+        if(j == 0 || invVR2_m(1, 2) < min2y) { min2y = invVR2_m(1, 2); }
+    }
+    std::nth_element(det_ratios.begin(), det_ratios.begin() + nMatch / 2, det_ratios.end());
+    double zoom = sqrt(det_ratios[nMatch / 2]);
+    double cell_size2 = std::max(xy_thresh, 1e-9);
+    double cell_size1 = (zoom > 0 && std::isfinite(zoom)) ? cell_size2 * zoom : cell_size2;
+    vector<long long> keys(4 * nMatch);
+    for(size_t j = 0; j < nMatch; j++)
+    {
+        keys[4 * j + 0] = (long long)floor((grid.invVR1s[j](0, 2) - min1x) / cell_size1);
+        keys[4 * j + 1] = (long long)floor((grid.invVR1s[j](1, 2) - min1y) / cell_size1);
+        keys[4 * j + 2] = (long long)floor((grid.invVR2s[j](0, 2) - min2x) / cell_size2);
+        keys[4 * j + 3] = (long long)floor((grid.invVR2s[j](1, 2) - min2y) / cell_size2);
+    }
+    grid.sortx.resize(nMatch);
+    for(size_t j = 0; j < nMatch; j++)
+    {
+        grid.sortx[j] = j;
+    }
+    CellKeyLess key_less = {&keys};
+    std::stable_sort(grid.sortx.begin(), grid.sortx.end(), key_less);
+    grid.offsets.clear();
+    for(size_t s = 0; s < nMatch; s++)
+    {
+        if(s == 0 || key_less(grid.sortx[s - 1], grid.sortx[s]))
+        {
+            grid.offsets.push_back(s);
         }
-        */
-    }
-
-    int get_best_affine_inliers(double* kpts1, size_t kpts1_len,
-                                double* kpts2, size_t kpts2_len,
-                                size_t* fm, double* fs, size_t nMatch,
-                                double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
-                                // memory is expected to by allocated by the caller (i.e. via numpy.empty)
-                                bool* out_inliers, double* out_errors, double* out_matrix)
-    {
-        printDBG_SVER("get_best_affine_inliers");
-        printDBG_SVER(" * kpts1_len = " << kpts1_len);
-        printDBG_SVER(" * kpts2_len = " << kpts2_len);
-        printDBG_SVER(" * nMatch = " << nMatch);
-        printDBG_SVER(" * xy_thresh_sqrd = " << xy_thresh_sqrd);
-        printDBG_SVER(" * scale_thresh_sqrd = " << scale_thresh_sqrd);
-        printDBG_SVER(" * ori_thresh = " << ori_thresh);
-        printDBG_SVER(" * sizeof(size_t) = " << sizeof(size_t));
-        MARKUSED(kpts1_len);
-        MARKUSED(kpts2_len);
-        CHECK_FM_BOUNDS(fm, nMatch, kpts1_len, kpts2_len);
-        //const size_t num_matches = nMatch / 2;
-        const size_t num_matches = nMatch;
-        double current_max_inlier_weight = 0;
-        #define USE_PAR_SVER
-
-        #ifndef USE_PAR_SVER
-        const bool parallel_flag = 0;
-        bool* tmp_inliers = new bool[num_matches];
-        double* tmp_errors = new double[num_matches * 3];
-        #else
-        const bool parallel_flag = 1;
-        #endif
-        printDBG_SVER(" * parallel_flag = " << parallel_flag);
+    }
+    grid.offsets.push_back(nMatch);
+    const size_t nBucket = grid.offsets.size() - 1;
+    grid.center1x.resize(nBucket);
+    grid.center1y.resize(nBucket);
+    grid.radius1.resize(nBucket);
+    grid.low2x.resize(nBucket);
+    grid.low2y.resize(nBucket);
+    grid.high2x.resize(nBucket);
+    grid.high2y.resize(nBucket);
+    for(size_t k = 0; k < nBucket; k++)
+    {
+        double lo1x = INFINITY, lo1y = INFINITY, hi1x = -INFINITY, hi1y = -INFINITY;
+        double lo2x = INFINITY, lo2y = INFINITY, hi2x = -INFINITY, hi2y = -INFINITY;
+        for(size_t s = grid.offsets[k]; s < grid.offsets[k + 1]; s++)
+        {
+            const Matx<T, 3, 3>& m1 = grid.invVR1s[grid.sortx[s]];
+            const Matx<T, 3, 3>& m2 = grid.invVR2s[grid.sortx[s]];
+            const double x1 = m1(0, 2), y1 = m1(1, 2), x2 = m2(0, 2), y2 = m2(1, 2);
+            lo1x = std::min(lo1x, x1); hi1x = std::max(hi1x, x1);
+            lo1y = std::min(lo1y, y1); hi1y = std::max(hi1y, y1);
+            lo2x = std::min(lo2x, x2); hi2x = std::max(hi2x, x2);
+            lo2y = std::min(lo2y, y2); hi2y = std::max(hi2y, y2);
+        }
+        grid.center1x[k] = (lo1x + hi1x) / 2;
+        grid.center1y[k] = (lo1y + hi1y) / 2;
+        grid.radius1[k] = sqrt((hi1x - lo1x) * (hi1x - lo1x) + (hi1y - lo1y) * (hi1y - lo1y)) / 2;
+        grid.low2x[k] = lo2x;
+        grid.low2y[k] = lo2y;
+        grid.high2x[k] = hi2x;
+        grid.high2y[k] = hi2y;
+    }
+}
 
+// Same result as best_affine_inliers (up to floating point ties in the
+// weights), but each hypothesis skips the buckets of matches that cannot be
+// within the spatial threshold and only computes the scale and orientation
+// errors of matches that pass the spatial test. The errors of the winning
+// hypothesis are recomputed for every match at the end.
+template<typename T>
+static double best_affine_inliers_grid(const T* kpts1, const T* kpts2,
+                                       const size_t* fm, const T* fs, size_t nMatch,
+                                       double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+                                       int num_threads,
+                                       bool* out_inliers, T* out_errors, T* out_matrix)
+{
+    if(nMatch == 0)
+    {
+        return 0;
+    }
+    const double xy_thresh = sqrt(xy_thresh_sqrd);
+    // padding of the bucket test that absorbs the roundoff of the
+    //  per-match tests (which are done in T)
+    const double pad = 1 + std::max(1e-9, 1e3 * (double)std::numeric_limits<T>::epsilon());
+    MatchGrid<T> grid;
+    build_match_grid(kpts1, kpts2, fm, nMatch, xy_thresh, grid);
+    const long nBucket = (long)grid.offsets.size() - 1;
+    printDBG_SVER(" * nBucket = " << nBucket);
+    vector<double> weights(nMatch);
+    MARKUSED(num_threads);
+    #pragma omp parallel for num_threads(num_threads) if(num_threads != 1)
+    for(long i = 0; i < (long)nMatch; i++)
+    {
+        const Matx<T, 3, 3> Aff_mat = get_Aff_mat(grid.invVR1s[i], grid.invVR2s[i]);
+        const double stretch = sqrt(Aff_mat(0, 0) * Aff_mat(0, 0) + Aff_mat(0, 1) * Aff_mat(0, 1) +
+                                    Aff_mat(1, 0) * Aff_mat(1, 0) + Aff_mat(1, 1) * Aff_mat(1, 1));
+        double inlier_weight = 0;
+        for(long k = 0; k < nBucket; k++)
         {
-            //(max : max_val)
-            #pragma omp parallel for if(parallel_flag)
-            for(size_t i1 = 0; i1 < nMatch * 2; i1 += 2)
+            // distance from the projected bucket center to the bucket bbox in image 2
+            double px = Aff_mat(0, 0) * grid.center1x[k] + Aff_mat(0, 1) * grid.center1y[k] + Aff_mat(0, 2);
+            double py = Aff_mat(1, 0) * grid.center1x[k] + Aff_mat(1, 1) * grid.center1y[k] + Aff_mat(1, 2);
+            double gx = std::max(std::max(grid.low2x[k] - px, px - grid.high2x[k]), 0.0);
+            double gy = std::max(std::max(grid.low2y[k] - py, py - grid.high2y[k]), 0.0);
+            double reach = (xy_thresh + stretch * grid.radius1[k]) * pad;
+            if(gx * gx + gy * gy > reach * reach)
             {
-                #ifdef USE_PAR_SVER
-                bool* tmp_inliers = new bool[num_matches];
-                double* tmp_errors = new double[num_matches * 3];
-                #endif
-                SETUP_invVRs(i1, i1_)
-                    Matx<double, 3, 3> Aff_mat = get_Aff_mat(i1_invVR1_m, i1_invVR2_m);
-                double inlier_weight_for_i1 = 0;
-                for(size_t i2 = 0; i2 < nMatch * 2; i2 += 2)
+                continue;
+            }
+            for(size_t s = grid.offsets[k]; s < grid.offsets[k + 1]; s++)
+            {
+                const size_t j = grid.sortx[s];
+                Matx<T, 3, 3> invVR1_mt = Aff_mat * grid.invVR1s[j];
+                if(!(xy_distance(invVR1_mt, grid.invVR2s[j]) < xy_thresh_sqrd))
                 {
-                    SETUP_invVRs(i2, i2_)
-                        Matx<double, 3, 3> i2_invVR1_mt = Aff_mat * i2_invVR1_m;
-                    double    xy_err = tmp_errors[(0 * num_matches) + (i2 / 2)] =  xy_distance(i2_invVR1_mt, i2_invVR2_m);
-                    double   ori_err = tmp_errors[(1 * num_matches) + (i2 / 2)] = ori_distance(i2_invVR1_mt, i2_invVR2_m);
-                    double scale_err = tmp_errors[(2 * num_matches) + (i2 / 2)] = det_distance(i2_invVR1_mt, i2_invVR2_m);
-                    bool is_inlier = (xy_err    <    xy_thresh_sqrd) &&
-                                     (scale_err < scale_thresh_sqrd) &&
-                                     (ori_err   <        ori_thresh);
-                    if(is_inlier)
-                    {
-                        //inlier_weight_for_i1++;
-                        inlier_weight_for_i1 += fs[i2 / 2];
-                    }
-                    tmp_inliers[i2 / 2] = is_inlier;
+                    continue;
                 }
-                #pragma omp critical(current_max_inlier_weight)
+                if((det_distance(invVR1_mt, grid.invVR2s[j]) < scale_thresh_sqrd) &&
+                   (ori_distance(invVR1_mt, grid.invVR2s[j]) < ori_thresh))
+                {
+                    inlier_weight += fs[j];
+                }
+            }
+        }
+        weights[i] = inlier_weight;
+    }
+    // The first hypothesis with the largest weight wins
+    size_t best_index = 0;
+    for(size_t i = 1; i < nMatch; i++)
+    {
+        if(weights[i] > weights[best_index])
+        {
+            best_index = i;
+        }
+    }
+    const Matx<T, 3, 3> Aff_mat = get_Aff_mat(grid.invVR1s[best_index], grid.invVR2s[best_index]);
+    for(size_t j = 0; j < nMatch; j++)
+    {
+        Matx<T, 3, 3> invVR1_mt = Aff_mat * grid.invVR1s[j];
+        T    xy_err = out_errors[(0 * nMatch) + j] =  xy_distance(invVR1_mt, grid.invVR2s[j]);
+        T   ori_err = out_errors[(1 * nMatch) + j] = ori_distance(invVR1_mt, grid.invVR2s[j]);
+        T scale_err = out_errors[(2 * nMatch) + j] = det_distance(invVR1_mt, grid.invVR2s[j]);
+        out_inliers[j] = (xy_err    <    xy_thresh_sqrd) &&
+                         (scale_err < scale_thresh_sqrd) &&
+                         (ori_err   <        ori_thresh);
+    }
+    memcpy(out_matrix, &Aff_mat, sizeof(Matx<T, 3, 3>));
+    return weights[best_index];
+}
+
+// Tests every affine hypothesis against every match. T is the floating point
+// type of the keypoints, scores, errors, and matrices.
+template<typename T>
+static void affine_inliers(const T* kpts1, size_t kpts1_len,
+                           const T* kpts2, size_t kpts2_len,
+                           const size_t* fm, const T* fs, size_t nMatch,
+                           double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+                           int num_threads,
+                           // memory is expected to by allocated by the caller (i.e. via numpy.empty)
+                           bool* out_inlier_flags, T* out_errors_list, T* out_matrices_list)
+{
+    printDBG_SVER("affine_inliers");
+    printDBG_SVER(" * kpts1_len = " << kpts1_len);
+    printDBG_SVER(" * kpts2_len = " << kpts2_len);
+    printDBG_SVER(" * nMatch = " << nMatch);
+    printDBG_SVER(" * xy_thresh_sqrd = " << xy_thresh_sqrd);
+    printDBG_SVER(" * scale_thresh_sqrd = " << scale_thresh_sqrd);
+    printDBG_SVER(" * ori_thresh = " << ori_thresh);
+    printDBG_SVER(" * sizeof(size_t) = " << sizeof(size_t));
+    MARKUSED(kpts1_len);
+    MARKUSED(kpts2_len);
+    CHECK_FM_BOUNDS(fm, nMatch, kpts1_len, kpts2_len);
+    num_threads = resolve_num_threads(num_threads);
+    printDBG_SVER(" * num_threads = " << num_threads);
+    MARKUSED(num_threads);
+    //vector<Matx<double, 3, 3> > Aff_mats;
+    // MATRIX_REF(i) should be the same as Aff_mats[i], but
+    //  directly operating on the numpy-allocated memory
+    //   (less allocation == faster code)
+#define MATRIX_REF(i) (*((i)+((Matx<T, 3, 3>*)out_matrices_list)))
+    //vector<vector<double> > xy_errs, scale_errs, ori_errs;
+    for(size_t fm_ind = 0; fm_ind < nMatch * 2; fm_ind += 2)
+    {
+        SETUP_invVRs(fm_ind,)
+        //Aff_mats.push_back(get_Aff_mat(invVR1_m, invVR2_m));
+        MATRIX_REF(fm_ind / 2) = get_Aff_mat(invVR1_m, invVR2_m);
+    }
+    //const size_t num_matches = nMatch / 2;
+    const size_t num_matches = nMatch;
+    // each hypothesis writes to its own rows of the output, so the
+    //  hypotheses can be tested independently
+    #pragma omp parallel for num_threads(num_threads) if(num_threads != 1)
+    for(size_t i = 0; i < num_matches; i++)
+    {
+        //xy_errs.push_back(vector<double>());
+        //scale_errs.push_back(vector<double>());
+        //ori_errs.push_back(vector<double>());
+        Matx<T, 3, 3> Aff_mat = MATRIX_REF(i);
+        for(size_t fm_ind = 0; fm_ind < nMatch * 2; fm_ind += 2)
+        {
+            SETUP_invVRs(fm_ind,)
+            // _test_hypothesis_inliers
+            Matx<T, 3, 3> invVR1_mt = Aff_mat * invVR1_m;
+            T xy_err = xy_distance(invVR1_mt, invVR2_m);
+            T scale_err = det_distance(invVR1_mt, invVR2_m);
+            T ori_err = ori_distance(invVR1_mt, invVR2_m);
+            //xy_errs[i].push_back(xy_err);
+            //scale_errs[i].push_back(scale_err);
+            //ori_errs[i].push_back(ori_err);
+            // poke the error values directly into the output array with pointer voodoo to
+            //  avoid intermediate allocations (the explicit structure is shown by the
+            //   commented xy_errs, scale_errs, and ori_errs variables).
+#define PACKED_INSERT(OFFSET, VAR) \
+*(out_errors_list+(num_matches*3*i)+(num_matches*(OFFSET))+(fm_ind/2)) = (VAR)
+            PACKED_INSERT(0, xy_err);
+            PACKED_INSERT(1, ori_err);
+            PACKED_INSERT(2, scale_err);
+#undef PACKED_INSERT
+            bool is_inlier = (xy_err < xy_thresh_sqrd) &&
+                             (scale_err < scale_thresh_sqrd) &&
+                             (ori_err < ori_thresh);
+            *(out_inlier_flags + (num_matches * i) + (fm_ind / 2)) = is_inlier;
+            //printf("errs[%u][%u]: %f, %f, %f\n", fm_ind, i, xy_err, scale_err, ori_err);
+        }
+    }
+#undef MATRIX_REF
+    /*
+    #define SHOW_ERRVEC(vec) \
+    for(size_t i = 0; i < vec.size(); i++) { \
+        putchar('['); \
+        for(size_t j = 0; j < vec[i].size(); j++) { \
+            printf("%f, ", vec[i][j]); \
+        } \
+        puts("]"); \
+    }
+            puts("-----");
+            SHOW_ERRVEC(xy_errs)
+            puts("-----");
+            SHOW_ERRVEC(scale_errs)
+            puts("-----");
+            SHOW_ERRVEC(ori_errs)
+            puts("-----");
+    #undef SHOW_ERRVEC
+    */
+    // Code for copying Aff_mats into the output is redundant now
+    //  that the output is operated on directly (via MATRIX_REF)
+    /*
+    //printf("%lu\n", Aff_mats.size());
+    for(size_t i = 0; i < Aff_mats.size(); i++) {
+        const size_t mat_size = 3*3*sizeof(double);
+        //char msg[] = {'M', 'a', 't', 0x30+i%10, 0};
+        //debug_print_mat3x3(msg, Aff_mats[i]);
+        double* dest = (out_matrices_list+(3*3*i));
+        //char* destc = (char*)(out_matrices_list+(3*3*i));
+        //printf("%x\n", dest);
+        //printf("before: "); for(size_t j=0; j < 9; j++) {printf("%f ", *(dest+j)); }
+        //printf("\nbefore: "); for(size_t j=0; j < mat_size; j+=8) {printf("0x%08x ", *(destc+j)); }
+        memcpy(dest, &Aff_mats[i], mat_size);
+        //printf("\nafter: "); for(size_t j=0; j < 9; j++) {printf("%f ", *(dest+j)); }
+        //printf("\nafter: "); for(size_t j=0; j < mat_size; j+=8) {printf("0x%08x ", *(destc+j)); }
+        //puts("\n");
+    }
+    */
+}
+
+template<typename T>
+static double best_affine_inliers_pair(const T* kpts1, size_t kpts1_len,
+                                       const T* kpts2, size_t kpts2_len,
+                                       const size_t* fm, const T* fs, size_t nMatch,
+                                       double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+                                       int num_threads, bool spatial_index, bool deterministic,
+                                       // memory is expected to by allocated by the caller (i.e. via numpy.empty)
+                                       bool* out_inliers, T* out_errors, T* out_matrix)
+{
+    printDBG_SVER("best_affine_inliers_pair");
+    printDBG_SVER(" * kpts1_len = " << kpts1_len);
+    printDBG_SVER(" * kpts2_len = " << kpts2_len);
+    printDBG_SVER(" * nMatch = " << nMatch);
+    printDBG_SVER(" * xy_thresh_sqrd = " << xy_thresh_sqrd);
+    printDBG_SVER(" * scale_thresh_sqrd = " << scale_thresh_sqrd);
+    printDBG_SVER(" * ori_thresh = " << ori_thresh);
+    printDBG_SVER(" * sizeof(size_t) = " << sizeof(size_t));
+    MARKUSED(kpts1_len);
+    MARKUSED(kpts2_len);
+    CHECK_FM_BOUNDS(fm, nMatch, kpts1_len, kpts2_len);
+    if(spatial_index)
+    {
+        return best_affine_inliers_grid(
+            kpts1, kpts2, fm, fs, nMatch,
+            xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+            resolve_num_threads(num_threads),
+            out_inliers, out_errors, out_matrix);
+    }
+    if(deterministic)
+    {
+        return best_affine_inliers_ordered(
+            kpts1, kpts2, fm, fs, nMatch,
+            xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+            resolve_num_threads(num_threads),
+            out_inliers, out_errors, out_matrix);
+    }
+    double current_max_inlier_weight = best_affine_inliers(
+        kpts1, kpts2, fm, fs, nMatch,
+        xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+        resolve_num_threads(num_threads),
+        out_inliers, out_errors, out_matrix);
+    return current_max_inlier_weight;
+}
+
+template<typename T>
+static void best_affine_inliers_batch(const T* kpts1_flat, const size_t* kpts1_offsets,
+                                      const T* kpts2_flat, const size_t* kpts2_offsets,
+                                      const size_t* fm_flat, const T* fs_flat, const size_t* fm_offsets,
+                                      size_t nPairs, const double* xy_thresh_sqrd_list,
+                                      double scale_thresh_sqrd, double ori_thresh,
+                                      int num_threads, bool spatial_index, bool deterministic,
+                                      // memory is expected to by allocated by the caller (i.e. via numpy.empty)
+                                      bool* out_inliers_flat, T* out_errors_flat,
+                                      T* out_matrices, double* out_weights)
+{
+    /*
+    Runs get_best_affine_inliers over many (kpts1, kpts2, fm, fs) pairs in
+    a single call. Inputs are stacked CSR-style: the keypoints of pair p
+    start at row kpts{1,2}_offsets[p] (pairs may share keypoint rows) and
+    its matches are fm_offsets[p]:fm_offsets[p + 1] (fm_offsets has
+    nPairs + 1 entries). Each pair writes its inlier flags at
+    out_inliers_flat[fm_offsets[p]], its (3, nMatch_p) error block at
+    out_errors_flat[3 * fm_offsets[p]], and its hypothesis at
+    out_matrices[9 * p].
+    */
+    printDBG_SVER("best_affine_inliers_batch");
+    printDBG_SVER(" * nPairs = " << nPairs);
+    num_threads = resolve_num_threads(num_threads);
+    for(size_t px = 0; px < nPairs; px++)
+    {
+        const size_t fm_start = fm_offsets[px];
+        const size_t nMatch = fm_offsets[px + 1] - fm_start;
+        if(nMatch == 0)
+        {
+            out_weights[px] = 0;
+            continue;
+        }
+        out_weights[px] = (spatial_index ? best_affine_inliers_grid<T> :
+                           deterministic ? best_affine_inliers_ordered<T> : best_affine_inliers<T>)(
+            kpts1_flat + (6 * kpts1_offsets[px]),
+            kpts2_flat + (6 * kpts2_offsets[px]),
+            fm_flat + (2 * fm_start), fs_flat + fm_start, nMatch,
+            xy_thresh_sqrd_list[px], scale_thresh_sqrd, ori_thresh,
+            num_threads,
+            out_inliers_flat + fm_start,
+            out_errors_flat + (3 * fm_start),
+            out_matrices + (9 * px));
+    }
+}
+// Compact version of affine_inliers. Only the number of inliers and the
+// inlier weight of each hypothesis are written (O(nMatch) memory instead of
+// O(nMatch ** 2)). The top_k hypotheses with the largest weight (ties by
+// index) additionally get their index, inlier flags (top_k, nMatch), errors
+// (top_k, 3, nMatch), and matrix written in order.
+template<typename T>
+static void affine_inlier_scores(const T* kpts1, const T* kpts2,
+                                 const size_t* fm, const T* fs, size_t nMatch,
+                                 double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+                                 int num_threads, size_t top_k,
+                                 // memory is expected to by allocated by the caller (i.e. via numpy.empty)
+                                 size_t* out_counts, double* out_weights,
+                                 size_t* out_top_idxs, bool* out_top_inliers,
+                                 T* out_top_errors, T* out_top_mats)
+{
+    printDBG_SVER("affine_inlier_scores");
+    printDBG_SVER(" * nMatch = " << nMatch);
+    printDBG_SVER(" * top_k = " << top_k);
+    vector<Matx<T, 3, 3> > invVR1s(nMatch), invVR2s(nMatch);
+    for(size_t j = 0; j < nMatch; j++)
+    {
+        SETUP_invVRs(2 * j,)
+        invVR1s[j] = invVR1_m;
+        invVR2s[j] = invVR2_m;
+    }
+    num_threads = resolve_num_threads(num_threads);
+    MARKUSED(num_threads);
+    #pragma omp parallel for num_threads(num_threads) if(num_threads != 1)
+    for(long i = 0; i < (long)nMatch; i++)
+    {
+        const Matx<T, 3, 3> Aff_mat = get_Aff_mat(invVR1s[i], invVR2s[i]);
+        out_weights[i] = test_affine_hypothesis(
+            Aff_mat, invVR1s, invVR2s, fs, nMatch,
+            xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+            &out_counts[i], (bool*)NULL, (T*)NULL);
+    }
+    top_k = std::min(top_k, nMatch);
+    vector<size_t> order(nMatch);
+    for(size_t i = 0; i < nMatch; i++)
+    {
+        order[i] = i;
+    }
+    WeightGreater weight_greater = {out_weights};
+    std::partial_sort(order.begin(), order.begin() + top_k, order.end(), weight_greater);
+    for(size_t r = 0; r < top_k; r++)
+    {
+        const size_t i = order[r];
+        const Matx<T, 3, 3> Aff_mat = get_Aff_mat(invVR1s[i], invVR2s[i]);
+        size_t count;
+        test_affine_hypothesis(
+            Aff_mat, invVR1s, invVR2s, fs, nMatch,
+            xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+            &count, out_top_inliers + (r * nMatch), out_top_errors + (r * 3 * nMatch));
+        out_top_idxs[r] = i;
+        memcpy(out_top_mats + (9 * r), &Aff_mat, sizeof(Matx<T, 3, 3>));
+    }
+}
+
+// Nested version of best_affine_inliers for subsets of the matches that grow
+// with a level: match j is part of every level >= levels[j]. Each hypothesis
+// is only tested once and its inlier weight is accumulated for every level,
+// in the same order best_affine_inliers would accumulate it for that subset.
+// The best hypothesis of each level is chosen among the hypotheses of the
+// level's own matches (ties go to the first one, like best_affine_inliers
+// and argmax in the python fallback). Its index (nMatch if the level has none), inlier flags
+// (masked to the level), errors (nLevels, 3, nMatch), matrix, and weight are
+// written in level order.
+template<typename T>
+static void best_affine_inliers_nested(const T* kpts1, const T* kpts2,
+                                       const size_t* fm, const T* fs,
+                                       const size_t* levels, size_t nMatch, size_t nLevels,
+                                       double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh,
+                                       int num_threads,
+                                       // memory is expected to by allocated by the caller (i.e. via numpy.empty)
+                                       size_t* out_best_idxs, bool* out_inliers,
+                                       T* out_errors, T* out_mats, double* out_weights)
+{
+    printDBG_SVER("best_affine_inliers_nested");
+    printDBG_SVER(" * nMatch = " << nMatch);
+    printDBG_SVER(" * nLevels = " << nLevels);
+    vector<Matx<T, 3, 3> > invVR1s(nMatch), invVR2s(nMatch);
+    for(size_t j = 0; j < nMatch; j++)
+    {
+        SETUP_invVRs(2 * j,)
+        invVR1s[j] = invVR1_m;
+        invVR2s[j] = invVR2_m;
+    }
+    // weights of hypothesis i at each level are stored at i * nLevels
+    vector<double> level_weights(nMatch * nLevels, 0.0);
+    num_threads = resolve_num_threads(num_threads);
+    MARKUSED(num_threads);
+    #pragma omp parallel for num_threads(num_threads) if(num_threads != 1)
+    for(long i = 0; i < (long)nMatch; i++)
+    {
+        double* weights = &level_weights[i * nLevels];
+        const Matx<T, 3, 3> Aff_mat = get_Aff_mat(invVR1s[i], invVR2s[i]);
+        for(size_t j = 0; j < nMatch; j++)
+        {
+            Matx<T, 3, 3> invVR1_mt = Aff_mat * invVR1s[j];
+            T    xy_err =  xy_distance(invVR1_mt, invVR2s[j]);
+            T   ori_err = ori_distance(invVR1_mt, invVR2s[j]);
+            T scale_err = det_distance(invVR1_mt, invVR2s[j]);
+            bool is_inlier = (xy_err    <    xy_thresh_sqrd) &&
+                             (scale_err < scale_thresh_sqrd) &&
+                             (ori_err   <        ori_thresh);
+            if(is_inlier)
+            {
+                for(size_t b = levels[j]; b < nLevels; b++)
                 {
-                    if(inlier_weight_for_i1 >= current_max_inlier_weight)
-                    {
-                        printDBG_SVER(" * inlier_weight_for_i1 = " << inlier_weight_for_i1);
-                        printDBG_SVER(" * i1 = " << i1);
-                        printDBG_SVER(" * current_max_inlier_weight = " << current_max_inlier_weight);
-                        current_max_inlier_weight = inlier_weight_for_i1;
-                        // reuse the output space for the current maximum (since
-                        //  the final "current maximum" is the intended output)
-                        memcpy(out_inliers, tmp_inliers, num_matches * sizeof(bool));
-                        memcpy(out_errors,   tmp_errors, num_matches * 3 * sizeof(double));
-                        memcpy(out_matrix, &Aff_mat, sizeof(Matx<double, 3, 3>));
-                    }
+                    weights[b] += fs[j];
                 }
-                #ifdef USE_PAR_SVER
-                delete [] tmp_inliers;
-                delete [] tmp_errors;
-                #endif
             }
         }
-        #ifndef USE_PAR_SVER
-        delete [] tmp_inliers;
-        delete [] tmp_errors;
-        #endif
-        return current_max_inlier_weight;
     }
+    for(size_t b = 0; b < nLevels; b++)
+    {
+        size_t best_idx = nMatch;
+        double best_weight = 0;
+        for(size_t i = 0; i < nMatch; i++)
+        {
+            // ties go to the first hypothesis, like argmax in the python fallback
+            if(levels[i] <= b && (best_idx == nMatch || level_weights[i * nLevels + b] > best_weight))
+            {
+                best_idx = i;
+                best_weight = level_weights[i * nLevels + b];
+            }
+        }
+        out_best_idxs[b] = best_idx;
+        out_weights[b] = best_weight;
+        bool* inliers = out_inliers + (b * nMatch);
+        if(best_idx == nMatch)
+        {
+            memset(inliers, 0, nMatch * sizeof(bool));
+            continue;
+        }
+        const Matx<T, 3, 3> Aff_mat = get_Aff_mat(invVR1s[best_idx], invVR2s[best_idx]);
+        size_t count;
+        test_affine_hypothesis(
+            Aff_mat, invVR1s, invVR2s, fs, nMatch,
+            xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh,
+            &count, inliers, out_errors + (b * 3 * nMatch));
+        for(size_t j = 0; j < nMatch; j++)
+        {
+            inliers[j] = inliers[j] && levels[j] <= b;
+        }
+        memcpy(out_mats + (9 * b), &Aff_mat, sizeof(Matx<T, 3, 3>));
+    }
+}
 #undef SETUP_invVRs
+
+extern "C" {
+    // The double entry points are the reference implementation; the _f32
+    // entry points run the same code in single precision.
+#define SVER_AFFINE_INLIERS(NAME, T) \
+    void NAME(T* kpts1, size_t kpts1_len, T* kpts2, size_t kpts2_len, \
+              size_t* fm, T* fs, size_t nMatch, \
+              double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh, \
+              int num_threads, \
+              bool* out_inlier_flags, T* out_errors_list, T* out_matrices_list) \
+    { \
+        affine_inliers<T>(kpts1, kpts1_len, kpts2, kpts2_len, fm, fs, nMatch, \
+                          xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh, num_threads, \
+                          out_inlier_flags, out_errors_list, out_matrices_list); \
+    }
+    SVER_AFFINE_INLIERS(get_affine_inliers, double)
+    SVER_AFFINE_INLIERS(get_affine_inliers_f32, float)
+#undef SVER_AFFINE_INLIERS
+
+#define SVER_BEST_AFFINE_INLIERS(NAME, T) \
+    int NAME(T* kpts1, size_t kpts1_len, T* kpts2, size_t kpts2_len, \
+             size_t* fm, T* fs, size_t nMatch, \
+             double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh, \
+             int num_threads, bool spatial_index, bool deterministic, \
+             bool* out_inliers, T* out_errors, T* out_matrix) \
+    { \
+        return best_affine_inliers_pair<T>(kpts1, kpts1_len, kpts2, kpts2_len, fm, fs, nMatch, \
+                                           xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh, \
+                                           num_threads, spatial_index, deterministic, \
+                                           out_inliers, out_errors, out_matrix); \
+    }
+    SVER_BEST_AFFINE_INLIERS(get_best_affine_inliers, double)
+    SVER_BEST_AFFINE_INLIERS(get_best_affine_inliers_f32, float)
+#undef SVER_BEST_AFFINE_INLIERS
+
+#define SVER_BEST_AFFINE_INLIERS_BATCH(NAME, T) \
+    void NAME(T* kpts1_flat, size_t* kpts1_offsets, T* kpts2_flat, size_t* kpts2_offsets, \
+              size_t* fm_flat, T* fs_flat, size_t* fm_offsets, \
+              size_t nPairs, double* xy_thresh_sqrd_list, \
+              double scale_thresh_sqrd, double ori_thresh, \
+              int num_threads, bool spatial_index, bool deterministic, \
+              bool* out_inliers_flat, T* out_errors_flat, \
+              T* out_matrices, double* out_weights) \
+    { \
+        best_affine_inliers_batch<T>(kpts1_flat, kpts1_offsets, kpts2_flat, kpts2_offsets, \
+                                     fm_flat, fs_flat, fm_offsets, nPairs, xy_thresh_sqrd_list, \
+                                     scale_thresh_sqrd, ori_thresh, num_threads, \
+                                     spatial_index, deterministic, \
+                                     out_inliers_flat, out_errors_flat, out_matrices, out_weights); \
+    }
+    SVER_BEST_AFFINE_INLIERS_BATCH(get_best_affine_inliers_batch, double)
+    SVER_BEST_AFFINE_INLIERS_BATCH(get_best_affine_inliers_batch_f32, float)
+#undef SVER_BEST_AFFINE_INLIERS_BATCH
+
+#define SVER_AFFINE_INLIER_SCORES(NAME, T) \
+    void NAME(T* kpts1, T* kpts2, size_t* fm, T* fs, size_t nMatch, \
+              double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh, \
+              int num_threads, size_t top_k, \
+              size_t* out_counts, double* out_weights, \
+              size_t* out_top_idxs, bool* out_top_inliers, \
+              T* out_top_errors, T* out_top_mats) \
+    { \
+        affine_inlier_scores<T>(kpts1, kpts2, fm, fs, nMatch, \
+                                xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh, \
+                                num_threads, top_k, out_counts, out_weights, \
+                                out_top_idxs, out_top_inliers, out_top_errors, out_top_mats); \
+    }
+    SVER_AFFINE_INLIER_SCORES(get_affine_inlier_scores, double)
+    SVER_AFFINE_INLIER_SCORES(get_affine_inlier_scores_f32, float)
+#undef SVER_AFFINE_INLIER_SCORES
+
+#define SVER_BEST_AFFINE_INLIERS_NESTED(NAME, T) \
+    void NAME(T* kpts1, T* kpts2, size_t* fm, T* fs, size_t* levels, \
+              size_t nMatch, size_t nLevels, \
+              double xy_thresh_sqrd, double scale_thresh_sqrd, double ori_thresh, \
+              int num_threads, \
+              size_t* out_best_idxs, bool* out_inliers, \
+              T* out_errors, T* out_mats, double* out_weights) \
+    { \
+        best_affine_inliers_nested<T>(kpts1, kpts2, fm, fs, levels, nMatch, nLevels, \
+                                      xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh, \
+                                      num_threads, out_best_idxs, out_inliers, \
+                                      out_errors, out_mats, out_weights); \
+    }
+    SVER_BEST_AFFINE_INLIERS_NESTED(get_best_affine_inliers_nested, double)
+    SVER_BEST_AFFINE_INLIERS_NESTED(get_best_affine_inliers_nested_f32, float)
+#undef SVER_BEST_AFFINE_INLIERS_NESTED
 #undef printDBG_SVER
+    int sver_abi_version()
+    {
+        return SVER_ABI_VERSION;
+    }
+
     void hello_world()
     {
         puts("Hello from C++!");
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the exact brute force FLANN backend
+
+CommandLine:
+    python -m pytest tests/test_flann_bruteforce.py
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+from vtool import _pyflann_backend as backend
+from vtool import matching
+from vtool import nearest_neighbors
+
+
+def _exact_knn(dpts, qpts, K):
+    diff = qpts[:, None, :].astype(np.int64) - dpts[None, :, :].astype(np.int64)
+    dists = (diff ** 2).sum(axis=2)
+    # A stable sort breaks ties by index
+    qx2_dx = np.argsort(dists, axis=1, kind='mergesort')[:, 0:K]
+    return qx2_dx, np.take_along_axis(dists, qx2_dx, axis=1)
+
+
+@pytest.mark.parametrize('memory_budget', [None, 1, 5000])
+@pytest.mark.parametrize('K', [1, 2, 7])
+def test_bruteforce_knn_exact(memory_budget, K):
+    rng = np.random.RandomState(0)
+    # A small range of values gives many tied distances
+    dpts = rng.randint(0, 4, size=(60, 16)).astype(np.uint8)
+    qpts = rng.randint(0, 4, size=(45, 16)).astype(np.uint8)
+    qx2_dx, qx2_dist = backend.bruteforce_knn(
+        dpts, qpts, K, memory_budget=memory_budget
+    )
+    expected_dx, expected_dist = _exact_knn(dpts, qpts, K)
+    assert qx2_dx.dtype == np.int32 and qx2_dist.dtype == np.int32
+    assert np.all(qx2_dx == expected_dx)
+    assert np.all(qx2_dist == expected_dist)
+    # Float vectors use float64 distances
+    qx2_dx, qx2_dist = backend.bruteforce_knn(
+        dpts.astype(np.float32), qpts.astype(np.float32), K
+    )
+    assert qx2_dist.dtype == np.float64
+    assert np.all(qx2_dx == expected_dx)
+    assert np.allclose(qx2_dist, expected_dist)
+
+
+def test_bruteforce_knn_full_range_sift():
+    # The largest possible distances are still exact
+    dpts = np.array([[0] * 128, [255] * 128, [255] * 64 + [0] * 64], dtype=np.uint8)
+    qpts = dpts[::-1].copy()
+    qx2_dx, qx2_dist = backend.bruteforce_knn(dpts, qpts, 3)
+    assert np.all(qx2_dist == _exact_knn(dpts, qpts, 3)[1])
+    assert qx2_dist.max() == 128 * 255 ** 2
+
+
+def test_bruteforce_flann_interface():
+    rng = np.random.RandomState(0)
+    dpts = rng.randint(0, 256, size=(80, 128)).astype(np.uint8)
+    qpts = rng.randint(0, 256, size=(20, 128)).astype(np.uint8)
+    flann = backend.BruteForceFLANN()
+    flann.build_index(dpts[0:50], algorithm='kdtree', trees=8)
+    flann.add_points(dpts[50:])
+    assert flann.get_indexed_shape() == dpts.shape
+    qx2_dx, qx2_dist = flann.nn_index(qpts, num_neighbors=3, checks=20)
+    assert np.all(qx2_dx == _exact_knn(dpts, qpts, 3)[0])
+    qx2_dx, qx2_dist = flann.nn_index(qpts, 1)
+    assert qx2_dx.shape == (20,) and qx2_dist.shape == (20,)
+    with pytest.raises(ValueError):
+        flann.nn_index(qpts, 81)
+    qx2_dx2 = backend.BruteForceFLANN().nn(dpts, qpts, 1)[0]
+    assert np.all(qx2_dx2 == qx2_dx)
+    # The normalized distances used by vsone matching
+    fx2_to_fx1, fx2_to_dist = matching.normalized_nearest_neighbors(flann, qpts, 2)
+    expected_dx, expected_dist = _exact_knn(dpts, qpts, 2)
+    assert np.all(fx2_to_fx1 == expected_dx)
+    assert np.allclose(fx2_to_dist, np.sqrt(expected_dist) / matching.PSEUDO_MAX_DIST)
+
+
+def test_bruteforce_flann_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(nearest_neighbors, 'FLANN_CLS', backend.BruteForceFLANN)
+    rng = np.random.RandomState(0)
+    dpts = rng.randint(0, 256, size=(30, 128)).astype(np.uint8)
+    for _ in range(2):
+        flann = nearest_neighbors.flann_cache(
+            dpts, cache_dir=str(tmpdir), flann_params={'algorithm': 'kdtree'}
+        )
+        assert isinstance(flann, backend.BruteForceFLANN)
+        assert np.all(flann.nn_index(dpts, 1)[0] == np.arange(len(dpts)))
+
+
+def test_bruteforce_backend_env():
+    code = (
+        'from vtool._pyflann_backend import FLANN_CLS, BruteForceFLANN; '
+        'assert FLANN_CLS is BruteForceFLANN'
+    )
+    env = dict(os.environ, VTOOL_FLANN_BACKEND='bruteforce')
+    subprocess.check_call([sys.executable, '-c', code], env=env)
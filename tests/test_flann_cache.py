@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the in-process LRU and the memory mapped points of flann_cache
+
+CommandLine:
+    python -m pytest tests/test_flann_cache.py
+"""
+from __future__ import absolute_import, division, print_function
+from os.path import exists
+import numpy as np
+import pytest
+from vtool import _pyflann_backend
+from vtool import nearest_neighbors as nntool
+
+
+@pytest.fixture(autouse=True)
+def bruteforce_flann(monkeypatch):
+    monkeypatch.setattr(nntool, 'FLANN_CLS', _pyflann_backend.BruteForceFLANN)
+
+
+def _testdata_dpts(num=200, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 256, size=(num, 128)).astype(np.uint8)
+
+
+def test_flann_cache_lru_hit(tmpdir):
+    dpts = _testdata_dpts()
+    lru = nntool.FlannLRU()
+    kw = dict(cache_dir=str(tmpdir), lru=lru, verbose=0)
+    flann1 = nntool.flann_cache(dpts, **kw)
+    flann2 = nntool.flann_cache(dpts, **kw)
+    assert flann1 is flann2
+    assert lru.num_hits == 1 and lru.num_misses == 1
+    assert lru.total_bytes >= dpts.nbytes
+    # Other points are other indexes
+    flann3 = nntool.flann_cache(_testdata_dpts(seed=1), **kw)
+    assert flann3 is not flann1
+    assert len(lru) == 2
+    # A new LRU loads the index from disk
+    flann4 = nntool.flann_cache(dpts, cache_dir=str(tmpdir), lru=nntool.FlannLRU())
+    assert flann4 is not flann1
+    idxs1, dists1 = flann1.nn_index(dpts[:10], 3)
+    idxs4, dists4 = flann4.nn_index(dpts[:10], 3)
+    assert np.all(idxs1 == idxs4) and np.all(dists1 == dists4)
+
+
+def test_flann_lru_eviction(tmpdir):
+    lru = nntool.FlannLRU(max_bytes=int(_testdata_dpts().nbytes * 2.5))
+    kw = dict(cache_dir=str(tmpdir), lru=lru, verbose=0)
+    dpts_list = [_testdata_dpts(seed=seed) for seed in range(3)]
+    flanns = [nntool.flann_cache(dpts, **kw) for dpts in dpts_list]
+    # The least recently used index is evicted
+    assert len(lru) == 2
+    assert lru.total_bytes <= lru.max_bytes
+    assert nntool.flann_cache(dpts_list[2], **kw) is flanns[2]
+    assert nntool.flann_cache(dpts_list[0], **kw) is not flanns[0]
+    # Indexes larger than the budget are not kept
+    lru.max_bytes = 10
+    lru.put('big', flanns[0], 11)
+    assert lru.get('big') is None
+    lru.clear()
+    assert len(lru) == 0 and lru.total_bytes == 0
+
+
+def test_flann_cache_lru_bypass(tmpdir):
+    dpts = _testdata_dpts()
+    lru = nntool.FlannLRU()
+    flann1 = nntool.flann_cache(dpts, cache_dir=str(tmpdir), lru=lru, verbose=0)
+    flann2 = nntool.flann_cache(dpts, cache_dir=str(tmpdir), lru=None, verbose=0)
+    assert flann2 is not flann1
+    flann3 = nntool.flann_cache(
+        dpts, cache_dir=str(tmpdir), lru=lru, use_cache=False, verbose=0
+    )
+    assert flann3 is not flann1
+    assert lru.num_hits == 0
+    # The rebuilt index replaces the old one
+    assert len(lru) == 1
+    assert nntool.flann_cache(dpts, cache_dir=str(tmpdir), lru=lru) is flann3
+
+
+def test_flann_cache_mmap_dpts(tmpdir):
+    dpts = _testdata_dpts()
+    kw = dict(cache_dir=str(tmpdir), lru=None, mmap_dpts=True, verbose=0)
+    flann1 = nntool.flann_cache(dpts, **kw)
+    dpts_fpath = nntool.get_flann_dpts_fpath(flann1.flann_fpath)
+    assert exists(dpts_fpath)
+    # The index is built over a view of the mapped file
+    assert isinstance(flann1._pts.base, np.memmap)
+    assert np.all(flann1._pts == dpts)
+    # Mapped points are not counted in the size of the index
+    assert nntool._flann_nbytes(flann1, flann1._pts.base) == 0
+    flann2 = nntool.flann_cache(dpts, **kw)
+    assert isinstance(flann2._pts.base, np.memmap)
+    idxs1, dists1 = flann1.nn_index(dpts[:10], 2)
+    idxs2, dists2 = flann2.nn_index(dpts[:10], 2)
+    assert np.all(idxs1 == idxs2) and np.all(dists1 == dists2)
+    assert np.all(idxs1[:, 0] == np.arange(10))
+
+
+def test_flann_augment_does_not_modify_lru(tmpdir, monkeypatch):
+    dpts = _testdata_dpts()
+    new_dpts = _testdata_dpts(num=20, seed=1)
+    lru = nntool.FlannLRU()
+    monkeypatch.setattr(nntool, 'FLANN_LRU', lru)
+    flann = nntool.flann_cache(dpts, cache_dir=str(tmpdir), verbose=0)
+    assert len(lru) == 1
+    aug = nntool.flann_augment(
+        dpts, new_dpts, str(tmpdir), '', '_aug', {}, save=False
+    )
+    assert aug is not flann
+    assert flann.get_indexed_shape() == dpts.shape
+    assert aug.get_indexed_shape()[0] == len(dpts) + len(new_dpts)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the exact brute force nearest neighbor backend of vtool.matching
+
+CommandLine:
+    python -m pytest tests/test_matching_bruteforce.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+import utool as ut
+from vtool import matching
+
+
+def _exact_neighbors(vecs1, vecs2, K):
+    diff = vecs2[:, None, :].astype(np.float64) - vecs1[None, :, :]
+    dist_sqrd = (diff ** 2).sum(axis=2)
+    # A stable sort breaks ties by index
+    fx2_to_fx1 = np.argsort(dist_sqrd, axis=1, kind='mergesort')[:, 0:K]
+    fx1_to_fx2 = np.argsort(dist_sqrd.T, axis=1, kind='mergesort')[:, 0:K]
+    fx2_to_dist = np.take_along_axis(dist_sqrd, fx2_to_fx1, axis=1)
+    fx1_to_dist = np.take_along_axis(dist_sqrd.T, fx1_to_fx2, axis=1)
+    return fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.float32])
+@pytest.mark.parametrize('K, blocksize', [(1, None), (2, 3), (3, 1), (5, 50)])
+def test_bruteforce_matches_exact(dtype, K, blocksize):
+    rng = np.random.RandomState(0)
+    # A small range of values gives many tied distances
+    vecs1 = rng.randint(0, 3, size=(40, 16)).astype(dtype)
+    vecs2 = rng.randint(0, 3, size=(30, 16)).astype(dtype)
+    tup = matching.bruteforce_nearest_neighbors(
+        vecs1, vecs2, K, blocksize=blocksize, normalize=False
+    )
+    expected = _exact_neighbors(vecs1, vecs2, K)
+    for got, want in zip(tup, expected):
+        assert got.shape == want.shape
+        assert np.all(got == want)
+    assert tup[0].dtype == np.int32 and tup[2].dtype == np.int32
+    fx2_to_fx1, fx2_to_dist = matching.bruteforce_nearest_neighbors(
+        vecs1, vecs2, K, symmetric=False, blocksize=blocksize
+    )[0:2]
+    assert np.all(fx2_to_fx1 == expected[0])
+    assert np.allclose(fx2_to_dist, np.sqrt(expected[1]) / matching.PSEUDO_MAX_DIST)
+    with pytest.raises(matching.MatchingError):
+        matching.bruteforce_nearest_neighbors(vecs1, vecs2, 31)
+
+
+def test_resolve_nn_backend():
+    num = int(np.sqrt(matching.NN_BRUTEFORCE_MAX_PAIRS))
+    assert matching._resolve_nn_backend('auto', num, num) == 'bruteforce'
+    assert matching._resolve_nn_backend('auto', num + 1, num + 1) == 'flann'
+    assert matching._resolve_nn_backend('flann', 10, 10) == 'flann'
+    assert matching._resolve_nn_backend('bruteforce', 10 ** 5, 10 ** 5) == 'bruteforce'
+    with pytest.raises(ValueError):
+        matching._resolve_nn_backend('kdtree', 10, 10)
+
+
+@pytest.mark.parametrize('symmetric', [True, False])
+def test_assign_bruteforce_needs_no_flann(symmetric):
+    rng = np.random.RandomState(0)
+    base_vecs = rng.randint(0, 256, size=(50, 128))
+    annots = []
+    for aid in [1, 2]:
+        noise = rng.randint(-20, 21, size=base_vecs.shape)
+        vecs = np.clip(base_vecs + noise, 0, 255).astype(np.uint8)
+        kpts = np.tile([[0, 0, 1, 0, 1, 0]], (len(vecs), 1)).astype(np.float64)
+        annots.append(ut.LazyDict({'aid': aid, 'kpts': kpts, 'vecs': vecs}))
+    cfgdict = {'symmetric': symmetric, 'K': 2, 'nn_backend': 'bruteforce'}
+    match = matching.PairwiseMatch(annots[0], annots[1]).assign(cfgdict)
+    # The lazy FLANN indexes are never built
+    assert 'flann' not in annots[0].stored_keys()
+    assert 'flann' not in annots[1].stored_keys()
+    tup = _exact_neighbors(annots[0]['vecs'], annots[1]['vecs'], 3)
+    fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist = [
+        x if x.dtype.kind == 'i' else np.sqrt(x) / matching.PSEUDO_MAX_DIST
+        for x in tup
+    ]
+    if symmetric:
+        fm = matching.assign_symmetric_matches(
+            fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist, 2, 1
+        )[0]
+    else:
+        fm = matching.assign_unconstrained_matches(fx2_to_fx1, fx2_to_dist, 2, 1)[0]
+    assert np.all(match.fm == fm)
+    # Each feature matches its counterpart in the other view
+    assert set(range(len(base_vecs))) <= {fx1 for fx1, fx2 in match.fm if fx1 == fx2}
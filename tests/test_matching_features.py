@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parity tests between PairwiseMatchSet.make_feature_matrix and building the
+feature vector of each PairwiseMatch
+
+CommandLine:
+    python -m pytest tests/test_matching_features.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pandas as pd
+import pytest
+from vtool import _rhomb_dist
+from vtool.matching import AnnotPairFeatInfo, PairwiseMatch, PairwiseMatchSet
+
+LOCAL_KEYS = ['match_dist', 'norm_dist', 'ratio', 'ratio_score']
+
+
+def _testdata_matches(num_pairs=30, seed=0):
+    rng = np.random.RandomState(seed)
+    view_pairs = sorted(_rhomb_dist.VIEW_INT_DIST.keys())
+    matches = []
+    for aid2 in range(2, num_pairs + 2):
+        num = rng.randint(0, 12)
+        match = PairwiseMatch({'aid': 1}, {'aid': aid2})
+        match.fm = rng.randint(0, 50, size=(num, 2))
+        match.fs = rng.rand(num)
+        for key in LOCAL_KEYS:
+            match.local_measures[key] = rng.rand(num) + 0.1
+        time1 = rng.rand() * 1000
+        # Some pairs have the same time and place
+        time2 = time1 if aid2 % 5 == 0 else rng.rand() * 1000
+        gps1 = rng.rand(2) * 10
+        gps2 = gps1 if aid2 % 5 == 0 else rng.rand(2) * 10
+        match.global_measures['time'] = (time1, time2)
+        match.global_measures['gps'] = (gps1, gps2)
+        match.global_measures['view'] = view_pairs[rng.randint(len(view_pairs))]
+        qual2 = None if aid2 % 7 == 0 else rng.randint(1, 5)
+        match.global_measures['qual'] = (rng.randint(1, 5), qual2)
+        matches.append(match)
+    return matches
+
+
+@pytest.mark.parametrize(
+    'kw',
+    [
+        dict(),
+        dict(summary_ops='all', indices=slice(1, 4)),
+        dict(bin_key='ratio', bins=[0.5, 0.7, 0.9], sorters=['ratio', 'norm_dist']),
+    ],
+)
+def test_feature_matrix_matches_vectors(kw):
+    matches = _testdata_matches()
+    feats = [match.make_feature_vector(**kw) for match in matches]
+    # Ranks past the number of matches of a pair are left out of its vector,
+    # so they are nan in the training layout
+    X = pd.DataFrame(feats)
+    featinfo = AnnotPairFeatInfo(X)
+    mset = PairwiseMatchSet.from_matches(matches)
+    X2 = mset.make_feature_matrix(featinfo)
+    assert X2.shape == X.shape
+    for px, feat in enumerate(feats):
+        idxs = [X.columns.get_loc(key) for key in feat.keys()]
+        vals = np.array(list(feat.values()), dtype=float)
+        assert np.allclose(X2[px, idxs], vals, equal_nan=True)
+        others = np.setdiff1d(np.arange(X.shape[1]), idxs)
+        assert np.all(np.isnan(X2[px, others]))
+
+
+def test_feature_matrix_out_and_frame():
+    matches = _testdata_matches()
+    X = pd.DataFrame([match.make_feature_vector() for match in matches])
+    mset = PairwiseMatchSet.from_matches(matches)
+    # Columns can be given in any order
+    columns = list(X.columns)[::-1]
+    out = np.zeros((len(matches), len(columns)), dtype=np.float32)
+    result = mset.make_feature_matrix(columns, out=out)
+    assert result is out
+    X3 = mset.make_feature_matrix(columns, as_frame=True)
+    assert list(X3.columns) == columns
+    assert np.allclose(X3.values, X[columns].values, equal_nan=True)
+    assert np.allclose(out, X[columns].values, equal_nan=True, rtol=1e-6)
+    with pytest.raises(ValueError):
+        mset.make_feature_matrix(columns, out=out[1:])
+    with pytest.raises(ValueError):
+        mset.make_feature_matrix(columns + ['notafeature'])
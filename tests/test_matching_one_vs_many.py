@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for one-vs-many matching with vtool.matching.OneVsManyIndex
+
+CommandLine:
+    python -m pytest tests/test_matching_one_vs_many.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+import utool as ut
+import vtool.demodata as demodata
+from vtool import matching, nearest_neighbors
+from vtool._pyflann_backend import BruteForceFLANN
+
+
+def _testdata_annots(num_annots=4, num=8):
+    """ Perturbed views of one grid, so features with the same index match """
+    rng = np.random.RandomState(0)
+    base_vecs = rng.randint(0, 256, size=(num * num, 128))
+    annots = []
+    for aid in range(1, num_annots + 1):
+        kpts = demodata.perterbed_grid_kpts(
+            seed=aid, wh_stride=(10, 10), wh_num=(num, num), dtype=np.float64
+        )
+        noise = rng.randint(-20, 21, size=base_vecs.shape)
+        vecs = np.clip(base_vecs + noise, 0, 255).astype(np.uint8)
+        annots.append(ut.LazyDict({'aid': aid, 'kpts': kpts, 'vecs': vecs}))
+    return annots
+
+
+@pytest.mark.parametrize('K, Knorm', [(1, 1), (2, 1), (3, 2)])
+def test_split_neighbors(K, Knorm):
+    annots = _testdata_annots()
+    query, db_annots = annots[0], annots[1:]
+    index = matching.OneVsManyIndex(db_annots)
+    # Exact neighbors of the query features in the stacked vectors
+    qvecs = query['vecs'].astype(np.float64)
+    dvecs = index.idx2_vec.astype(np.float64)
+    dists = ((qvecs[:, None, :] - dvecs[None, :, :]) ** 2).sum(axis=2)
+    qfx_to_idx = np.argsort(dists, axis=1, kind='mergesort')[:, 0 : K + Knorm]
+    qfx_to_idx = qfx_to_idx.astype(np.int32)
+    qfx_to_dist = np.sqrt(np.take_along_axis(dists, qfx_to_idx, axis=1))
+    assign_list = index._split_neighbors(qfx_to_idx, qfx_to_dist, K, Knorm)
+    assert len(assign_list) == len(db_annots)
+    assert sum(len(tup[0]) for tup in assign_list) == len(qvecs) * K
+    for ax, (fm, match_dist, norm_dist, fx1_norm, fx2_norm) in enumerate(
+        assign_list
+    ):
+        assert fm.dtype == np.int32 and fx2_norm is None
+        expected = [
+            (index.idx2_fx[idx], qfx, qfx_to_dist[qfx, rank])
+            for qfx in range(len(qvecs))
+            for rank, idx in enumerate(qfx_to_idx[qfx, 0:K])
+            if index.idx2_ax[idx] == ax
+        ]
+        assert fm.tolist() == [[fx1, qfx] for fx1, qfx, _ in expected]
+        assert np.all(match_dist == [dist for _, _, dist in expected])
+        norm_idx = qfx_to_idx[fm.T[1], K + Knorm - 1]
+        assert np.all(fx1_norm == index.idx2_fx[norm_idx])
+        assert np.all(norm_dist == qfx_to_dist[fm.T[1], K + Knorm - 1])
+
+
+def test_one_vs_many_empty():
+    annots = _testdata_annots(2)
+    assert matching.OneVsManyIndex([]).assign(annots[0]) == []
+    # Too few database features to find a match and a normalizer
+    tiny = {'aid': 3, 'kpts': annots[1]['kpts'][0:1], 'vecs': annots[1]['vecs'][0:1]}
+    empty = {'aid': 4, 'kpts': np.empty((0, 6)), 'vecs': np.empty((0, 128), np.uint8)}
+    index = matching.OneVsManyIndex([tiny, empty])
+    matches = index.assign(annots[0])
+    assert [len(match) for match in matches] == [0, 0]
+
+
+@pytest.mark.parametrize('K, Knorm', [(1, 1), (2, 2)])
+def test_one_vs_many_matches_assign(K, Knorm, monkeypatch):
+    # Exact searches on both sides, so the test does not need pyflann
+    monkeypatch.setattr(nearest_neighbors, 'FLANN_CLS', BruteForceFLANN)
+    monkeypatch.setattr(nearest_neighbors, 'FLANN_LRU', nearest_neighbors.FlannLRU())
+    cfgdict = {'K': K, 'Knorm': Knorm, 'symmetric': False, 'nn_backend': 'bruteforce'}
+    annots = _testdata_annots(2)
+    # A single database annotation gives the same result as assign
+    (match,) = matching.OneVsManyIndex(annots[1:]).assign(annots[0], cfgdict)
+    expected = matching.PairwiseMatch(annots[1], annots[0]).assign(cfgdict)
+    assert np.all(match.fm == expected.fm)
+    assert np.all(match.fm_norm1 == expected.fm_norm1)
+    for key, val in expected.local_measures.items():
+        assert np.allclose(match.local_measures[key], val)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for vtool.matching.apply_all_parallel
+
+CommandLine:
+    python -m pytest tests/test_matching_parallel.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+import ubelt as ub
+import utool as ut
+import vtool.demodata as demodata
+import vtool.keypoint as ktool
+from vtool import matching
+
+
+def _testdata_annots(num_annots=4):
+    """ Perturbed views of one grid, so features with the same index match """
+    rng = np.random.RandomState(0)
+    base_vecs = rng.randint(0, 256, size=(15 * 15, 128))
+    annots = []
+    for aid in range(1, num_annots + 1):
+        kpts = demodata.perterbed_grid_kpts(
+            seed=aid, wh_stride=(10, 10), wh_num=(15, 15), dtype=np.float64
+        )
+        noise = rng.randint(-20, 21, size=base_vecs.shape)
+        vecs = np.clip(base_vecs + noise, 0, 255).astype(np.uint8)
+        dlen_sqrd = ktool.get_kpts_dlen_sqrd(kpts)
+        annots.append(
+            ut.LazyDict({'aid': aid, 'kpts': kpts, 'vecs': vecs, 'dlen_sqrd': dlen_sqrd})
+        )
+    return annots
+
+
+def test_apply_all_chunks_group_annots():
+    annots = _testdata_annots(4)
+    pairs = [(0, 1), (2, 3), (0, 2), (1, 0), (0, 3), (2, 1)]
+    matches = [matching.PairwiseMatch(annots[x1], annots[x2]) for x1, x2 in pairs]
+    chunks = matching._apply_all_chunks(matches, chunksize=3)
+    assert sorted(ub.flatten(c[0] for c in chunks)) == list(range(len(pairs)))
+    assert all(len(c[0]) <= 3 for c in chunks)
+    # The three pairs with annot1 = aid 1 are in one chunk
+    assert sorted(chunks[0][0]) == [0, 2, 4]
+    for match_idxs, annot_keys, pair_list in chunks:
+        assert len(set(annot_keys)) == len(annot_keys)
+        for x, (ax1, ax2) in zip(match_idxs, pair_list):
+            assert annot_keys[ax1] == matches[x].annot1['aid']
+            assert annot_keys[ax2] == matches[x].annot2['aid']
+
+
+def test_apply_all_annot_data():
+    kpts = demodata.get_dummy_kpts()
+    keys = ['dlen_sqrd', 'kpts', 'vecs']
+    annot = ut.LazyDict({'aid': 1, 'rchip_fpath': 'chip.png'})
+    # Lazy values from other modules are computed before they are sent
+    annot.set_lazy_func('dlen_sqrd', lambda: ktool.get_kpts_dlen_sqrd(kpts))
+    # Lazy values set up by vtool are rebuilt in the worker
+    matching.ensure_metadata_feats(annot)
+    data = matching._apply_all_annot_data(annot, keys)
+    assert sorted(data.keys()) == ['aid', 'dlen_sqrd', 'rchip_fpath']
+    assert 'kpts' not in annot.stored_keys()
+    # Nothing else is sent once every value is available
+    annot = ut.LazyDict({'kpts': kpts, 'vecs': kpts, 'rchip_fpath': 'chip.png'})
+    data = matching._apply_all_annot_data(annot, ['kpts', 'vecs'])
+    assert sorted(data.keys()) == ['kpts', 'vecs']
+
+
+@pytest.mark.parametrize('nprocs', [1, 2])
+def test_apply_all_parallel_matches_serial(nprocs):
+    # The exact backend does not need pyflann, so the process pool is always
+    # tested
+    cfgdict = {'ratio_thresh': 0.9, 'symmetric': True, 'nn_backend': 'bruteforce'}
+    annots = _testdata_annots(4)
+    pairs = [(0, 1), (1, 0), (2, 3), (0, 2), (0, 3)]
+    matches = [matching.PairwiseMatch(annots[x1], annots[x2]) for x1, x2 in pairs]
+    matching.apply_all_parallel(matches, cfgdict, nprocs=nprocs, chunksize=2)
+    for (x1, x2), match in zip(pairs, matches):
+        expected = matching.PairwiseMatch(annots[x1], annots[x2])
+        expected.apply_all(cfgdict)
+        assert np.all(match.fm == expected.fm)
+        assert np.allclose(match.fs, expected.fs)
+        assert np.allclose(match.H_12, expected.H_12)
+        assert list(match.local_measures.keys()) == list(
+            expected.local_measures.keys()
+        )
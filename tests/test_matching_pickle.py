@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the compact pickle state of PairwiseMatch
+
+CommandLine:
+    python -m pytest tests/test_matching_pickle.py
+"""
+from __future__ import absolute_import, division, print_function
+import pickle
+import numpy as np
+import pytest
+import utool as ut
+from vtool.matching import PairwiseMatch
+
+
+def _testdata_match(num=500):
+    rng = np.random.RandomState(0)
+    annot1 = ut.LazyDict({'aid': 1, 'kpts': rng.rand(num, 6)})
+    annot2 = ut.LazyDict({'aid': 2, 'kpts': rng.rand(num, 6)})
+    match = PairwiseMatch(annot1, annot2)
+    match.fm = rng.randint(0, num, size=(num, 2)).astype(np.int64)
+    match.fs = rng.rand(num)
+    match.H_12 = rng.rand(3, 3)
+    match.global_measures['yaw'] = (0.5, 1.5)
+    for key in ['match_dist', 'norm_dist', 'ratio', 'sver_err_xy']:
+        match.local_measures[key] = rng.rand(num)
+    match.local_measures['norm_fx1'] = rng.randint(0, num, size=num)
+    return match
+
+
+def _assert_same_fields(match1, match2, rtol=0, atol=0):
+    assert match1.annot1 == match2.annot1
+    assert match1.annot2 == match2.annot2
+    assert match1.fm.dtype == match2.fm.dtype
+    assert np.all(match1.fm == match2.fm)
+    assert match1.fs.dtype == match2.fs.dtype
+    assert np.allclose(match1.fs, match2.fs, rtol=rtol, atol=atol)
+    assert np.all(match1.H_12 == match2.H_12)
+    assert match1.H_21 is None and match2.H_21 is None
+    assert match1.global_measures == match2.global_measures
+    assert list(match1.local_measures.keys()) == list(match2.local_measures.keys())
+    for key, val1 in match1.local_measures.items():
+        val2 = match2.local_measures[key]
+        assert val1.dtype == val2.dtype
+        assert np.allclose(val1, val2, rtol=rtol, atol=atol)
+
+
+def test_compact_pickle_roundtrip():
+    match = _testdata_match()
+    full = pickle.loads(pickle.dumps(match, protocol=2))
+    match.compact_pickle = True
+    data = pickle.dumps(match, protocol=2)
+    compact = pickle.loads(data)
+    # The same fields as the default state, up to float32 precision
+    _assert_same_fields(full, compact, rtol=1e-6, atol=1e-7)
+    norm_fx1 = full.local_measures['norm_fx1']
+    assert np.all(compact.local_measures['norm_fx1'] == norm_fx1)
+    assert len(data) < len(pickle.dumps(full, protocol=2)) * 0.6
+    # A loaded compact match stays compact
+    assert compact.compact_pickle
+    again = pickle.loads(pickle.dumps(compact, protocol=2))
+    _assert_same_fields(compact, again)
+
+
+def test_compact_state_full_precision():
+    match = _testdata_match()
+    full = pickle.loads(pickle.dumps(match, protocol=2))
+    match2 = PairwiseMatch.__new__(PairwiseMatch)
+    match2.__setstate__(match.compact_state(measure_dtype=None))
+    _assert_same_fields(full, match2)
+
+
+def test_compact_state_empty():
+    match = PairwiseMatch({'aid': 1}, {})
+    match.compact_pickle = True
+    match2 = pickle.loads(pickle.dumps(match, protocol=2))
+    assert match2.fm is None and match2.fs is None
+    assert match2.annot2 == {}
+    assert len(match2.local_measures) == 0
+    match.fm = np.empty((0, 2), dtype=np.int64)
+    match.fs = np.empty(0)
+    match.local_measures['ratio'] = np.empty(0)
+    match2 = pickle.loads(pickle.dumps(match, protocol=2))
+    assert match2.fm.shape == (0, 2) and match2.fm.dtype == np.int64
+    assert match2.local_measures['ratio'].dtype == np.float64
+
+
+@pytest.mark.skipif(pickle.HIGHEST_PROTOCOL < 5, reason='needs pickle protocol 5')
+def test_compact_pickle_out_of_band():
+    match = _testdata_match()
+    match.compact_pickle = True
+    buffers = []
+    data = pickle.dumps(match, protocol=5, buffer_callback=buffers.append)
+    # The arrays are sent out of band instead of being copied into data
+    assert len(buffers) <= 8
+    assert len(data) < 2000
+    match2 = pickle.loads(data, buffers=buffers)
+    # Out of band buffers round trip exactly
+    _assert_same_fields(pickle.loads(pickle.dumps(match, protocol=5)), match2)
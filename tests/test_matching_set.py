@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parity tests between PairwiseMatchSet and looping over PairwiseMatch objects
+
+CommandLine:
+    python -m pytest tests/test_matching_set.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+from vtool.matching import PairwiseMatch, PairwiseMatchSet
+
+LOCAL_KEYS = ['match_dist', 'norm_dist', 'ratio', 'ratio_score']
+
+
+def _testdata_matches(counts=(7, 0, 1, 12, 3, 2), seed=0):
+    rng = np.random.RandomState(seed)
+    matches = []
+    for aid2, num in enumerate(counts, start=2):
+        match = PairwiseMatch({'aid': 1}, {'aid': aid2})
+        match.fm = rng.randint(0, 50, size=(num, 2))
+        match.fs = rng.rand(num)
+        match.H_12 = rng.rand(3, 3)
+        match.global_measures['time'] = (rng.rand() * 100, rng.rand() * 100)
+        for key in LOCAL_KEYS:
+            match.local_measures[key] = rng.rand(num) + 0.1
+        matches.append(match)
+    return matches
+
+
+def _assert_same_matches(matches1, matches2):
+    assert len(matches1) == len(matches2)
+    for match1, match2 in zip(matches1, matches2):
+        assert match1.annot2 == match2.annot2
+        assert np.all(match1.fm == match2.fm)
+        assert np.all(match1.fs == match2.fs)
+        assert match1.H_12 is match2.H_12
+        assert list(match1.local_measures) == list(match2.local_measures)
+        for key, val in match1.local_measures.items():
+            assert np.all(val == match2.local_measures[key])
+
+
+def test_match_set_roundtrip():
+    matches = _testdata_matches()
+    mset = PairwiseMatchSet.from_matches(matches)
+    assert len(mset) == len(matches)
+    assert mset.num_matches == sum(map(len, matches))
+    assert np.all(mset.counts == list(map(len, matches)))
+    _assert_same_matches(matches, mset.to_matches())
+
+
+def test_match_set_row_ops():
+    matches = _testdata_matches()
+    mset = PairwiseMatchSet.from_matches(matches)
+    cfgdict = {'ratio_thresh': 0.6}
+    expected = [match.apply_ratio_test(cfgdict) for match in matches]
+    _assert_same_matches(expected, mset.apply_ratio_test(cfgdict).to_matches())
+    # take regroups rows by pair and keeps their order within a pair
+    rng = np.random.RandomState(1)
+    rowxs = rng.permutation(mset.num_matches)[: mset.num_matches // 2]
+    taken = mset.take(rowxs)
+    for px, match in enumerate(taken.to_matches()):
+        own = rowxs[mset.pair_ids[rowxs] == px] - mset.offsets[px]
+        _assert_same_matches([matches[px].take(own)], [match])
+    pxs = [3, 0, 3, 1]
+    _assert_same_matches(
+        [matches[px] for px in pxs], mset.take_pairs(pxs).to_matches()
+    )
+
+
+@pytest.mark.parametrize(
+    'kw',
+    [
+        dict(summary_ops='all'),
+        dict(summary_ops='all', bin_key='ratio', bins=[0.4, 0.7, 0.9]),
+        dict(indices=[0, 1, -1], sorters=['ratio', 'match_dist']),
+        dict(indices=slice(1, 4)),
+    ],
+)
+def test_match_set_feature_vector(kw):
+    matches = _testdata_matches()
+    mset = PairwiseMatchSet.from_matches(matches)
+    feats = mset.make_feature_vector(**kw)
+    for px, match in enumerate(matches):
+        indices = kw.get('indices')
+        if isinstance(indices, list) and len(match) <= max(indices):
+            # Explicit ranks raise for a match without enough matches
+            continue
+        feat = match.make_feature_vector(**kw)
+        row = feats.loc[px]
+        # Columns a pair does not have are nan
+        assert set(feat.keys()) <= set(row.index)
+        assert row.drop(list(feat.keys())).isnull().all()
+        assert np.allclose(
+            row[list(feat.keys())].values.astype(float),
+            np.array(list(feat.values()), dtype=float),
+            equal_nan=True,
+        )
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the reciprocal neighbor flags of symmetric vsone matching
+
+CommandLine:
+    python -m pytest tests/test_matching_symmetric.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+from vtool import matching
+
+
+def _testdata_neighbors(num1, num2, num_neighbors, rng):
+    """ Distinct random neighbors with sorted distances in both directions """
+    fx2_to_fx1 = np.array(
+        [rng.choice(num1, num_neighbors, replace=False) for _ in range(num2)],
+        dtype=np.int32,
+    )
+    fx1_to_fx2 = np.array(
+        [rng.choice(num2, num_neighbors, replace=False) for _ in range(num1)],
+        dtype=np.int32,
+    )
+    fx2_to_dist = np.sort(rng.rand(num2, num_neighbors), axis=1)
+    fx1_to_dist = np.sort(rng.rand(num1, num_neighbors), axis=1)
+    return fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist
+
+
+@pytest.mark.parametrize('K', [1, 2, 5, 33])
+def test_flag_symmetric_join_matches_lookup(K):
+    rng = np.random.RandomState(K)
+    fx2_to_fx1, _, fx1_to_fx2, _ = _testdata_neighbors(40, 50, K + 1, rng)
+    expected = matching.flag_sym_slow(fx2_to_fx1, fx1_to_fx2, K)
+    for func in [
+        matching._flag_symmetric_lookup,
+        matching._flag_symmetric_join,
+        matching.flag_symmetric_matches,
+    ]:
+        assert np.all(func(fx2_to_fx1, fx1_to_fx2, K) == expected)
+    # Empty inputs
+    empty = np.empty((0, K + 1), dtype=np.int32)
+    assert matching._flag_symmetric_join(empty, fx1_to_fx2, K).shape == (0, K)
+    assert matching._flag_symmetric_join(fx2_to_fx1, empty, K).sum() == 0
+
+
+@pytest.mark.parametrize('K, Knorm', [(1, 1), (3, 2)])
+def test_assign_symmetric_reverse_normalizers(K, Knorm):
+    rng = np.random.RandomState(0)
+    tup = _testdata_neighbors(30, 25, K + Knorm, rng)
+    fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist = tup
+    assigntup = matching.assign_symmetric_matches(
+        fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist, K, Knorm
+    )
+    fm, match_dist, norm_fx1, norm_dist1, norm_fx2, norm_dist2 = assigntup
+    # The matches are the reciprocal pairs of both directions
+    fx1_to_flags = matching.flag_sym_slow(fx1_to_fx2, fx2_to_fx1, K)
+    fx1, rank = np.nonzero(fx1_to_flags)
+    reverse_fm = np.vstack([fx1, fx1_to_fx2[fx1, rank]]).T
+    sortx = np.lexsort(reverse_fm.T)
+    assert np.all(fm == reverse_fm[sortx])
+    norm_rank = K + Knorm - 1
+    assert np.all(norm_fx2 == fx1_to_fx2[fx1[sortx], norm_rank])
+    assert np.all(norm_dist2 == fx1_to_dist[fx1[sortx], norm_rank])
+    assert np.all(norm_fx1 == fx2_to_fx1[fm.T[1], norm_rank])
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the on disk spatial verification result cache.
+
+CommandLine:
+    python -m pytest tests/test_sver_cache.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+import vtool.demodata as demodata
+import vtool.spatial_verification as sver
+
+
+def _testdata_pair():
+    kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+    fm = demodata.make_dummy_fm(len(kpts1))
+    fs = np.random.RandomState(0).rand(len(fm))
+    return kpts1, kpts2, fm, fs
+
+
+def _assert_svtup_equal(svtup1, svtup2, errors_dtype=None):
+    """ errors_dtype is the dtype the errors of svtup2 are stored in """
+    assert (svtup1 is None) == (svtup2 is None)
+    if svtup1 is None:
+        return
+    assert len(svtup1) == len(svtup2)
+    for item1, item2 in zip(svtup1, svtup2):
+        is_errors = isinstance(item1, tuple)
+        items1 = item1 if is_errors else (item1,)
+        items2 = item2 if isinstance(item2, tuple) else (item2,)
+        for arr1, arr2 in zip(items1, items2):
+            assert (arr1 is None) == (arr2 is None)
+            if arr1 is None:
+                continue
+            if is_errors and errors_dtype is not None:
+                arr1 = arr1.astype(errors_dtype)
+            assert arr1.dtype == arr2.dtype
+            assert np.all(arr1 == arr2)
+
+
+@pytest.mark.parametrize('refine_method', ['homog', 'homog-iter', 'affine'])
+@pytest.mark.parametrize('full_homog_checks', [True, False])
+def test_sver_cache_roundtrip(tmpdir, refine_method, full_homog_checks):
+    kpts1, kpts2, fm, fs = _testdata_pair()
+    sver_cache = sver.SverCache(cache_dir=str(tmpdir))
+    for returnAff in [True, False]:
+        kw = dict(
+            match_weights=fs,
+            refine_method=refine_method,
+            full_homog_checks=full_homog_checks,
+            returnAff=returnAff,
+            deterministic=True,
+        )
+        expected = sver.spatially_verify_kpts(kpts1, kpts2, fm, **kw)
+        for _ in range(2):
+            svtup = sver.spatially_verify_kpts_cached(
+                kpts1, kpts2, fm, sver_cache, **kw
+            )
+            # The cache stores the errors in float32
+            _assert_svtup_equal(expected, svtup, errors_dtype=np.float32)
+    # returnAff does not change the key
+    assert (sver_cache.num_misses, sver_cache.num_hits) == (1, 3)
+
+
+def test_sver_cache_warm_rerun(tmpdir, monkeypatch):
+    kpts1, kpts2, fm, fs = _testdata_pair()
+    pairs = [(fm_, fs[0 : len(fm_)]) for fm_ in [fm, fm[::2], fm[0:3], fm[fs > 0.5]]]
+    cold = [
+        sver.spatially_verify_kpts_cached(
+            kpts1, kpts2, fm_, sver.SverCache(str(tmpdir)), match_weights=fs_
+        )
+        for fm_, fs_ in pairs
+    ]
+    assert cold[2] is None, 'failed verifications are cached too'
+
+    def _no_verify(*args, **kwargs):
+        raise AssertionError('a warm rerun should not verify anything')
+
+    monkeypatch.setattr(sver, 'get_best_affine_inliers_', _no_verify)
+    monkeypatch.setattr(sver, 'refine_inliers', _no_verify)
+    # A new cache object on the same directory, as in a rerun of a job
+    sver_cache = sver.SverCache(str(tmpdir))
+    warm = [
+        sver.spatially_verify_kpts_cached(
+            kpts1, kpts2, fm_, sver_cache, match_weights=fs_
+        )
+        for fm_, fs_ in pairs
+    ]
+    assert sver_cache.num_hits == len(pairs)
+    for svtup1, svtup2 in zip(cold, warm):
+        _assert_svtup_equal(svtup1, svtup2)
+    # Changing the config misses
+    with pytest.raises(AssertionError):
+        sver.spatially_verify_kpts_cached(
+            kpts1, kpts2, fm, sver_cache, match_weights=fs, xy_thresh=0.02
+        )
+
+
+def test_sver_cache_unknown_arg(tmpdir):
+    kpts1, kpts2, fm, fs = _testdata_pair()
+    sver_cache = sver.SverCache(str(tmpdir))
+    with pytest.raises(TypeError):
+        sver.spatially_verify_kpts_cached(
+            kpts1, kpts2, fm, sver_cache, match_weights=fs, xy_thres=0.02
+        )
+
+
+def test_sver_cache_lru_eviction(tmpdir):
+    kpts1, kpts2, fm, fs = _testdata_pair()
+    sver_cache = sver.SverCache(str(tmpdir))
+    kw_list = [
+        dict(match_weights=fs, xy_thresh=xy_thresh)
+        for xy_thresh in [0.01, 0.02, 0.03, 0.04]
+    ]
+    for kw in kw_list[0:3]:
+        sver.spatially_verify_kpts_cached(kpts1, kpts2, fm, sver_cache, **kw)
+    entry_bytes = max(sver_cache._get_lru().values())
+    sver_cache.max_bytes = 3 * entry_bytes
+    # Use the first result so the second is the least recently used
+    sver.spatially_verify_kpts_cached(kpts1, kpts2, fm, sver_cache, **kw_list[0])
+    sver.spatially_verify_kpts_cached(kpts1, kpts2, fm, sver_cache, **kw_list[3])
+    assert len(sver_cache) == 3
+    assert sver_cache._total_bytes <= sver_cache.max_bytes
+    cfgstrs = [sver_cache.get_cfgstr(kpts1, kpts2, fm, kw) for kw in kw_list]
+    hits = [sver.SverCache(str(tmpdir)).load(cfgstr)[0] for cfgstr in cfgstrs]
+    assert hits == [True, False, True, True]
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for deterministic=True spatial verification, which must give bit for
+bit identical results for any number of threads and on every run.
+
+CommandLine:
+    python -m pytest tests/test_sver_deterministic.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+import vtool.demodata as demodata
+import vtool.keypoint as ktool
+import vtool.spatial_verification as sver
+from testdata_nondeterm_sver import testdata_nondeterm_sver
+
+NUM_THREADS_LIST = [1, 2, 4, 8]
+
+
+def _testdata_tied_pair():
+    """ Uniform weights on a grid, so many hypotheses tie for the best weight """
+    kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+    kpts1, kpts2 = kpts1.astype(np.float64), kpts2.astype(np.float64)
+    fm = demodata.make_dummy_fm(len(kpts1))
+    fs = np.ones(len(fm))
+    xy_thresh_sqrd = ktool.get_kpts_dlen_sqrd(kpts2) * 0.01
+    return kpts1, kpts2, fm, fs, xy_thresh_sqrd
+
+
+def _svtup_bytes(svtup):
+    """ Exact binary representation of a spatial verification result """
+    arrs = []
+    for item in svtup:
+        arrs.extend(item if isinstance(item, tuple) else [item])
+    return b''.join(np.ascontiguousarray(arr).tobytes() for arr in arrs)
+
+
+def test_deterministic_cpp_thread_invariant():
+    import vtool.sver_c_wrapper as sver_c_wrapper
+
+    if not sver_c_wrapper.is_available():
+        pytest.skip('libsver is not built')
+
+    kpts1, kpts2, fm, fs, xy_thresh_sqrd = _testdata_tied_pair()
+    args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, sver.TAU / 4)
+    scores = sver_c_wrapper.get_affine_inlier_scores_cpp(*args)
+    weights = scores[1]
+    assert np.sum(weights == weights.max()) > 1, 'test data needs ties'
+    outs = [
+        sver_c_wrapper.get_best_affine_inliers_cpp(
+            *args, num_threads=num_threads, deterministic=True
+        )
+        for num_threads in NUM_THREADS_LIST * 3
+    ]
+    expected = _svtup_bytes(outs[0])
+    assert all(_svtup_bytes(out) == expected for out in outs)
+    # Ties go to the smallest index, like the compact search and argmax
+    Aff_mats = sver._affine_hypothesis_data(kpts1, kpts2, fm)[0]
+    assert np.allclose(outs[0][2], Aff_mats[weights.argmax()])
+
+
+def test_default_cpp_ties_to_smallest_index():
+    import vtool.sver_c_wrapper as sver_c_wrapper
+
+    if not sver_c_wrapper.is_available():
+        pytest.skip('libsver is not built')
+
+    kpts1, kpts2, fm, fs, xy_thresh_sqrd = _testdata_tied_pair()
+    args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, sver.TAU / 4)
+    weights = sver_c_wrapper.get_affine_inlier_scores_cpp(*args)[1]
+    Aff_mats = sver._affine_hypothesis_data(kpts1, kpts2, fm)[0]
+    # The winner is picked as the threads finish, but ties still go to the
+    # smallest index, so every thread count gives the argmax hypothesis
+    for num_threads in NUM_THREADS_LIST * 3:
+        out = sver_c_wrapper.get_best_affine_inliers_cpp(*args, num_threads=num_threads)
+        assert np.allclose(out[2], Aff_mats[weights.argmax()])
+
+
+def test_default_cpp_matches_deterministic():
+    import vtool.sver_c_wrapper as sver_c_wrapper
+
+    if not sver_c_wrapper.is_available():
+        pytest.skip('libsver is not built')
+
+    kpts1, kpts2, fm, fs, xy_thresh_sqrd = _testdata_tied_pair()
+    args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, sver.TAU / 4)
+    expected = _svtup_bytes(
+        sver_c_wrapper.get_best_affine_inliers_cpp(*args, deterministic=True)
+    )
+    # The default C search is reproducible too, the flag only saves memory
+    for num_threads in NUM_THREADS_LIST * 2:
+        out = sver_c_wrapper.get_best_affine_inliers_cpp(*args, num_threads=num_threads)
+        assert _svtup_bytes(out) == expected
+
+
+def test_deterministic_matches_python():
+    # The python search sums the weights in the same order, so it picks the
+    # same hypothesis out of the ties
+    kpts1, kpts2, fm, fs, xy_thresh_sqrd = _testdata_tied_pair()
+    args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, sver.TAU / 4)
+    py_out = sver.get_best_affine_inliers(*args, forcepy=True, deterministic=True)
+    out = sver.get_best_affine_inliers_(*args, deterministic=True)
+    assert np.all(py_out[0] == out[0])
+    assert np.allclose(py_out[2], out[2])
+
+
+def test_hypothesis_weights_ordered():
+    rng = np.random.RandomState(0)
+    hypo_flags = rng.rand(7, 300) > 0.4
+    fs = rng.rand(300)
+    weights = sver._hypothesis_weights(hypo_flags, fs, deterministic=True)
+    for flags, weight in zip(hypo_flags, weights):
+        expected = 0.0
+        for flag, f in zip(flags, fs):
+            if flag:
+                expected += f
+        assert weight == expected
+    assert np.allclose(weights, sver._hypothesis_weights(hypo_flags, fs))
+
+
+@pytest.mark.parametrize('refine_method', ['homog', 'homog-iter', 'affine'])
+def test_spatially_verify_kpts_deterministic(refine_method):
+    (
+        kpts1,
+        kpts2,
+        fm,
+        xy_thresh,
+        scale_thresh,
+        ori_thresh,
+        dlen_sqrd2,
+        min_nInliers,
+        match_weights,
+        full_homog_checks,
+    ) = testdata_nondeterm_sver()
+    kw = dict(
+        xy_thresh=xy_thresh,
+        scale_thresh=scale_thresh,
+        ori_thresh=ori_thresh,
+        dlen_sqrd2=dlen_sqrd2,
+        min_nInliers=min_nInliers,
+        match_weights=match_weights,
+        full_homog_checks=full_homog_checks,
+        refine_method=refine_method,
+        returnAff=True,
+        deterministic=True,
+    )
+    svtup_bytes = set()
+    for num_threads in NUM_THREADS_LIST * 2:
+        svtup = sver.spatially_verify_kpts(
+            kpts1, kpts2, fm, num_threads=num_threads, **kw
+        )
+        assert svtup is not None
+        svtup_bytes.add(_svtup_bytes(svtup))
+    assert len(svtup_bytes) == 1
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the float32 affine hypothesis search
+
+The float32 search is allowed to disagree with float64 only on matches whose
+errors are within roundoff of a threshold, so the inlier sets may differ by at
+most a couple of matches and the hypotheses by about 1e-5 relative.
+
+CommandLine:
+    python -m pytest tests/test_sver_float32.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import vtool.spatial_verification as sver
+from testdata_nondeterm_sver import testdata_nondeterm_sver
+
+# Number of matches allowed to flip between float32 and float64
+MAX_FLIPPED = 2
+AFF_RTOL = 1e-4
+
+
+def _assert_close_svtups(svtup64, svtup32):
+    assert (svtup64 is None) == (svtup32 is None)
+    if svtup64 is None:
+        return
+    refined_inliers64, aff_inliers64, Aff64 = svtup64[0], svtup64[3], svtup64[5]
+    refined_inliers32, aff_inliers32, Aff32 = svtup32[0], svtup32[3], svtup32[5]
+    assert len(np.setxor1d(aff_inliers64, aff_inliers32)) <= MAX_FLIPPED
+    assert len(np.setxor1d(refined_inliers64, refined_inliers32)) <= MAX_FLIPPED
+    # Errors and hypotheses come back as float64 for the refinement step
+    assert Aff32.dtype == np.float64
+    assert all(errs.dtype == np.float64 for errs in svtup32[4])
+    scale = np.abs(Aff64).max()
+    assert np.allclose(Aff64, Aff32, rtol=AFF_RTOL, atol=AFF_RTOL * scale)
+
+
+def _verify_both(**kwargs):
+    (
+        kpts1,
+        kpts2,
+        fm,
+        xy_thresh,
+        scale_thresh,
+        ori_thresh,
+        dlen_sqrd2,
+        min_nInliers,
+        match_weights,
+        full_homog_checks,
+    ) = testdata_nondeterm_sver()
+    args = (kpts1, kpts2, fm, xy_thresh, scale_thresh, ori_thresh, dlen_sqrd2)
+    kw = dict(
+        min_nInliers=min_nInliers,
+        match_weights=match_weights,
+        full_homog_checks=full_homog_checks,
+        returnAff=True,
+    )
+    kw.update(kwargs)
+    svtup64 = sver.spatially_verify_kpts(*args, **kw)
+    svtup32 = sver.spatially_verify_kpts(*args, dtype=np.float32, **kw)
+    return svtup64, svtup32
+
+
+def test_sver_float32_c():
+    svtup64, svtup32 = _verify_both()
+    _assert_close_svtups(svtup64, svtup32)
+
+
+def test_sver_float32_spatial_index():
+    svtup64, svtup32 = _verify_both(spatial_index=True)
+    _assert_close_svtups(svtup64, svtup32)
+
+
+def test_sver_float32_python():
+    svtup64, svtup32 = _verify_both(search='pruned')
+    _assert_close_svtups(svtup64, svtup32)
+
+
+def test_sver_float32_python_exhaustive():
+    data = testdata_nondeterm_sver()
+    kpts1, kpts2, fm, xy_thresh, scale_thresh, ori_thresh, dlen_sqrd2 = data[0:7]
+    fs = data[8]
+    xy_thresh_sqrd = xy_thresh * dlen_sqrd2
+    args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+    out64 = sver.get_best_affine_inliers(*args, forcepy=True)
+    out32 = sver.get_best_affine_inliers(*args, forcepy=True, dtype=np.float32)
+    assert out32[2].dtype == np.float32
+    assert len(np.setxor1d(out64[0], out32[0])) <= MAX_FLIPPED
+
+
+def test_sver_float32_batch():
+    data = testdata_nondeterm_sver()
+    kpts1, kpts2, fm = data[0:3]
+    fs = data[8]
+    fm_list = [fm, fm[::2]]
+    fs_list = [fs, fs[::2]]
+    kw = dict(match_weights_list=fs_list, returnAff=True)
+    svtups64 = sver.spatially_verify_kpts_batch([kpts1] * 2, [kpts2] * 2, fm_list, **kw)
+    svtups32 = sver.spatially_verify_kpts_batch(
+        [kpts1] * 2, [kpts2] * 2, fm_list, dtype=np.float32, **kw
+    )
+    for svtup64, svtup32 in zip(svtups64, svtups32):
+        _assert_close_svtups(svtup64, svtup32)
+
+
+def test_sver_float32_pruned_bounds():
+    # The float32 scale test accepts ratios of 1 against this hypothesis even
+    # though log(ratio) is just over log(scale_thresh) in float64
+    ratios = np.array([1.0] * 10 + [2.00000005227758] * 10 + [100.0] * 15)
+    num = len(ratios)
+    kpts1 = np.zeros((num, 6))
+    kpts1[:, 2] = kpts1[:, 4] = 1
+    kpts2 = np.zeros((num, 6))
+    kpts2[:, 2] = kpts2[:, 4] = np.sqrt(ratios)
+    fm = np.tile(np.arange(num)[:, None], (1, 2))
+    fs = np.ones(num)
+    xy_thresh_sqrd, scale_thresh, ori_thresh = 1e12, 2.0, 10.0
+    hypo_data = sver._affine_hypothesis_data(kpts1, kpts2, fm, dtype=np.float32)
+    flags = sver._test_hypothesis_inliers_block(
+        hypo_data[0], *(hypo_data[1:] + (xy_thresh_sqrd, scale_thresh, ori_thresh))
+    )[0]
+    bounds = sver._affine_hypothesis_upper_bounds(
+        kpts1, kpts2, fm, fs, scale_thresh, dtype=np.float32
+    )
+    assert np.all(flags.dot(fs) <= bounds)
+    args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+    out_exh = sver.get_best_affine_inliers(*args, forcepy=True, dtype=np.float32)
+    out_pru = sver.get_best_affine_inliers(*args, search='pruned', dtype=np.float32)
+    assert np.all(out_exh[0] == out_pru[0])
+    assert np.all(out_exh[2] == out_pru[2])
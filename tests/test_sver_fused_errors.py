@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parity tests between the fused refinement error tests and the reference
+test_homog_errors / test_affine_errors.
+
+The fused tests compute the same errors up to roundoff, so the inlier sets may
+only differ on matches whose errors are within roundoff of a threshold.
+
+CommandLine:
+    python -m pytest tests/test_sver_fused_errors.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import vtool.demodata as demodata
+import vtool.keypoint as ktool
+import vtool.spatial_verification as sver
+
+ERR_RTOL = 1e-9
+
+
+def _testdata_homog_pair(wh_num=(50, 40), seed=0):
+    grid_kw = dict(wh_stride=(10, 10), wh_num=wh_num, dtype=np.float64)
+    kpts1 = demodata.perterbed_grid_kpts(seed=seed, **grid_kw)
+    kpts2 = demodata.perterbed_grid_kpts(seed=seed + 1, **grid_kw)
+    fm = np.vstack([np.arange(len(kpts1))] * 2).T
+    rng = np.random.RandomState(seed)
+    H_list = [
+        np.eye(3) + rng.randn(3, 3) * np.array([[0.05], [0.05], [1e-4]])
+        for _ in range(5)
+    ]
+    xy_thresh_sqrd = 0.01 * ktool.get_kpts_dlen_sqrd(kpts2)
+    return kpts1, kpts2, fm, H_list, xy_thresh_sqrd
+
+
+def _assert_inliers_agree(inliers1, inliers2, errors, threshs):
+    """ inliers may only differ where an error is within roundoff of its threshold """
+    for fx in np.setxor1d(inliers1, inliers2):
+        assert any(
+            abs(err[fx] - thresh) <= ERR_RTOL * abs(thresh)
+            for err, thresh in zip(errors, threshs)
+            if err is not None
+        )
+
+
+def _assert_errors_close(errors1, errors2):
+    for err1, err2 in zip(errors1, errors2):
+        assert (err1 is None) == (err2 is None)
+        if err1 is not None:
+            assert np.allclose(err1, err2, rtol=ERR_RTOL, atol=ERR_RTOL)
+
+
+def test_homog_errors_fused_parity():
+    kpts1, kpts2, fm, H_list, xy_thresh_sqrd = _testdata_homog_pair()
+    scale_thresh, ori_thresh = 2.0, sver.TAU / 4
+    threshs = (xy_thresh_sqrd, ori_thresh, scale_thresh)
+    for H in H_list:
+        for full_homog_checks in [True, False]:
+            args = (H, kpts1, kpts2, fm, xy_thresh_sqrd, scale_thresh, ori_thresh)
+            ref = sver.test_homog_errors(*args, full_homog_checks=full_homog_checks)
+            fused = sver.test_homog_errors_fused(
+                *args, full_homog_checks=full_homog_checks
+            )
+            assert fused[0].dtype == ref[0].dtype
+            _assert_errors_close(ref[1], fused[1])
+            _assert_inliers_agree(ref[0], fused[0], ref[1], threshs)
+
+
+def test_affine_errors_fused_parity():
+    kpts1, kpts2, fm, H_list, xy_thresh_sqrd = _testdata_homog_pair(seed=1)
+    scale_thresh, ori_thresh = 2.0, sver.TAU / 4
+    threshs = (xy_thresh_sqrd, ori_thresh, scale_thresh)
+    for H in H_list:
+        # The affine test ignores the projective row
+        H[2] = [0, 0, 1]
+        args = (H, kpts1, kpts2, fm, xy_thresh_sqrd, scale_thresh, ori_thresh)
+        ref = sver.test_affine_errors(*args)
+        fused = sver.test_affine_errors_fused(*args)
+        _assert_errors_close(ref[1], fused[1])
+        _assert_inliers_agree(ref[0], fused[0], ref[1], threshs)
+
+
+def test_homog_errors_buffer_reuse():
+    # Testing into the same buffers gives the same result as fresh buffers, up
+    # to the last bit numpy's vectorized math may differ in between two calls
+    kpts1, kpts2, fm, H_list, xy_thresh_sqrd = _testdata_homog_pair(seed=2)
+    threshs = (xy_thresh_sqrd, 2.0, sver.TAU / 4)
+    match_data = sver._homog_match_data(kpts1, kpts2, fm)
+    buffers = sver._homog_error_buffers(len(fm))
+    for H in H_list:
+        inliers, errors = sver._homog_errors_into(
+            H, match_data, *(threshs + (True, buffers))
+        )
+        fused = sver.test_homog_errors_fused(H, kpts1, kpts2, fm, *threshs)
+        _assert_errors_close(fused[1], errors)
+        _assert_inliers_agree(fused[0], inliers, fused[1], threshs)
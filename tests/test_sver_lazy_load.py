@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests that libsver is only loaded on first use and that spatial verification
+falls back to python when it cannot be loaded.
+
+CommandLine:
+    python -m pytest tests/test_sver_lazy_load.py
+"""
+from __future__ import absolute_import, division, print_function
+import subprocess
+import sys
+import numpy as np
+import pytest
+import vtool as vt
+import vtool.demodata as demodata
+import vtool.spatial_verification as sver
+import vtool.sver_c_wrapper as sver_c_wrapper
+
+
+def test_import_does_not_load_libsver():
+    code = (
+        'import vtool, vtool.sver_c_wrapper as w; '
+        'assert w.c_sver is None and w.lib_fname is None'
+    )
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def test_missing_libsver_falls_back(tmpdir, monkeypatch):
+    kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+    fm = demodata.make_dummy_fm(len(kpts1))
+    fs = np.random.RandomState(0).rand(len(fm))
+    expected = sver.spatially_verify_kpts(
+        kpts1, kpts2, fm, match_weights=fs, deterministic=True
+    )
+    monkeypatch.setattr(sver_c_wrapper, 'dpath', str(tmpdir))
+    monkeypatch.setattr(sver_c_wrapper, 'lib_fname', None)
+    monkeypatch.setattr(sver_c_wrapper, 'c_sver', None)
+    monkeypatch.setattr(sver_c_wrapper, 'load_error', None)
+    with pytest.warns(UserWarning, match='build'):
+        assert not sver_c_wrapper.is_available()
+    assert isinstance(sver_c_wrapper.load_error, OSError)
+    with pytest.raises(OSError):
+        sver_c_wrapper.load_lib()
+    svtup = sver.spatially_verify_kpts(
+        kpts1, kpts2, fm, match_weights=fs, deterministic=True
+    )
+    assert np.all(svtup[0] == expected[0])
+    assert np.allclose(svtup[2], expected[2])
+
+
+def _reset_lib_state(monkeypatch):
+    monkeypatch.setattr(sver_c_wrapper, 'c_sver', None)
+    monkeypatch.setattr(sver_c_wrapper, 'load_error', None)
+    monkeypatch.setattr(sver_c_wrapper, '_cfuncs', {})
+
+
+def test_stale_libsver_falls_back(monkeypatch):
+    if sver_c_wrapper.find_lib_fname() is None:
+        pytest.skip('libsver is not built')
+    # A libsver built from older source lacks newer entry points
+    signatures = dict(sver_c_wrapper.CFUNC_SIGNATURES)
+    signatures['not_an_entry_point'] = signatures['get_affine_inliers']
+    monkeypatch.setattr(sver_c_wrapper, 'CFUNC_SIGNATURES', signatures)
+    _reset_lib_state(monkeypatch)
+    with pytest.warns(UserWarning):
+        assert not sver_c_wrapper.is_available()
+    assert isinstance(sver_c_wrapper.load_error, AttributeError)
+    assert not sver.have_sver_c_wrapper()
+
+
+def test_libsver_abi_mismatch_falls_back(monkeypatch):
+    if sver_c_wrapper.find_lib_fname() is None:
+        pytest.skip('libsver is not built')
+    monkeypatch.setattr(sver_c_wrapper, 'SVER_ABI_VERSION', -1)
+    _reset_lib_state(monkeypatch)
+    with pytest.warns(UserWarning, match='ABI version'):
+        assert not sver_c_wrapper.is_available()
+    assert isinstance(sver_c_wrapper.load_error, OSError)
+    with pytest.raises(OSError):
+        sver_c_wrapper.load_lib()
+
+
+def test_have_sver_c_wrapper(monkeypatch):
+    assert vt.have_sver_c_wrapper is sver.have_sver_c_wrapper
+    assert sver.have_sver_c_wrapper() == sver_c_wrapper.is_available()
+    # --no-c disables libsver even when it can be loaded
+    monkeypatch.setattr(sver, 'USE_SVER_C_WRAPPER', False)
+    assert not sver.have_sver_c_wrapper()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the nested ratio threshold sweep in
+PairwiseMatch.sver_flags, which verifies every threshold bin from a single
+hypothesis search.
+
+CommandLine:
+    python -m pytest tests/test_sver_nested.py
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pytest
+import vtool.demodata as demodata
+import vtool.keypoint as ktool
+import vtool.spatial_verification as sver
+from vtool.matching import PairwiseMatch
+
+THRESH_BINS = [0.5, 0.6, 0.7, 0.8]
+ERR_RTOL = 1e-12
+
+
+def _testdata_match(seed=0):
+    kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+    fm = demodata.make_dummy_fm(len(kpts1))
+    rng = np.random.RandomState(seed)
+    # Mix in random matches so the bins disagree on the best hypothesis
+    noise_fm = rng.randint(0, len(kpts1), size=(len(fm), 2))
+    fm = np.vstack([fm, noise_fm.astype(fm.dtype)])
+    dlen_sqrd2 = ktool.get_kpts_dlen_sqrd(kpts2)
+    match = PairwiseMatch({'kpts': kpts1}, {'kpts': kpts2, 'dlen_sqrd': dlen_sqrd2})
+    match.fm = fm
+    match.fs = rng.rand(len(fm))
+    match.local_measures['ratio'] = rng.rand(len(fm))
+    return match
+
+
+def _sver_flags_per_bin(match, cfgdict):
+    """ Verifies each bin from scratch (the behavior before the nested sweep) """
+    keys = ['sver_xy_thresh', 'sver_ori_thresh', 'sver_scale_thresh', 'refine_method']
+    xy_thresh, ori_thresh, scale_thresh, refine_method = match._take_params(
+        cfgdict, keys
+    )
+    sver_kw = dict(
+        xy_thresh=xy_thresh,
+        ori_thresh=ori_thresh,
+        scale_thresh=scale_thresh,
+        refine_method=refine_method,
+        dlen_sqrd2=match.annot2['dlen_sqrd'],
+        num_threads=1,
+    )
+    n_fm = len(match.fm)
+    agg_errors = tuple(np.full(n_fm, fill_value=np.inf) for _ in range(3))
+    agg_inlier_flags = np.zeros(n_fm, dtype=np.bool_)
+    agg_H_12 = None
+    prev_best = 50
+    ratio = match.local_measures['ratio']
+    for thresh in cfgdict['thresh_bins']:
+        ratio_flags = ratio < thresh
+        ratio_idxs = np.where(ratio_flags)[0]
+        if len(ratio_idxs) == 0:
+            continue
+        svtup = sver.spatially_verify_kpts(
+            match.annot1['kpts'],
+            match.annot2['kpts'],
+            match.fm[ratio_flags],
+            match_weights=match.fs[ratio_flags],
+            **sver_kw
+        )
+        if svtup is None:
+            inliers, errors, H_12 = [], [np.empty(0)] * 3, np.eye(3)
+        else:
+            inliers, errors, H_12 = svtup[0:3]
+        if agg_H_12 is None or (prev_best < len(inliers) < 100):
+            agg_H_12 = H_12
+            prev_best = len(inliers)
+        agg_inlier_flags[ratio_idxs[inliers]] = True
+        for agg_err, err in zip(agg_errors, errors):
+            if len(err):
+                agg_err[ratio_idxs] = np.minimum(agg_err[ratio_idxs], err)
+    return agg_inlier_flags, agg_errors, agg_H_12
+
+
+def _check_parity(thresh_bins, refine_method='homog', seed=0):
+    match = _testdata_match(seed)
+    cfgdict = dict(thresh_bins=thresh_bins, refine_method=refine_method)
+    flags, errors, H_12 = match.sver_flags(cfgdict, return_extra=True)
+    flags_, errors_, H_12_ = _sver_flags_per_bin(match, cfgdict)
+    assert np.all(flags == flags_)
+    # numpy's vectorized math can differ in the last bit between two calls
+    for err, err_ in zip(errors, errors_):
+        assert np.allclose(err, err_, rtol=ERR_RTOL, atol=0)
+    assert np.allclose(H_12, H_12_, rtol=ERR_RTOL, atol=ERR_RTOL)
+    return flags
+
+
+def test_sver_nested_parity():
+    flags = _check_parity(THRESH_BINS)
+    assert flags.sum() > 0
+
+
+def test_sver_nested_parity_affine():
+    _check_parity(THRESH_BINS, refine_method='affine', seed=1)
+
+
+def test_sver_nested_unsorted_bins():
+    # bins are verified in the given order, duplicates and all
+    _check_parity([0.7, 0.5, 0.8, 0.5], seed=2)
+
+
+def test_sver_nested_empty_bin():
+    _check_parity([0.0, 0.3, 0.9], seed=3)
+
+
+def test_sver_nested_ties_match_python():
+    import vtool.sver_c_wrapper as sver_c_wrapper
+
+    if not sver_c_wrapper.is_available():
+        pytest.skip('libsver is not built')
+    kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+    kpts1, kpts2 = kpts1.astype(np.float64), kpts2.astype(np.float64)
+    fm = demodata.make_dummy_fm(len(kpts1))
+    # Uniform weights on a grid, so many hypotheses tie at every level
+    fs = np.ones(len(fm))
+    match_levels = np.random.RandomState(0).randint(0, 4, size=len(fm))
+    args = (fm, fs, match_levels, 4, 0.01 * ktool.get_kpts_dlen_sqrd(kpts2))
+    args = args + (2.0, sver.TAU / 4)
+    c_out = sver.get_best_affine_inliers_nested(kpts1, kpts2, *args)
+    py_out = sver.get_best_affine_inliers_nested(kpts1, kpts2, *args, forcepy=True)
+    for c_level, py_level in zip(c_out, py_out):
+        assert np.all(c_level[0] == py_level[0])
+        assert np.allclose(c_level[2], py_level[2])
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for one-vs-one feature assignment
+
+CommandLine:
+    python tests/time_matching.py
+"""
+from __future__ import absolute_import, division, print_function
+import time
+import numpy as np
+from vtool import matching
+
+
+def testdata_symmetric_neighbors(num=1000, K=2, Knorm=1, seed=0):
+    """
+    Neighbors between two feature sets where each feature has a true
+    counterpart near the top of its neighbor list, so many matches are
+    reciprocal.
+
+    Returns:
+        tuple: (fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist)
+    """
+    rng = np.random.RandomState(seed)
+    num_neighbors = K + Knorm
+
+    def _neighbors():
+        # Distinct neighbors of each feature, with itself at a random rank
+        offsets = np.cumsum(rng.randint(1, 50, size=(num, num_neighbors)), axis=1)
+        rank = rng.randint(0, K, size=num)
+        start = np.arange(num) - offsets[np.arange(num), rank]
+        qfx_to_dfx = ((start[:, None] + offsets) % num).astype(np.int32)
+        qfx_to_dist = np.sort(rng.rand(num, num_neighbors), axis=1)
+        return qfx_to_dfx, qfx_to_dist
+
+    fx2_to_fx1, fx2_to_dist = _neighbors()
+    fx1_to_fx2, fx1_to_dist = _neighbors()
+    return fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist
+
+
+def _timeit(func, num_reps):
+    start = time.time()
+    for _ in range(num_reps):
+        result = func()
+    return (time.time() - start) / num_reps, result
+
+
+def benchmark_symmetric_flags(
+    K_list=(1, 2, 5, 10, 32, 64), num_list=(1000, 10000, 50000), num_reps=3
+):
+    """
+    The two versions of flag_symmetric_matches: the K x K lookup and the sort
+    join used for K >= SYMMETRIC_JOIN_MIN_K. Also times the python loop of
+    flag_sym_slow for small inputs and the full assign_symmetric_matches.
+    """
+    print('----------')
+    print('BENCHMARK: symmetric_flags')
+    print('SYMMETRIC_JOIN_MIN_K = %d' % (matching.SYMMETRIC_JOIN_MIN_K,))
+    for K in K_list:
+        for num in num_list:
+            tup = testdata_symmetric_neighbors(num, K)
+            fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist = tup
+            lookup_time, flags1 = _timeit(
+                lambda: matching._flag_symmetric_lookup(fx2_to_fx1, fx1_to_fx2, K),
+                num_reps,
+            )
+            join_time, flags2 = _timeit(
+                lambda: matching._flag_symmetric_join(fx2_to_fx1, fx1_to_fx2, K),
+                num_reps,
+            )
+            assert np.all(flags1 == flags2)
+            assign_time, _ = _timeit(
+                lambda: matching.assign_symmetric_matches(
+                    fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist, K, 1
+                ),
+                num_reps,
+            )
+            line = ' * K=%2d N=%6d lookup=%.4fs join=%.4fs assign=%.4fs' % (
+                K, num, lookup_time, join_time, assign_time)
+            if num <= 1000:
+                slow_time, flags3 = _timeit(
+                    lambda: matching.flag_sym_slow(fx2_to_fx1, fx1_to_fx2, K), 1
+                )
+                assert np.all(flags2 == flags3)
+                line += ' slow=%.4fs' % (slow_time,)
+            print(line)
+
+
+if __name__ == '__main__':
+    benchmark_symmetric_flags()
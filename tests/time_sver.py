@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the spatial verification hypothesis search
+
+CommandLine:
+    python tests/time_sver.py
+"""
+from __future__ import absolute_import, division, print_function
+import time
+import numpy as np
+import ubelt as ub
+from vtool import spatial_verification as sver
+
+
+def testdata_synthetic_pair(num_matches=2000, inlier_frac=0.3, seed=0):
+    """
+    Builds a pair of keypoint sets related by a similarity transform.
+
+    Only the first ``inlier_frac`` of the matches follow the transform, the
+    rest are random. Keypoint shapes are isotropic so that the orientation of
+    a mapped keypoint is just the sum of the angles.
+
+    Returns:
+        tuple: (kpts1, kpts2, fm, fs, true_inliers)
+    """
+    rng = np.random.RandomState(seed)
+    num_inliers = int(num_matches * inlier_frac)
+    scale = 1.3
+    rot = 0.4
+    trans = np.array([40.0, -25.0])
+    R = np.array([[np.cos(rot), -np.sin(rot)], [np.sin(rot), np.cos(rot)]])
+
+    kpts1 = np.zeros((num_matches, 6), dtype=np.float64)
+    kpts1[:, 0:2] = rng.rand(num_matches, 2) * 1000
+    kpts1[:, 2] = kpts1[:, 4] = rng.rand(num_matches) * 27 + 3
+    kpts1[:, 5] = rng.rand(num_matches) * sver.TAU
+
+    kpts2 = np.zeros((num_matches, 6), dtype=np.float64)
+    kpts2[:, 0:2] = rng.rand(num_matches, 2) * 1300
+    kpts2[:, 2] = kpts2[:, 4] = rng.rand(num_matches) * 27 + 3
+    kpts2[:, 5] = rng.rand(num_matches) * sver.TAU
+    # Plant the inliers
+    xy1 = kpts1[:num_inliers, 0:2]
+    noise = rng.randn(num_inliers, 2) * 2
+    kpts2[:num_inliers, 0:2] = scale * xy1.dot(R.T) + trans + noise
+    kpts2[:num_inliers, 2] = kpts2[:num_inliers, 4] = kpts1[:num_inliers, 2] * scale
+    kpts2[:num_inliers, 5] = (kpts1[:num_inliers, 5] + rot) % sver.TAU
+
+    fm = np.vstack([np.arange(num_matches)] * 2).T.astype(np.int32)
+    # Correct matches tend to have better scores
+    fs = rng.rand(num_matches)
+    fs[:num_inliers] += 0.5
+    sortx = rng.permutation(num_matches)
+    fm = fm.take(sortx, axis=0)
+    fs = fs.take(sortx)
+    true_inliers = np.where(sortx < num_inliers)[0]
+    return kpts1, kpts2, fm, fs, true_inliers
+
+
+def _recall(found, target):
+    if len(target) == 0:
+        return 1.0
+    return len(np.intersect1d(found, target)) / len(target)
+
+
+def _nbytes(data):
+    """ total size of the numpy buffers in a nested output """
+    buffers = {}
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, (list, tuple)):
+            stack.extend(item)
+        elif isinstance(item, np.ndarray):
+            # count views of the same buffer once
+            while item.base is not None:
+                item = item.base
+            buffers[id(item)] = item.nbytes
+    return sum(buffers.values())
+
+
+def benchmark_hypothesis_sampling(num_matches=2000, inlier_frac=0.3, num_seeds=3):
+    """
+    Compares the time and recall of sampled hypothesis search against the
+    exhaustive search.
+    """
+    print('----------')
+    print('BENCHMARK: hypothesis_sampling')
+    print('num_matches=%r inlier_frac=%r' % (num_matches, inlier_frac))
+    kw = dict(min_nInliers=4, returnAff=True)
+    rows = []
+    for seed in range(num_seeds):
+        kpts1, kpts2, fm, fs, true_inliers = testdata_synthetic_pair(
+            num_matches, inlier_frac, seed
+        )
+        kw['match_weights'] = fs
+        start = time.time()
+        svtup = sver.spatially_verify_kpts(kpts1, kpts2, fm, **kw)
+        exhaustive_time = time.time() - start
+        exhaustive_inliers = svtup[0] if svtup is not None else []
+        rows.append(
+            ('exhaustive', None, seed, exhaustive_time, 1.0,
+             _recall(exhaustive_inliers, true_inliers))
+        )
+        for method in ['random', 'stratified']:
+            for budget in [25, 50, 100, 250, 500]:
+                start = time.time()
+                svtup = sver.spatially_verify_kpts(
+                    kpts1,
+                    kpts2,
+                    fm,
+                    hypothesis_sampling=method,
+                    num_hypotheses=budget,
+                    hypothesis_seed=seed,
+                    **kw
+                )
+                total_time = time.time() - start
+                inliers = svtup[0] if svtup is not None else []
+                rows.append(
+                    (method, budget, seed, total_time,
+                     _recall(inliers, exhaustive_inliers),
+                     _recall(inliers, true_inliers))
+                )
+    # Average over seeds
+    groups = ub.group_items(rows, [row[0:2] for row in rows])
+    fmt = '{:>12} {:>8} {:>10} {:>18} {:>13}'
+    print(fmt.format('mode', 'budget', 'time', 'recall(exhaustive)', 'recall(truth)'))
+    for (method, budget), group in groups.items():
+        group = np.array([row[3:] for row in group])
+        mean_time, recall_exhaustive, recall_truth = group.mean(axis=0)
+        print(fmt.format(
+            method, str(budget), '%.4fs' % mean_time,
+            '%.3f' % recall_exhaustive, '%.3f' % recall_truth))
+    return rows
+
+
+def benchmark_pruned_search(num_matches=2000, inlier_frac=0.3):
+    """
+    Compares the pruned and exhaustive python hypothesis searches.
+    """
+    print('----------')
+    print('BENCHMARK: pruned search')
+    kpts1, kpts2, fm, fs, true_inliers = testdata_synthetic_pair(
+        num_matches, inlier_frac
+    )
+    xy_thresh_sqrd = 0.01 * sver.ktool.get_kpts_dlen_sqrd(kpts2)
+    args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, sver.TAU / 4)
+    for search in ['exhaustive', 'pruned']:
+        start = time.time()
+        aff_inliers = sver.get_best_affine_inliers(
+            *args, forcepy=True, search=search)[0]
+        print(' * %s: %.4fs nInliers=%d' % (
+            search, time.time() - start, len(aff_inliers)))
+
+
+def benchmark_spatial_index(inlier_frac=0.3):
+    """
+    Compares the best hypothesis search with and without the grid index.
+    """
+    print('----------')
+    print('BENCHMARK: spatial index')
+    for num_matches in [500, 2000, 4000]:
+        kpts1, kpts2, fm, fs, true_inliers = testdata_synthetic_pair(
+            num_matches, inlier_frac
+        )
+        xy_thresh_sqrd = 0.01 * sver.ktool.get_kpts_dlen_sqrd(kpts2)
+        args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, sver.TAU / 4)
+        for spatial_index in [False, True]:
+            start = time.time()
+            aff_inliers = sver.get_best_affine_inliers_(
+                *args, spatial_index=spatial_index)[0]
+            print(' * num_matches=%d spatial_index=%r: %.4fs nInliers=%d' % (
+                num_matches, spatial_index, time.time() - start,
+                len(aff_inliers)))
+
+
+def benchmark_float32(inlier_frac=0.3):
+    """
+    Compares the float64 and float32 affine hypothesis searches.
+    """
+    print('----------')
+    print('BENCHMARK: float32')
+    for num_matches in [500, 2000]:
+        kpts1, kpts2, fm, fs, true_inliers = testdata_synthetic_pair(
+            num_matches, inlier_frac
+        )
+        xy_thresh_sqrd = 0.01 * sver.ktool.get_kpts_dlen_sqrd(kpts2)
+        args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, sver.TAU / 4)
+        for forcepy in [False, True]:
+            results = {}
+            for dtype in [np.float64, np.float32]:
+                start = time.time()
+                if forcepy:
+                    out = sver.get_best_affine_inliers(
+                        *args, forcepy=True, dtype=dtype)
+                else:
+                    out = sver.get_best_affine_inliers_(*args, dtype=dtype)
+                results[dtype] = out[0]
+                print(' * num_matches=%d %s %s: %.4fs nInliers=%d' % (
+                    num_matches, 'py' if forcepy else 'c',
+                    np.dtype(dtype).name, time.time() - start, len(out[0])))
+            print('   flipped inliers: %d' % (
+                len(np.setxor1d(results[np.float64], results[np.float32]))))
+
+
+def benchmark_compact_inliers(inlier_frac=0.3):
+    """
+    Compares the dense and compact outputs of get_affine_inliers_cpp.
+    """
+    from vtool import sver_c_wrapper
+
+    print('----------')
+    print('BENCHMARK: compact inliers')
+    for num_matches in [500, 2000]:
+        kpts1, kpts2, fm, fs, true_inliers = testdata_synthetic_pair(
+            num_matches, inlier_frac
+        )
+        xy_thresh_sqrd = 0.01 * sver.ktool.get_kpts_dlen_sqrd(kpts2)
+        args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, sver.TAU / 4)
+        for compact in [False, True]:
+            start = time.time()
+            out = sver_c_wrapper.get_affine_inliers_cpp(
+                *args, compact=compact, top_k=10)
+            total_time = time.time() - start
+            nbytes = _nbytes(out)
+            print(' * num_matches=%d compact=%r: %.4fs output=%.1fMB' % (
+                num_matches, compact, total_time, nbytes / 2 ** 20))
+
+
+def benchmark_homog_batch(num_pairs=500):
+    """
+    Compares solving the homographies of many pairs one at a time and at once.
+    """
+    import vtool.linalg as ltool
+
+    print('----------')
+    print('BENCHMARK: homog batch')
+    rng = np.random.RandomState(0)
+    xy1_mn_list, xy2_mn_list = [], []
+    for num in rng.randint(7, 300, size=num_pairs):
+        xy1 = rng.rand(2, num) * 1000
+        xy2 = xy1 * 1.2 + rng.randn(2, num) * 2
+        xy1_mn_list.append(ltool.whiten_xy_points(xy1)[0])
+        xy2_mn_list.append(ltool.whiten_xy_points(xy2)[0])
+    start = time.time()
+    H_list1 = [sver.compute_homog(xy1, xy2)
+               for xy1, xy2 in zip(xy1_mn_list, xy2_mn_list)]
+    print(' * compute_homog loop: %.4fs' % (time.time() - start,))
+    start = time.time()
+    H_list2 = sver.compute_homog_batch(xy1_mn_list, xy2_mn_list)
+    print(' * compute_homog_batch: %.4fs' % (time.time() - start,))
+    max_diff = max(np.abs(H1 / H1[2, 2] - H2 / H2[2, 2]).max()
+                   for H1, H2 in zip(H_list1, H_list2))
+    print(' * max difference: %.2e' % (max_diff,))
+
+
+def testdata_perspective_pair(num_matches=1000, inlier_frac=0.4, seed=0, noise=1.5):
+    """
+    Like testdata_synthetic_pair, but the inliers follow a homography with a
+    perspective component, so a single affine hypothesis only fits part of
+    them.
+    """
+    import vtool.linalg as ltool
+
+    kpts1, kpts2, fm, fs, true_inliers = testdata_synthetic_pair(
+        num_matches, inlier_frac, seed
+    )
+    rng = np.random.RandomState(seed)
+    H = np.array([[1.2, 0.1, 30.0], [-0.05, 1.1, -20.0], [3e-4, 2e-4, 1.0]])
+    num_inliers = int(num_matches * inlier_frac)
+    xy1 = kpts1[:num_inliers, 0:2].T
+    xy2 = ltool.transform_points_with_homography(H, xy1)
+    kpts2[:num_inliers, 0:2] = xy2.T + rng.randn(num_inliers, 2) * noise
+    # match the scale change of the homography at each point
+    det = 1.0 / (H[2, 0] * xy1[0] + H[2, 1] * xy1[1] + 1) ** 3 * np.linalg.det(H)
+    kpts2[:num_inliers, 2] = kpts2[:num_inliers, 4] = (
+        kpts1[:num_inliers, 2] * np.sqrt(np.abs(det)))
+    kpts2[:num_inliers, 5] = kpts1[:num_inliers, 5]
+    return kpts1, kpts2, fm, fs, true_inliers
+
+
+def benchmark_homog_iter(num_seeds=5):
+    """
+    Compares refine_method='homog' and 'homog-iter'.
+
+    Uses the demodata easy1 / easy2 pair when pyhesaff is available, and
+    synthetic pairs related by a homography with known inliers otherwise.
+    """
+    print('----------')
+    print('BENCHMARK: homog-iter')
+    kw = dict(min_nInliers=4, returnAff=True)
+    try:
+        import vtool.demodata as demodata
+        kpts1, kpts2, fm, fs, rchip1, rchip2 = demodata.testdata_ratio_matches(
+            'easy1.png', 'easy2.png', ratio_thresh=0.625
+        )
+    except ImportError as ex:
+        print(' * skipping easy1/easy2 (%s)' % (ex,))
+    else:
+        for refine_method in ['homog', 'homog-iter']:
+            start = time.time()
+            svtup = sver.spatially_verify_kpts(
+                kpts1, kpts2, fm, match_weights=np.ones(len(fm)),
+                refine_method=refine_method, **kw)
+            print(' * easy1/easy2 %s: %.4fs nInliers=%d' % (
+                refine_method, time.time() - start, len(svtup[0])))
+    # A tight threshold and noisy inliers, so the homography estimated from
+    # the affine inliers alone misses some of the true inliers
+    noise, xy_thresh = 8.0, 0.0002
+    print(' * synthetic noise=%r xy_thresh=%r' % (noise, xy_thresh))
+    fmt = '{:>12} {:>10} {:>10} {:>10}'
+    print(fmt.format('refine', 'time', 'precision', 'recall'))
+    rows = ub.ddict(list)
+    for seed in range(num_seeds):
+        kpts1, kpts2, fm, fs, true_inliers = testdata_perspective_pair(
+            seed=seed, noise=noise)
+        for refine_method in ['homog', 'homog-iter']:
+            start = time.time()
+            svtup = sver.spatially_verify_kpts(
+                kpts1, kpts2, fm, xy_thresh=xy_thresh, match_weights=fs,
+                refine_method=refine_method, **kw)
+            total_time = time.time() - start
+            inliers = svtup[0] if svtup is not None else []
+            precision = _recall(true_inliers, inliers)
+            rows[refine_method].append(
+                (total_time, precision, _recall(inliers, true_inliers)))
+    for refine_method, group in rows.items():
+        mean_time, precision, recall = np.mean(group, axis=0)
+        print(fmt.format(refine_method, '%.4fs' % mean_time,
+                         '%.3f' % precision, '%.3f' % recall))
+
+
+def benchmark_nested_thresh_bins(thresh_bins=(0.5, 0.6, 0.7, 0.8), inlier_frac=0.3):
+    """
+    Compares verifying each ratio threshold bin from scratch with the nested
+    verification of all bins (what PairwiseMatch.sver_flags does).
+    """
+    print('----------')
+    print('BENCHMARK: nested thresh_bins')
+    sorted_bins = sorted(thresh_bins)
+    for num_matches in [500, 2000]:
+        kpts1, kpts2, fm, fs, true_inliers = testdata_synthetic_pair(
+            num_matches, inlier_frac
+        )
+        # Ratios uniform in [0, max(thresh_bins)) so the last bin has every match
+        ratio = np.random.RandomState(0).rand(num_matches) * sorted_bins[-1]
+        dlen_sqrd2 = sver.ktool.get_kpts_dlen_sqrd(kpts2)
+        kw = dict(dlen_sqrd2=dlen_sqrd2, returnAff=True)
+        start = time.time()
+        svtups1 = [
+            sver.spatially_verify_kpts(
+                kpts1, kpts2, fm[ratio < thresh], match_weights=fs[ratio < thresh],
+                **kw)
+            for thresh in sorted_bins
+        ]
+        per_bin_time = time.time() - start
+        start = time.time()
+        match_levels = np.searchsorted(sorted_bins, ratio, side='right')
+        svtups2 = sver.spatially_verify_kpts_nested(
+            kpts1, kpts2, fm, match_levels, len(sorted_bins), match_weights=fs,
+            **kw)
+        nested_time = time.time() - start
+        same = all(
+            np.all(svtup1[0] == svtup2[0]) for svtup1, svtup2 in zip(svtups1, svtups2)
+        )
+        print(' * num_matches=%d per-bin: %.4fs nested: %.4fs (%.2fx) same=%r' % (
+            num_matches, per_bin_time, nested_time, per_bin_time / nested_time,
+            same))
+
+
+def benchmark_kpts_mats(num_pairs=50, num_kpts=2000, num_matches=300):
+    """
+    One query annotation verified against many database annotations, with and
+    without the per-annotation keypoint matrices from sver.get_kpts_mats.
+    """
+    print('----------')
+    print('BENCHMARK: kpts_mats')
+    rng = np.random.RandomState(0)
+    kpts1, kpts2, _, _, _ = testdata_synthetic_pair(num_kpts, 0.3)
+    fm_list = [
+        np.vstack([rng.choice(num_kpts, num_matches, replace=False)] * 2).T
+        for _ in range(num_pairs)
+    ]
+    fs_list = [rng.rand(num_matches) for _ in range(num_pairs)]
+    kw = dict(search='pruned', refine_method='homog-iter')
+    for use_mats in [False, True]:
+        start = time.time()
+        if use_mats:
+            kw['kpts1_mats'] = sver.get_kpts_mats(kpts1)
+            kw['kpts2_mats'] = sver.get_kpts_mats(kpts2)
+        for fm, fs in zip(fm_list, fs_list):
+            sver.spatially_verify_kpts(kpts1, kpts2, fm, match_weights=fs, **kw)
+        print(' * num_pairs=%d use_mats=%r: %.4fs' % (
+            num_pairs, use_mats, time.time() - start))
+
+
+def benchmark_fused_errors(num_reps=20, inlier_frac=0.3):
+    """
+    The reference refinement error tests against the fused versions used by
+    refine_inliers. The fused tests are also timed with precomputed keypoint
+    matrices, which leaves only the error computation itself.
+    """
+    print('----------')
+    print('BENCHMARK: fused_errors')
+    for num_matches in [1000, 10000]:
+        kpts1, kpts2, fm, fs, _ = testdata_synthetic_pair(num_matches, inlier_frac)
+        aff_inliers, _, Aff = sver.get_best_affine_inliers_(
+            kpts1, kpts2, fm, fs, 1000.0, 2.0, sver.TAU / 4
+        )
+        H = sver.estimate_refined_transform(kpts1, kpts2, fm, aff_inliers)
+        args = (kpts1, kpts2, fm, 1000.0, 2.0, sver.TAU / 4)
+        mats_kw = dict(
+            kpts1_mats=sver.get_kpts_mats(kpts1), kpts2_mats=sver.get_kpts_mats(kpts2)
+        )
+        funcs = [
+            ('homog', sver.test_homog_errors, H, {}),
+            ('homog_fused', sver.test_homog_errors_fused, H, {}),
+            ('homog_fused_mats', sver.test_homog_errors_fused, H, mats_kw),
+            ('affine', sver.test_affine_errors, Aff, {}),
+            ('affine_fused', sver.test_affine_errors_fused, Aff, {}),
+            ('affine_fused_mats', sver.test_affine_errors_fused, Aff, mats_kw),
+        ]
+        for name, func, M, kw in funcs:
+            start = time.time()
+            for _ in range(num_reps):
+                func(M, *args, **kw)
+            print(' * num_matches=%d %s: %.4fs' % (
+                num_matches, name, time.time() - start))
+
+
+def benchmark_deterministic(inlier_frac=0.3, num_threads_list=(1, 4)):
+    """
+    Overhead of deterministic=True on the C and python hypothesis searches.
+    """
+    print('----------')
+    print('BENCHMARK: deterministic')
+    for num_matches in [500, 2000]:
+        kpts1, kpts2, fm, fs, _ = testdata_synthetic_pair(num_matches, inlier_frac)
+        xy_thresh_sqrd = 0.01 * sver.ktool.get_kpts_dlen_sqrd(kpts2)
+        args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, sver.TAU / 4)
+        for num_threads in num_threads_list:
+            for deterministic in [False, True]:
+                start = time.time()
+                sver.get_best_affine_inliers_(
+                    *args, num_threads=num_threads, deterministic=deterministic)
+                print(' * num_matches=%d c num_threads=%d deterministic=%r: %.4fs' % (
+                    num_matches, num_threads, deterministic, time.time() - start))
+        for deterministic in [False, True]:
+            start = time.time()
+            sver.get_best_affine_inliers(
+                *args, forcepy=True, deterministic=deterministic)
+            print(' * num_matches=%d py deterministic=%r: %.4fs' % (
+                num_matches, deterministic, time.time() - start))
+
+
+def benchmark_sver_cache(num_pairs=50, num_kpts=2000, num_matches=300):
+    """
+    A cold run of many pairs through sver.SverCache against a warm rerun,
+    which only hashes the inputs and loads the results.
+    """
+    import tempfile
+    print('----------')
+    print('BENCHMARK: sver_cache')
+    rng = np.random.RandomState(0)
+    kpts1, kpts2, _, _, _ = testdata_synthetic_pair(num_kpts, 0.3)
+    fm_list = [
+        np.vstack([rng.choice(num_kpts, num_matches, replace=False)] * 2).T
+        for _ in range(num_pairs)
+    ]
+    fs_list = [rng.rand(num_matches) for _ in range(num_pairs)]
+    cache_dir = tempfile.mkdtemp()
+    for run in ['uncached', 'cold', 'warm']:
+        sver_cache = sver.SverCache(cache_dir)
+        start = time.time()
+        for fm, fs in zip(fm_list, fs_list):
+            kw = dict(match_weights=fs, deterministic=True)
+            if run == 'uncached':
+                sver.spatially_verify_kpts(kpts1, kpts2, fm, **kw)
+            else:
+                sver.spatially_verify_kpts_cached(kpts1, kpts2, fm, sver_cache, **kw)
+        print(' * num_pairs=%d %s: %.4fs hits=%d' % (
+            num_pairs, run, time.time() - start, sver_cache.num_hits))
+    sver_cache.clear()
+
+
+if __name__ == '__main__':
+    benchmark_hypothesis_sampling(inlier_frac=0.3)
+    benchmark_hypothesis_sampling(inlier_frac=0.02)
+    benchmark_pruned_search()
+    benchmark_spatial_index()
+    benchmark_float32()
+    benchmark_compact_inliers()
+    benchmark_homog_batch()
+    benchmark_homog_iter()
+    benchmark_nested_thresh_bins()
+    benchmark_kpts_mats()
+    benchmark_fused_errors()
+    benchmark_deterministic()
+    benchmark_sver_cache()
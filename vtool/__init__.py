@@ -461,23 +461,34 @@ from vtool.chip import (
     testshow_extramargin_info,
 )
 from vtool.spatial_verification import (
-    HAVE_SVER_C_WRAPPER,
     INDEX_DTYPE,
     SV_DTYPE,
+    SverCache,
+    USE_SVER_C_WRAPPER,
     VERBOSE_SVER,
     build_affine_lstsqrs_Mx6,
     build_lstsqrs_Mx9,
     compute_affine,
     compute_homog,
+    compute_homog_batch,
     estimate_refined_transform,
     get_affine_inliers,
     get_best_affine_inliers,
     get_best_affine_inliers_,
+    get_best_affine_inliers_nested,
+    get_kpts_mats,
     get_normalized_affine_inliers,
+    have_sver_c_wrapper,
     refine_inliers,
+    sample_affine_hypotheses,
     spatially_verify_kpts,
+    spatially_verify_kpts_batch,
+    spatially_verify_kpts_cached,
+    spatially_verify_kpts_nested,
     test_affine_errors,
+    test_affine_errors_fused,
     test_homog_errors,
+    test_homog_errors_fused,
     testdata_matching_affine_inliers,
     testdata_matching_affine_inliers_normalized,
     try_svd,
@@ -512,22 +523,31 @@ from vtool.util_math import (
 from vtool.matching import (
     AnnotPairFeatInfo,
     AssignTup,
+    COMPACT_MEASURE_DTYPE,
+    COMPACT_STATE_VERSION,
     MatchingError,
+    NN_BRUTEFORCE_BLOCK_SIZE,
+    NN_BRUTEFORCE_MAX_PAIRS,
     NORM_CHIP_CONFIG,
+    OneVsManyIndex,
     PSEUDO_MAX_DIST,
     PSEUDO_MAX_DIST_SQRD,
     PSEUDO_MAX_VEC_COMPONENT,
     PairwiseMatch,
+    PairwiseMatchSet,
     SUM_OPS,
+    SYMMETRIC_JOIN_MIN_K,
     VSONE_ASSIGN_CONFIG,
     VSONE_DEFAULT_CONFIG,
     VSONE_FEAT_CONFIG,
     VSONE_PI_DICT,
     VSONE_RATIO_CONFIG,
     VSONE_SVER_CONFIG,
+    apply_all_parallel,
     assign_symmetric_matches,
     assign_unconstrained_matches,
     asymmetric_correspondence,
+    bruteforce_nearest_neighbors,
     csum,
     demodata_match,
     empty_assign,
@@ -535,6 +555,7 @@ from vtool.matching import (
     ensure_metadata_dlen_sqrd,
     ensure_metadata_feats,
     ensure_metadata_flann,
+    ensure_metadata_kpts_mats,
     ensure_metadata_normxy,
     ensure_metadata_vsone,
     flag_sym_slow,
@@ -574,12 +595,16 @@ from vtool.geometry import (
 )
 from vtool.nearest_neighbors import (
     AnnoyWrapper,
+    FLANN_LRU,
+    FLANN_LRU_MAX_BYTES,
+    FlannLRU,
     ann_flann_once,
     assign_to_centroids,
     flann_augment,
     flann_cache,
     flann_index_time_experiment,
     get_flann_cfgstr,
+    get_flann_dpts_fpath,
     get_flann_fpath,
     get_flann_params,
     get_flann_params_cfgstr,
@@ -774,12 +799,17 @@ __all__ = [
     'AnnoyWraper',
     'AnnoyWrapper',
     'AssignTup',
+    'COMPACT_MEASURE_DTYPE',
+    'COMPACT_STATE_VERSION',
     'ConfusionMetrics',
     'DATETIMEORIGINAL_TAGID',
     'DEFAULT_DTYPE',
     'EXIF_TAG_DATETIME',
     'EXIF_TAG_GPS',
     'EXIF_TAG_TO_TAGID',
+    'FLANN_LRU',
+    'FLANN_LRU_MAX_BYTES',
+    'FlannLRU',
     'GPSDATE_CODE',
     'GPSINFO_CODE',
     'GPSLATITUDEREF_CODE',
@@ -790,7 +820,6 @@ __all__ = [
     'GPS_TAG_TO_GPSID',
     'GRAVITY_THETA',
     'GaussianBlurInplace',
-    'HAVE_SVER_C_WRAPPER',
     'INDEX_DTYPE',
     'KPTS_DTYPE',
     'L1',
@@ -802,6 +831,8 @@ __all__ = [
     'LINE_AA',
     'LOC_DIMS',
     'MatchingError',
+    'NN_BRUTEFORCE_BLOCK_SIZE',
+    'NN_BRUTEFORCE_MAX_PAIRS',
     'NORM_CHIP_CONFIG',
     'ORIENTATION_000',
     'ORIENTATION_090',
@@ -813,10 +844,12 @@ __all__ = [
     'ORIENTATION_ORDER_LIST',
     'ORIENTATION_UNDEFINED',
     'ORI_DIM',
+    'OneVsManyIndex',
     'PSEUDO_MAX_DIST',
     'PSEUDO_MAX_DIST_SQRD',
     'PSEUDO_MAX_VEC_COMPONENT',
     'PairwiseMatch',
+    'PairwiseMatchSet',
     'SCAX_DIM',
     'SCAY_DIM',
     'SENSITIVITYTYPE_CODE',
@@ -824,12 +857,15 @@ __all__ = [
     'SKEW_DIM',
     'SUM_OPS',
     'SV_DTYPE',
+    'SYMMETRIC_JOIN_MIN_K',
     'ScaleStrat',
     'ScoreNormVisualizeClass',
     'ScoreNormalizer',
+    'SverCache',
     'TAU',
     'TEMP_VEC_DTYPE',
     'TRANSFORM_DTYPE',
+    'USE_SVER_C_WRAPPER',
     'VALID_DISTS',
     'VERBOSE_SVER',
     'VSONE_ASSIGN_CONFIG',
@@ -847,6 +883,7 @@ __all__ = [
     'affine_warp_around_center',
     'and_lists',
     'ann_flann_once',
+    'apply_all_parallel',
     'apply_filter_funcs',
     'apply_grouping',
     'apply_grouping_',
@@ -891,6 +928,7 @@ __all__ = [
     'blend_images_mult_average',
     'blend_images_multiply',
     'breakup_equal_streak',
+    'bruteforce_nearest_neighbors',
     'build_affine_lstsqrs_Mx6',
     'build_lstsqrs_Mx9',
     'calc_error_bars_from_sample',
@@ -923,6 +961,7 @@ __all__ = [
     'compute_chip',
     'compute_distances',
     'compute_homog',
+    'compute_homog_batch',
     'compute_ndarray_unique_rowids_unsafe',
     'compute_unique_arr_dataids',
     'compute_unique_data_ids',
@@ -975,6 +1014,7 @@ __all__ = [
     'ensure_metadata_dlen_sqrd',
     'ensure_metadata_feats',
     'ensure_metadata_flann',
+    'ensure_metadata_kpts_mats',
     'ensure_metadata_normxy',
     'ensure_metadata_vsone',
     'ensure_monotone_decreasing',
@@ -1045,6 +1085,7 @@ __all__ = [
     'get_affine_inliers',
     'get_best_affine_inliers',
     'get_best_affine_inliers_',
+    'get_best_affine_inliers_nested',
     'get_covered_mask',
     'get_crop_slices',
     'get_cross_patch',
@@ -1062,6 +1103,7 @@ __all__ = [
     'get_extract_features_default_params',
     'get_extramargin_measures',
     'get_flann_cfgstr',
+    'get_flann_dpts_fpath',
     'get_flann_fpath',
     'get_flann_params',
     'get_flann_params_cfgstr',
@@ -1083,6 +1125,7 @@ __all__ = [
     'get_kpts_dummy_img',
     'get_kpts_eccentricity',
     'get_kpts_image_extent',
+    'get_kpts_mats',
     'get_kpts_strs',
     'get_kpts_wh',
     'get_lat_lon',
@@ -1138,6 +1181,7 @@ __all__ = [
     'groupby_dict',
     'groupby_gen',
     'groupedzip',
+    'have_sver_c_wrapper',
     'haversine',
     'hist_argmaxima',
     'hist_argmaxima2',
@@ -1293,6 +1337,7 @@ __all__ = [
     'safe_min',
     'safe_pdist',
     'safe_vstack',
+    'sample_affine_hypotheses',
     'sample_ell_border_pts',
     'sample_ell_border_vals',
     'sample_uniform',
@@ -1316,6 +1361,9 @@ __all__ = [
     'sorted_indices_ranges',
     'spatial_verification',
     'spatially_verify_kpts',
+    'spatially_verify_kpts_batch',
+    'spatially_verify_kpts_cached',
+    'spatially_verify_kpts_nested',
     'stack_image_list',
     'stack_image_list_special',
     'stack_image_recurse',
@@ -1339,9 +1387,11 @@ __all__ = [
     'take2',
     'take_col_per_row',
     'test_affine_errors',
+    'test_affine_errors_fused',
     'test_annoy',
     'test_cv2_flann',
     'test_homog_errors',
+    'test_homog_errors_fused',
     'test_language_modulus',
     'test_mser',
     'test_ondisk_find_patch_fpath_dominant_orientations',
@@ -13,9 +13,10 @@ def main():  # nocover
 
     from vtool import sver_c_wrapper
 
-    print('sver_c_wrapper.lib_fname = {!r}'.format(sver_c_wrapper.lib_fname))
-    print('sver_c_wrapper.lib_fname_cand = {!r}'.format(sver_c_wrapper.lib_fname_cand))
+    print('sver_c_wrapper.lib_fname = {!r}'.format(sver_c_wrapper.find_lib_fname()))
+    print('sver_c_wrapper.is_available() = {!r}'.format(sver_c_wrapper.is_available()))
     print('sver_c_wrapper.c_sver = {!r}'.format(sver_c_wrapper.c_sver))
+    print('sver_c_wrapper.load_error = {!r}'.format(sver_c_wrapper.load_error))
 
     try:
         import cv2
@@ -3,13 +3,18 @@
 abstract which pyflann implementation is used
 
 from vtool._pyflann_backend import pyflann
+
+Setting the environment variable VTOOL_FLANN_BACKEND=bruteforce makes
+FLANN_CLS the exact BruteForceFLANN search instead.
 """
 import logging
+import os
 
+import numpy as np
 import ubelt as ub
 
 
-__all__ = ['pyflann', 'FLANN_CLS']
+__all__ = ['pyflann', 'FLANN_CLS', 'BruteForceFLANN', 'bruteforce_knn']
 
 
 logger = logging.getLogger('vtool')
@@ -53,5 +58,220 @@ except ImportError:
 
         FLANN_CLS = _DUMMY_FLANN_CLS
 
+
+# Approximate number of bytes of temporary arrays per block of the brute force
+# search
+BRUTEFORCE_MEMORY_BUDGET = 2 ** 27
+
+# Bytes of temporary arrays per distance (dot product, distance, partition
+# indices and flags)
+_BRUTEFORCE_BYTES_PER_DIST = 24
+
+
+def _bruteforce_prepare(vecs):
+    """
+    Returns the vectors as a float array for BLAS and their squared norms.
+
+    The norms of uint8 vectors are int32 and the distances computed from them
+    are exact int32 values.
+    """
+    vecs = np.asarray(vecs)
+    if vecs.dtype == np.uint8:
+        sqrd = (vecs.astype(np.int32) ** 2).sum(axis=1, dtype=np.int32)
+        # Dot products of uint8 vectors are integers, which float32 holds
+        # exactly below 2 ** 24
+        exact32 = vecs.shape[1] * (255 ** 2) < 2 ** 24
+        fvecs = vecs.astype(np.float32 if exact32 else np.float64)
+    else:
+        fvecs = vecs.astype(np.float64)
+        sqrd = (fvecs ** 2).sum(axis=1)
+    return fvecs, sqrd
+
+
+def _bruteforce_dist_sqrd(fvecs1, sqrd1, fvecs2, sqrd2):
+    """
+    Squared L2 distances between the rows of fvecs1 and fvecs2 using
+    ||a||^2 + ||b||^2 - 2ab
+    """
+    dists = fvecs1.dot(fvecs2.T)
+    if sqrd1.dtype.kind == 'i':
+        dists = dists.astype(np.int32)
+    dists *= -2
+    dists += sqrd1[:, None]
+    dists += sqrd2[None, :]
+    if dists.dtype.kind == 'f':
+        # Rounding can make the distance of equal vectors negative
+        np.maximum(dists, 0, out=dists)
+    return dists
+
+
+def _bruteforce_topk(dists, K, offset=0):
+    """
+    The K smallest distances of each row, sorted by distance and then index
+    """
+    num = dists.shape[1]
+    if K < num:
+        part = np.argpartition(dists, K - 1, axis=1)[:, 0:K]
+        part_dist = np.take_along_axis(dists, part, axis=1)
+        # Rows with ties at the K-th distance are fully sorted so the smallest
+        # indices are kept
+        kth_dist = part_dist.max(axis=1)
+        tied = np.flatnonzero((dists <= kth_dist[:, None]).sum(axis=1) > K)
+        if len(tied) > 0:
+            sortx = np.argsort(dists[tied], axis=1, kind='mergesort')[:, 0:K]
+            part[tied] = sortx
+            part_dist[tied] = np.take_along_axis(dists[tied], sortx, axis=1)
+    else:
+        part = np.broadcast_to(np.arange(num), dists.shape)
+        part_dist = dists
+    order = np.lexsort((part, part_dist), axis=-1)
+    idxs = np.take_along_axis(part, order, axis=1).astype(np.int32) + offset
+    return idxs, np.take_along_axis(part_dist, order, axis=1)
+
+
+def bruteforce_knn(dpts, qpts, num_neighbors, memory_budget=None, prepared=None):
+    """
+    Exact K nearest neighbors of qpts in dpts, computed in blocks of query
+    rows so the temporary arrays stay within memory_budget bytes.
+
+    For uint8 descriptors (e.g. SIFT) the squared distances are exact int32
+    values. Ties are broken by index.
+
+    Args:
+        dpts (ndarray): database vectors
+        qpts (ndarray): query vectors
+        num_neighbors (int): number of neighbors (K)
+        memory_budget (int): approximate bytes of temporary arrays per block.
+            Defaults to BRUTEFORCE_MEMORY_BUDGET.
+        prepared (tuple): the result of _bruteforce_prepare(dpts), if known
+
+    Returns:
+        tuple: (qx2_dx, qx2_dist_sqrd), both with shape (len(qpts), K)
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool._pyflann_backend import *  # NOQA
+        >>> import numpy as np
+        >>> rng = np.random.RandomState(0)
+        >>> dpts = rng.randint(0, 256, size=(200, 128)).astype(np.uint8)
+        >>> qpts = rng.randint(0, 256, size=(50, 128)).astype(np.uint8)
+        >>> qx2_dx, qx2_dist = bruteforce_knn(dpts, qpts, 3, memory_budget=1000)
+        >>> assert qx2_dx.dtype == np.int32 and qx2_dist.dtype == np.int32
+        >>> diff = qpts[:, None, :].astype(np.int64) - dpts[None, :, :]
+        >>> dists = (diff ** 2).sum(axis=2)
+        >>> assert np.all(qx2_dx == dists.argsort(axis=1)[:, 0:3])
+        >>> assert np.all(qx2_dist == np.sort(dists, axis=1)[:, 0:3])
+    """
+    if prepared is None:
+        prepared = _bruteforce_prepare(dpts)
+    fdpts, dsqrd = prepared
+    num_data = len(fdpts)
+    K = num_neighbors
+    if K > num_data:
+        raise ValueError(
+            'cannot find %d neighbors in %d indexed points' % (K, num_data)
+        )
+    if memory_budget is None:
+        memory_budget = BRUTEFORCE_MEMORY_BUDGET
+    block_bytes = _BRUTEFORCE_BYTES_PER_DIST * max(1, num_data)
+    blocksize = max(1, int(memory_budget // block_bytes))
+
+    fqpts, qsqrd = _bruteforce_prepare(qpts)
+    num_query = len(fqpts)
+    qx2_dx = np.empty((num_query, K), dtype=np.int32)
+    qx2_dist = np.empty((num_query, K), dtype=dsqrd.dtype)
+    for start in range(0, num_query, blocksize):
+        stop = min(start + blocksize, num_query)
+        dists = _bruteforce_dist_sqrd(
+            fqpts[start:stop], qsqrd[start:stop], fdpts, dsqrd
+        )
+        qx2_dx[start:stop], qx2_dist[start:stop] = _bruteforce_topk(dists, K)
+    return qx2_dx, qx2_dist
+
+
+class BruteForceFLANN(object):
+    """
+    Exact nearest neighbor search with the interface of pyflann.FLANN.
+
+    There is no index structure: build_index keeps the points and nn_index
+    computes all distances with bruteforce_knn. This is fast for the small
+    per-annotation descriptor sets of one-vs-one matching and makes results
+    deterministic. save_index writes nothing, so a cached index is always
+    rebuilt, which only costs a copy of the points.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool._pyflann_backend import *  # NOQA
+        >>> import numpy as np
+        >>> rng = np.random.RandomState(0)
+        >>> dpts = rng.randint(0, 256, size=(100, 128)).astype(np.uint8)
+        >>> flann = BruteForceFLANN()
+        >>> flann.build_index(dpts, algorithm='kdtree', trees=8)
+        >>> qx2_dx, qx2_dist = flann.nn_index(dpts[0:10], 2, checks=20)
+        >>> assert np.all(qx2_dx.T[0] == np.arange(10))
+        >>> assert np.all(qx2_dist.T[0] == 0)
+        >>> qx2_dx, qx2_dist = flann.nn_index(dpts[0:10], 1)
+        >>> assert qx2_dx.shape == (10,)
+    """
+
+    def __init__(self, memory_budget=None, **kwargs):
+        self.memory_budget = memory_budget
+        self.params = {}
+        self._pts = None
+        self._prepared = None
+
+    def build_index(self, pts, **flann_params):
+        self._pts = np.asarray(pts)
+        self._prepared = _bruteforce_prepare(self._pts)
+        self.params = dict(flann_params)
+        return self.params
+
+    def add_points(self, pts, rebuild_threshold=2.0):
+        if self._pts is None:
+            self.build_index(pts)
+        else:
+            self.build_index(np.vstack([self._pts, pts]), **self.params)
+
+    def delete_index(self, **kwargs):
+        self._pts = None
+        self._prepared = None
+
+    def save_index(self, filename):
+        pass
+
+    def load_index(self, filename, pts):
+        self.build_index(pts)
+
+    def get_indexed_shape(self):
+        if self._pts is None:
+            return (0, 0)
+        return self._pts.shape
+
+    def nn_index(self, qpts, num_neighbors=1, **kwargs):
+        if self._pts is None:
+            raise ValueError('build_index must be called before nn_index')
+        qpts = np.asarray(qpts)
+        if qpts.ndim == 1:
+            qpts = qpts[None, :]
+        qx2_dx, qx2_dist = bruteforce_knn(
+            self._pts,
+            qpts,
+            num_neighbors,
+            memory_budget=self.memory_budget,
+            prepared=self._prepared,
+        )
+        if num_neighbors == 1:
+            # like pyflann, a single neighbor is returned as flat arrays
+            return qx2_dx.ravel(), qx2_dist.ravel()
+        return qx2_dx, qx2_dist
+
+    def nn(self, pts, qpts, num_neighbors=1, **kwargs):
+        self.build_index(pts, **kwargs)
+        return self.nn_index(qpts, num_neighbors)
+
+
+if os.environ.get('VTOOL_FLANN_BACKEND', '').lower() == 'bruteforce':
+    FLANN_CLS = BruteForceFLANN
+
 logger.debug('VTOOL BACKEND FOR pyflann = {!r}'.format(pyflann))
 logger.debug('VTOOL BACKEND FOR FLANN_CLS = {!r}'.format(FLANN_CLS))
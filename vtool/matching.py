@@ -44,6 +44,7 @@ VSONE_ASSIGN_CONFIG = [
     ut.ParamInfo('weight', None, valid_values=[None, 'fgweights'],),
     ut.ParamInfo('K', 1, min_=1),
     ut.ParamInfo('Knorm', 1, min_=1),
+    ut.ParamInfo('nn_backend', 'auto', valid_values=['auto', 'flann', 'bruteforce']),
 ]
 
 VSONE_RATIO_CONFIG = [
@@ -57,7 +58,7 @@ VSONE_SVER_CONFIG = [
     ut.ParamInfo(
         'refine_method',
         'homog',
-        valid_values=['homog', 'affine'],
+        valid_values=['homog', 'homog-iter', 'affine'],
         hideif=lambda cfg: not cfg['sv_on'],
     ),
     ut.ParamInfo(
@@ -96,6 +97,11 @@ VSONE_DEFAULT_CONFIG = VSONE_ASSIGN_CONFIG + VSONE_RATIO_CONFIG + VSONE_SVER_CON
 
 VSONE_PI_DICT = {pi.varname: pi for pi in VSONE_DEFAULT_CONFIG}
 
+# Version of the PairwiseMatch.compact_state format
+COMPACT_STATE_VERSION = 1
+# Scores and local measures are stored with this precision in compact states
+COMPACT_MEASURE_DTYPE = np.float32
+
 
 def demodata_match(cfgdict={}, apply=True, use_cache=True, recompute=False):
     import vtool as vt
@@ -203,6 +209,8 @@ class PairwiseMatch(ub.NiceRepr):
         match.local_measures = ub.odict([])
         match.global_measures = ub.odict([])
         match._inplace_default = False
+        # If True, pickle with the smaller state of compact_state
+        match.compact_pickle = False
 
     @staticmethod
     def _available_params():
@@ -241,7 +249,12 @@ class PairwiseMatch(ub.NiceRepr):
 
         This means that if you need properties of annots, you must reapply
         them after you load a PairwiseMatch object.
+
+        If match.compact_pickle is True, the state is the smaller
+        :func:`PairwiseMatch.compact_state` instead.
         """
+        if getattr(match, 'compact_pickle', False):
+            return match.compact_state()
 
         def _prepare_annot(annot):
             if isinstance(annot, ut.LazyDict):
@@ -267,9 +280,107 @@ class PairwiseMatch(ub.NiceRepr):
         return state
 
     def __setstate__(match, state):
+        if 'compact_version' in state:
+            state = _expand_compact_state(state)
         match.__dict__.update(state)
         match.verbose = False
 
+    def compact_state(match, measure_dtype=COMPACT_MEASURE_DTYPE):
+        """
+        A smaller version of the pickle state.
+
+        * annotations are only referenced by their aid
+        * fm is stored as int32 when its indices fit
+        * fs and the floating point local measures are stored as
+          measure_dtype, packed into a single (num_measures, len(fm)) array
+
+        The state only contains a few large arrays, so pickle protocol 5
+        can send them as out of band buffers without copying them. Loading
+        the state restores the same fields and dtypes as the default state.
+        Everything except fs and the local measures is restored exactly.
+
+        Args:
+            measure_dtype (dtype): dtype of the stored scores and measures.
+                None keeps their precision.
+
+        Example:
+            >>> # ENABLE_DOCTEST
+            >>> from vtool.matching import *  # NOQA
+            >>> import pickle
+            >>> match = PairwiseMatch({'aid': 1}, {'aid': 2})
+            >>> match.fm = np.arange(2000).reshape(1000, 2)
+            >>> match.fs = np.random.RandomState(0).rand(1000)
+            >>> match.H_12 = np.eye(3)
+            >>> match.local_measures['ratio'] = 1 - match.fs
+            >>> match.local_measures['match_dist'] = match.fs * 100
+            >>> full_data = pickle.dumps(match, protocol=2)
+            >>> match.compact_pickle = True
+            >>> data = pickle.dumps(match, protocol=2)
+            >>> match2 = pickle.loads(data)
+            >>> assert len(data) < len(full_data) / 2
+            >>> assert np.all(match2.fm == match.fm)
+            >>> assert match2.fm.dtype == match.fm.dtype
+            >>> assert np.allclose(match2.local_measures['ratio'],
+            >>>                    match.local_measures['ratio'], atol=1e-7)
+            >>> print(list(match2.local_measures.keys()), match2.annot1)
+            ['ratio', 'match_dist'] {'aid': 1}
+        """
+
+        def _annot_ref(annot):
+            return {'aid': annot['aid']} if 'aid' in annot else {}
+
+        def _pack(arr):
+            return arr if measure_dtype is None else arr.astype(measure_dtype)
+
+        fm = match.fm
+        fm_dtype = None
+        if fm is not None:
+            fm_dtype = fm.dtype.str
+            if fm.size == 0 or fm.max() <= np.iinfo(np.int32).max:
+                fm = fm.astype(np.int32)
+        fs = match.fs
+        fs_dtype = None
+        if fs is not None:
+            fs_dtype = fs.dtype.str
+            fs = _pack(fs)
+        num = 0 if match.fm is None else len(match.fm)
+        local_keys = list(match.local_measures.keys())
+        # Floating point measures with one value per match are packed together
+        packed_keys = [
+            key
+            for key, val in match.local_measures.items()
+            if isinstance(val, np.ndarray)
+            and val.shape == (num,)
+            and np.issubdtype(val.dtype, np.floating)
+        ]
+        packed_dtypes = [match.local_measures[key].dtype.str for key in packed_keys]
+        if measure_dtype is None:
+            measure_dtype_ = np.result_type(*packed_dtypes) if packed_keys else None
+        else:
+            measure_dtype_ = measure_dtype
+        packed = np.empty((len(packed_keys), num), dtype=measure_dtype_)
+        for row, key in zip(packed, packed_keys):
+            row[:] = match.local_measures[key]
+        other_measures = ub.dict_diff(match.local_measures, packed_keys)
+        state = {
+            'compact_version': COMPACT_STATE_VERSION,
+            'annot1': _annot_ref(match.annot1),
+            'annot2': _annot_ref(match.annot2),
+            'fm': fm,
+            'fm_dtype': fm_dtype,
+            'fs': fs,
+            'fs_dtype': fs_dtype,
+            'H_21': match.H_21,
+            'H_12': match.H_12,
+            'global_measures': match.global_measures,
+            'local_keys': local_keys,
+            'packed_keys': packed_keys,
+            'packed_dtypes': packed_dtypes,
+            'packed_measures': packed,
+            'other_measures': dict(other_measures),
+        }
+        return state
+
     def show(
         match,
         ax=None,
@@ -476,10 +587,10 @@ class PairwiseMatch(ub.NiceRepr):
                 match.assign()
         """
         params = match._take_params(
-            cfgdict, ['K', 'Knorm', 'symmetric', 'checks', 'weight']
+            cfgdict, ['K', 'Knorm', 'symmetric', 'checks', 'weight', 'nn_backend']
         )
         params = list(params)
-        K, Knorm, symmetric, checks, weight_key = params
+        K, Knorm, symmetric, checks, weight_key, nn_backend = params
         annot1 = match.annot1
         annot2 = match.annot2
 
@@ -493,12 +604,25 @@ class PairwiseMatch(ub.NiceRepr):
 
         # Search for nearest neighbors
         if symmetric:
-            tup = symmetric_correspondence(annot1, annot2, K, Knorm, checks, allow_shrink)
+            tup = symmetric_correspondence(
+                annot1, annot2, K, Knorm, checks, allow_shrink, nn_backend
+            )
         else:
             tup = asymmetric_correspondence(
-                annot1, annot2, K, Knorm, checks, allow_shrink
+                annot1, annot2, K, Knorm, checks, allow_shrink, nn_backend
             )
         fm, match_dist, norm_dist, fx1_norm, fx2_norm = tup
+        match._set_assignment(fm, match_dist, norm_dist, fx1_norm, fx2_norm, weight_key)
+        return match
+
+    def _set_assignment(
+        match, fm, match_dist, norm_dist, fx1_norm, fx2_norm, weight_key=None
+    ):
+        """
+        Sets the correspondences and the local measures computed by assign
+        """
+        annot1 = match.annot1
+        annot2 = match.annot2
 
         ratio = np.divide(match_dist, norm_dist)
         # convert so bigger is better
@@ -562,10 +686,7 @@ class PairwiseMatch(ub.NiceRepr):
         from vtool import spatial_verification as sver
         import vtool as vt
 
-        def _run_sver(kpts1, kpts2, fm, match_weights, **sver_kw):
-            svtup = sver.spatially_verify_kpts(
-                kpts1, kpts2, fm, match_weights=match_weights, **sver_kw
-            )
+        def _unpack_svtup(svtup):
             if svtup is None:
                 errors = [np.empty(0), np.empty(0), np.empty(0)]
                 inliers = []
@@ -575,6 +696,12 @@ class PairwiseMatch(ub.NiceRepr):
             svtup = (inliers, errors, H_12)
             return svtup
 
+        def _run_sver(kpts1, kpts2, fm, match_weights, **sver_kw):
+            svtup = sver.spatially_verify_kpts(
+                kpts1, kpts2, fm, match_weights=match_weights, **sver_kw
+            )
+            return _unpack_svtup(svtup)
+
         (
             sver_xy_thresh,
             sver_ori_thresh,
@@ -595,6 +722,9 @@ class PairwiseMatch(ub.NiceRepr):
         kpts1 = match.annot1['kpts']
         kpts2 = match.annot2['kpts']
         dlen_sqrd2 = match.annot2['dlen_sqrd']
+        # Reuse the keypoint matrices of annotations that are in many pairs
+        ensure_metadata_kpts_mats(match.annot1)
+        ensure_metadata_kpts_mats(match.annot2)
 
         sver_kw = dict(
             xy_thresh=sver_xy_thresh,
@@ -602,6 +732,8 @@ class PairwiseMatch(ub.NiceRepr):
             scale_thresh=sver_scale_thresh,
             refine_method=refine_method,
             dlen_sqrd2=dlen_sqrd2,
+            kpts1_mats=match.annot1['kpts_mats'],
+            kpts2_mats=match.annot2['kpts_mats'],
         )
 
         if thresh_bins:
@@ -619,22 +751,35 @@ class PairwiseMatch(ub.NiceRepr):
             agg_H_12 = None
             prev_best = 50
 
+            # The bins are nested: a match passes every threshold above its
+            # ratio. Verify all bins at once so each affine hypothesis is only
+            # tested once.
+            ratio = match.local_measures['ratio']
+            sorted_bins = sorted(set(thresh_bins))
+            match_levels = np.searchsorted(sorted_bins, ratio, side='right')
+            level_svtups = sver.spatially_verify_kpts_nested(
+                kpts1,
+                kpts2,
+                match.fm,
+                match_levels,
+                len(sorted_bins),
+                match_weights=match.fs,
+                **sver_kw
+            )
+
             for thresh in thresh_bins:
-                ratio = match.local_measures['ratio']
+                level = sorted_bins.index(thresh)
 
                 # These are of len(match.fm)=1000
                 # 100 of these are True
-                ratio_flags = ratio < thresh
+                ratio_flags = match_levels <= level
                 ratio_idxs = np.where(ratio_flags)[0]
 
                 if len(ratio_idxs) == 0:
                     continue
 
-                # Filter matches at this level of the ratio test
-                fm = match.fm[ratio_flags]
-                match_weights = match.fs[ratio_flags]
-
-                svtup = _run_sver(kpts1, kpts2, fm, match_weights, **sver_kw)
+                # The matches at this level of the ratio test
+                svtup = _unpack_svtup(level_svtups[level])
                 (inliers, errors, H_12) = svtup
                 n_inliers = len(inliers)
 
@@ -720,64 +865,7 @@ class PairwiseMatch(ub.NiceRepr):
 
     def _make_global_feature_vector(match, global_keys=None):
         """ Global annotation properties and deltas """
-        import vtool as vt
-
-        feat = ut.odict([])
-
-        if global_keys is None:
-            # speed should need to be requested
-            global_keys = sorted(match.global_measures.keys())
-        global_measures = ut.dict_subset(match.global_measures, global_keys)
-
-        for k, v in global_measures.items():
-            v1, v2 = v
-            if v1 is None:
-                v1 = np.nan
-            if v2 is None:
-                v2 = np.nan
-            if ut.isiterable(v1):
-                for i in range(len(v1)):
-                    feat['global({}_1[{}])'.format(k, i)] = v1[i]
-                    feat['global({}_2[{}])'.format(k, i)] = v2[i]
-                if k == 'gps':
-                    delta = vt.haversine(v1, v2)
-                else:
-                    delta = np.abs(v1 - v2)
-            else:
-                feat['global({}_1)'.format(k)] = v1
-                feat['global({}_2)'.format(k)] = v2
-                # if k == 'yaw':
-                #     # delta = vt.ori_distance(v1, v2)
-                #     delta = vt.cyclic_distance(v1, v2, modulo=vt.TAU)
-                if k == 'view':
-                    delta = _rhomb_dist.VIEW_INT_DIST[(v1, v2)]
-                    # delta = vt.cyclic_distance(v1, v2, modulo=8)
-                else:
-                    delta = np.abs(v1 - v2)
-            feat['global(delta_{})'.format(k)] = delta
-            assert k != 'yaw', 'yaw is depricated'
-
-        # Impose ordering on these keys to add symmetry
-        keys_to_order = ['qual', 'view']
-        for key in keys_to_order:
-            k1 = 'global({}_1)'.format(key)
-            k2 = 'global({}_2)'.format(key)
-            if k1 in feat and k2 in feat:
-                minv, maxv = np.sort([feat[k1], feat[k2]])
-                feat['global(min_{})'.format(key)] = minv
-                feat['global(max_{})'.format(key)] = maxv
-
-        if 'global(delta_gps)' in feat and 'global(delta_time)' in feat:
-            hour_delta = feat['global(delta_time)'] / 360
-            km_delta = feat['global(delta_gps)']
-            if hour_delta == 0:
-                if km_delta == 0:
-                    feat['global(speed)'] = 0
-                else:
-                    feat['global(speed)'] = np.nan
-            else:
-                feat['global(speed)'] = km_delta / hour_delta
-        return feat
+        return _global_feature_vector(match.global_measures, global_keys)
 
     def _make_local_summary_feature_vector(
         match, local_keys=None, summary_ops=None, bin_key=None, bins=None
@@ -964,6 +1052,997 @@ class PairwiseMatch(ub.NiceRepr):
         return feat
 
 
+def _expand_compact_state(state):
+    """ Converts a PairwiseMatch.compact_state to the default state """
+    if state['compact_version'] != COMPACT_STATE_VERSION:
+        raise ValueError(
+            'Unknown compact PairwiseMatch state version {}'.format(
+                state['compact_version']
+            )
+        )
+    fm = state['fm']
+    if fm is not None:
+        fm = fm.astype(np.dtype(state['fm_dtype']))
+    fs = state['fs']
+    if fs is not None:
+        fs = fs.astype(np.dtype(state['fs_dtype']))
+    local_measures = dict(state['other_measures'])
+    packed_items = zip(
+        state['packed_keys'], state['packed_dtypes'], state['packed_measures']
+    )
+    for key, dtype, row in packed_items:
+        local_measures[key] = row.astype(np.dtype(dtype))
+    local_measures = ub.odict(
+        [(key, local_measures[key]) for key in state['local_keys']]
+    )
+    expanded = {
+        'annot1': state['annot1'],
+        'annot2': state['annot2'],
+        'fm': fm,
+        'fs': fs,
+        'H_21': state['H_21'],
+        'H_12': state['H_12'],
+        'global_measures': state['global_measures'],
+        'local_measures': local_measures,
+        'compact_pickle': True,
+    }
+    return expanded
+
+
+def _global_feature_vector(global_measures, global_keys=None):
+    """ Global annotation properties and deltas of one pair """
+    import vtool as vt
+
+    feat = ut.odict([])
+
+    if global_keys is None:
+        # speed should need to be requested
+        global_keys = sorted(global_measures.keys())
+    global_measures = ut.dict_subset(global_measures, global_keys)
+
+    for k, v in global_measures.items():
+        v1, v2 = v
+        if v1 is None:
+            v1 = np.nan
+        if v2 is None:
+            v2 = np.nan
+        if ut.isiterable(v1):
+            for i in range(len(v1)):
+                feat['global({}_1[{}])'.format(k, i)] = v1[i]
+                feat['global({}_2[{}])'.format(k, i)] = v2[i]
+            if k == 'gps':
+                delta = vt.haversine(v1, v2)
+            else:
+                delta = np.abs(v1 - v2)
+        else:
+            feat['global({}_1)'.format(k)] = v1
+            feat['global({}_2)'.format(k)] = v2
+            # if k == 'yaw':
+            #     # delta = vt.ori_distance(v1, v2)
+            #     delta = vt.cyclic_distance(v1, v2, modulo=vt.TAU)
+            if k == 'view':
+                delta = _rhomb_dist.VIEW_INT_DIST[(v1, v2)]
+                # delta = vt.cyclic_distance(v1, v2, modulo=8)
+            else:
+                delta = np.abs(v1 - v2)
+        feat['global(delta_{})'.format(k)] = delta
+        assert k != 'yaw', 'yaw is depricated'
+
+    # Impose ordering on these keys to add symmetry
+    keys_to_order = ['qual', 'view']
+    for key in keys_to_order:
+        k1 = 'global({}_1)'.format(key)
+        k2 = 'global({}_2)'.format(key)
+        if k1 in feat and k2 in feat:
+            minv, maxv = np.sort([feat[k1], feat[k2]])
+            feat['global(min_{})'.format(key)] = minv
+            feat['global(max_{})'.format(key)] = maxv
+
+    if 'global(delta_gps)' in feat and 'global(delta_time)' in feat:
+        hour_delta = feat['global(delta_time)'] / 360
+        km_delta = feat['global(delta_gps)']
+        if hour_delta == 0:
+            if km_delta == 0:
+                feat['global(speed)'] = 0
+            else:
+                feat['global(speed)'] = np.nan
+        else:
+            feat['global(speed)'] = km_delta / hour_delta
+    return feat
+
+
+def _global_feature_columns(global_measures_list, global_keys):
+    """
+    The features of :func:`_global_feature_vector` for many pairs at once, as
+    an odict of arrays with one value per pair. Pairs without a measure (or
+    with a None value) get nan, and the delta of an iterable measure is only
+    defined for gps.
+    """
+    import vtool as vt
+
+    num_pairs = len(global_measures_list)
+    feat = ut.odict([])
+    for k in sorted(global_keys):
+        pair_vals = [gm.get(k, (None, None)) for gm in global_measures_list]
+        example = next((v for v in ub.flatten(pair_vals) if v is not None), np.nan)
+        if ut.isiterable(example):
+            shape = (len(example),)
+        else:
+            shape = ()
+        nan_val = np.full(shape, np.nan)
+        arrs = [
+            np.array(
+                [nan_val if v[ix] is None else v[ix] for v in pair_vals], dtype=float
+            ).reshape((num_pairs,) + shape)
+            for ix in [0, 1]
+        ]
+        v1, v2 = arrs
+        if shape:
+            for i in range(shape[0]):
+                feat['global({}_1[{}])'.format(k, i)] = v1[:, i]
+                feat['global({}_2[{}])'.format(k, i)] = v2[:, i]
+            if k == 'gps':
+                feat['global(delta_{})'.format(k)] = vt.haversine(v1.T, v2.T)
+        else:
+            feat['global({}_1)'.format(k)] = v1
+            feat['global({}_2)'.format(k)] = v2
+            if k == 'view':
+                delta = [
+                    _rhomb_dist.VIEW_INT_DIST.get((a, b), np.nan)
+                    for a, b in zip(v1, v2)
+                ]
+                delta = np.array(delta, dtype=float)
+            else:
+                delta = np.abs(v1 - v2)
+            feat['global(delta_{})'.format(k)] = delta
+
+    # Impose ordering on these keys to add symmetry (np.sort puts nan last)
+    keys_to_order = ['qual', 'view']
+    for key in keys_to_order:
+        k1 = 'global({}_1)'.format(key)
+        k2 = 'global({}_2)'.format(key)
+        if k1 in feat and k2 in feat:
+            feat['global(min_{})'.format(key)] = np.fmin(feat[k1], feat[k2])
+            feat['global(max_{})'.format(key)] = np.maximum(feat[k1], feat[k2])
+
+    if 'global(delta_gps)' in feat and 'global(delta_time)' in feat:
+        hour_delta = feat['global(delta_time)'] / 360
+        km_delta = feat['global(delta_gps)']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = km_delta / hour_delta
+        speed[hour_delta == 0] = np.where(km_delta[hour_delta == 0] == 0, 0, np.nan)
+        feat['global(speed)'] = speed
+    return feat
+
+
+def _segment_median(vals, pair_ids, offsets):
+    """ np.median of each contiguous segment of vals (nan for empty ones) """
+    counts = np.diff(offsets)
+    sorted_vals = vals[np.lexsort((vals, pair_ids))]
+    meds = np.full(len(counts), np.nan)
+    nonempty = counts > 0
+    lo = offsets[:-1][nonempty] + (counts[nonempty] - 1) // 2
+    hi = offsets[:-1][nonempty] + counts[nonempty] // 2
+    meds[nonempty] = (sorted_vals[lo] + sorted_vals[hi]) / 2
+    return meds
+
+
+def _segment_sum_ops(vals, pair_ids, offsets, opnames):
+    """
+    Computes the SUM_OPS named by opnames over each pair's segment of vals
+    at once. Empty segments give the same values as the numpy functions
+    (0 for sums and nan otherwise).
+    """
+    num_pairs = len(offsets) - 1
+    counts = np.diff(offsets)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sums = np.bincount(pair_ids, weights=vals, minlength=num_pairs)
+        means = sums / counts
+        results = {}
+        for opname in opnames:
+            if opname == 'sum':
+                results[opname] = sums
+            elif opname == 'mean':
+                results[opname] = means
+            elif opname == 'std':
+                devs = vals - means[pair_ids]
+                sqrd_devs = np.bincount(
+                    pair_ids, weights=devs ** 2, minlength=num_pairs
+                )
+                results[opname] = np.sqrt(sqrd_devs / counts)
+            elif opname == 'invsum':
+                results[opname] = np.bincount(
+                    pair_ids, weights=1 / vals, minlength=num_pairs
+                )
+            elif opname == 'med':
+                results[opname] = _segment_median(vals, pair_ids, offsets)
+            else:
+                raise KeyError('Unknown summary op {!r}'.format(opname))
+    return results
+
+
+class PairwiseMatchSet(ub.NiceRepr):
+    """
+    The results of many PairwiseMatch objects stored as a struct of arrays.
+
+    The matches of all pairs are concatenated, so pair ``px`` owns rows
+    ``offsets[px]:offsets[px + 1]`` of ``fm``, ``fs``, and every array in
+    ``local_measures``. Row operations (compress, take, the ratio test) and
+    summary feature vectors are computed for all pairs at once instead of
+    looping over match objects.
+
+    Per pair attributes (the annotations, homographies, and global measures)
+    are kept in lists.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> matches = []
+        >>> for aid2, num in enumerate([5, 0, 3], start=2):
+        >>>     match = PairwiseMatch({'aid': 1}, {'aid': aid2})
+        >>>     match.fm = rng.randint(0, 10, size=(num, 2))
+        >>>     match.fs = rng.rand(num)
+        >>>     match.local_measures['ratio'] = rng.rand(num)
+        >>>     matches.append(match)
+        >>> mset = PairwiseMatchSet.from_matches(matches)
+        >>> print(mset)
+        <PairwiseMatchSet(3 pairs, 8 matches)>
+        >>> mset2 = mset.apply_ratio_test({'ratio_thresh': .5})
+        >>> matches2 = [m.apply_ratio_test({'ratio_thresh': .5}) for m in matches]
+        >>> assert np.all(mset2.counts == list(map(len, matches2)))
+        >>> assert np.all(mset2[2].fm == matches2[2].fm)
+        >>> feats = mset.make_feature_vector(indices=2)
+        >>> feat = matches[0].make_feature_vector(indices=2)
+        >>> row = feats.loc[0, list(feat.keys())]
+        >>> assert np.allclose(row.values, list(feat.values()))
+    """
+
+    def __init__(
+        mset,
+        fm,
+        fs,
+        offsets,
+        local_measures=None,
+        annot1_list=None,
+        annot2_list=None,
+        H_12_list=None,
+        H_21_list=None,
+        global_measures_list=None,
+    ):
+        num_pairs = len(offsets) - 1
+        mset.fm = fm
+        mset.fs = fs
+        mset.offsets = np.asarray(offsets, dtype=np.int64)
+        if local_measures is None:
+            local_measures = ub.odict([])
+        mset.local_measures = local_measures
+        mset.annot1_list = [None] * num_pairs if annot1_list is None else annot1_list
+        mset.annot2_list = [None] * num_pairs if annot2_list is None else annot2_list
+        mset.H_12_list = [None] * num_pairs if H_12_list is None else H_12_list
+        mset.H_21_list = [None] * num_pairs if H_21_list is None else H_21_list
+        if global_measures_list is None:
+            global_measures_list = [ub.odict([]) for _ in range(num_pairs)]
+        mset.global_measures_list = global_measures_list
+        # The pair that owns each row
+        mset.pair_ids = np.repeat(np.arange(num_pairs), mset.counts)
+
+    @classmethod
+    def from_matches(PairwiseMatchSet, matches):
+        """
+        Concatenates the results of PairwiseMatch objects. A match without
+        results (fm is None) becomes a pair with no matches. All matches must
+        have the same local measures.
+        """
+        counts = [len(match) for match in matches]
+        offsets = np.zeros(len(matches) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        has_fm = [match for match in matches if match.fm is not None]
+        if len(has_fm) == 0:
+            fm = np.empty((0, 2), dtype=np.int64)
+            fs = np.empty(0)
+            local_keys = []
+        else:
+            fm = np.vstack([match.fm for match in has_fm])
+            fs = np.hstack([match.fs for match in has_fm])
+            local_keys = list(has_fm[0].local_measures.keys())
+        local_measures = ub.odict([])
+        for key in local_keys:
+            parts = []
+            for match in has_fm:
+                if list(match.local_measures.keys()) != local_keys:
+                    raise ValueError('All matches must have the same local measures')
+                parts.append(match.local_measures[key])
+            local_measures[key] = np.hstack(parts)
+        mset = PairwiseMatchSet(
+            fm,
+            fs,
+            offsets,
+            local_measures,
+            annot1_list=[match.annot1 for match in matches],
+            annot2_list=[match.annot2 for match in matches],
+            H_12_list=[match.H_12 for match in matches],
+            H_21_list=[match.H_21 for match in matches],
+            global_measures_list=[match.global_measures for match in matches],
+        )
+        return mset
+
+    def __nice__(mset):
+        return '{} pairs, {} matches'.format(len(mset), mset.num_matches)
+
+    def __len__(mset):
+        return len(mset.offsets) - 1
+
+    @property
+    def num_matches(mset):
+        return int(mset.offsets[-1])
+
+    @property
+    def counts(mset):
+        """ number of matches in each pair """
+        return np.diff(mset.offsets)
+
+    def __getitem__(mset, px):
+        """
+        The PairwiseMatch of pair px. Its arrays are views into this set.
+        """
+        start, stop = mset.offsets[px], mset.offsets[px + 1]
+        match = PairwiseMatch(mset.annot1_list[px], mset.annot2_list[px])
+        match.fm = mset.fm[start:stop]
+        match.fs = mset.fs[start:stop]
+        match.H_12 = mset.H_12_list[px]
+        match.H_21 = mset.H_21_list[px]
+        match.global_measures = mset.global_measures_list[px]
+        match.local_measures = ub.map_vals(
+            lambda a: a[start:stop], mset.local_measures
+        )
+        return match
+
+    def to_matches(mset):
+        """ Splits the set into PairwiseMatch objects """
+        return [mset[px] for px in range(len(mset))]
+
+    def _from_rows(mset, rowxs, counts):
+        """ A new set with the given rows, which must be grouped by pair """
+        offsets = np.zeros(len(mset) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        mset_ = PairwiseMatchSet(
+            mset.fm.take(rowxs, axis=0),
+            mset.fs.take(rowxs, axis=0),
+            offsets,
+            ub.map_vals(lambda a: a.take(rowxs), mset.local_measures),
+            annot1_list=mset.annot1_list,
+            annot2_list=mset.annot2_list,
+            H_12_list=mset.H_12_list,
+            H_21_list=mset.H_21_list,
+            global_measures_list=mset.global_measures_list,
+        )
+        return mset_
+
+    def compress(mset, flags):
+        """ Keeps the matches (over all pairs) where flags is True """
+        flags = np.asarray(flags, dtype=np.bool_)
+        counts = np.bincount(mset.pair_ids[flags], minlength=len(mset))
+        return mset._from_rows(np.where(flags)[0], counts)
+
+    def take(mset, indices):
+        """
+        Keeps the matches at the given row indices (over all pairs). Rows are
+        regrouped by pair, keeping their given order within each pair.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        pair_ids = mset.pair_ids.take(indices)
+        sortx = np.argsort(pair_ids, kind='stable')
+        counts = np.bincount(pair_ids, minlength=len(mset))
+        return mset._from_rows(indices.take(sortx), counts)
+
+    def take_pairs(mset, pxs):
+        """ A new set with only the pairs pxs, in that order """
+        pxs = np.asarray(pxs, dtype=np.int64)
+        counts = mset.counts.take(pxs)
+        offsets = np.zeros(len(pxs) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        starts = mset.offsets.take(pxs)
+        # row index of every match of every chosen pair
+        rowxs = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        mset_ = PairwiseMatchSet(
+            mset.fm.take(rowxs, axis=0),
+            mset.fs.take(rowxs, axis=0),
+            offsets,
+            ub.map_vals(lambda a: a.take(rowxs), mset.local_measures),
+            annot1_list=ut.take(mset.annot1_list, pxs),
+            annot2_list=ut.take(mset.annot2_list, pxs),
+            H_12_list=ut.take(mset.H_12_list, pxs),
+            H_21_list=ut.take(mset.H_21_list, pxs),
+            global_measures_list=ut.take(mset.global_measures_list, pxs),
+        )
+        return mset_
+
+    def ratio_test_flags(mset, cfgdict={}):
+        (ratio_thresh,) = PairwiseMatch._take_params(cfgdict, ['ratio_thresh'])
+        return mset.local_measures['ratio'] < ratio_thresh
+
+    def apply_ratio_test(mset, cfgdict={}):
+        return mset.compress(mset.ratio_test_flags(cfgdict))
+
+    def _make_global_feature_vector(mset, global_keys=None):
+        """ Global features of every pair as a list of dicts """
+        return [
+            _global_feature_vector(global_measures, global_keys)
+            for global_measures in mset.global_measures_list
+        ]
+
+    def _make_local_summary_feature_vector(
+        mset, local_keys=None, summary_ops=None, bin_key=None, bins=None
+    ):
+        """
+        The columns of PairwiseMatch._make_local_summary_feature_vector for
+        every pair at once, as an odict of arrays with one value per pair.
+        """
+        if summary_ops is None:
+            summary_ops = {'sum', 'mean', 'std', 'len'}
+        if summary_ops == 'all':
+            summary_ops = set(SUM_OPS.keys()).union({'len'})
+        opnames = sorted(set(summary_ops) - {'len'})
+
+        if local_keys is None:
+            local_measures = mset.local_measures
+        else:
+            local_measures = ut.dict_subset(mset.local_measures, local_keys)
+
+        feat = ut.odict([])
+        if bin_key is not None:
+            if bins is None:
+                raise ValueError('must choose bins')
+            if isinstance(bins, int):
+                bins = np.linspace(0, 1.0, bins + 1)
+            else:
+                bins = list(bins)
+            bin_ids = np.searchsorted(bins, mset.local_measures[bin_key])
+            dimkey_fmt = '{opname}({measure}[{bin_key}<{binval}])'
+            for binid, binval in enumerate(bins, start=1):
+                sub = mset.compress(bin_ids <= binid)
+                sub_measures = ut.dict_subset(sub.local_measures, local_measures.keys())
+                if 'len' in summary_ops:
+                    dimkey = dimkey_fmt.format(
+                        opname='len', measure='matches', bin_key=bin_key, binval=binval,
+                    )
+                    feat[dimkey] = sub.counts
+                results = {
+                    k: _segment_sum_ops(vs, sub.pair_ids, sub.offsets, opnames)
+                    for k, vs in sub_measures.items()
+                }
+                for opname in opnames:
+                    for k in sub_measures.keys():
+                        dimkey = dimkey_fmt.format(
+                            opname=opname, measure=k, bin_key=bin_key, binval=binval,
+                        )
+                        feat[dimkey] = results[k][opname]
+        else:
+            dimkey_fmt = '{opname}({measure})'
+            if 'len' in summary_ops:
+                dimkey = dimkey_fmt.format(opname='len', measure='matches')
+                feat[dimkey] = mset.counts
+            results = {
+                k: _segment_sum_ops(vs, mset.pair_ids, mset.offsets, opnames)
+                for k, vs in local_measures.items()
+            }
+            for opname in opnames:
+                for k in local_measures.keys():
+                    dimkey = dimkey_fmt.format(opname=opname, measure=k)
+                    feat[dimkey] = results[k][opname]
+        return feat
+
+    def _make_local_top_feature_vector(
+        mset, local_keys=None, sorters='ratio', indices=3
+    ):
+        """
+        The columns of PairwiseMatch._make_local_top_feature_vector for every
+        pair at once. Pairs without a match at a rank get nan. Matches with
+        tied sorter values are ranked in their row order.
+        """
+        if local_keys is None:
+            local_measures = mset.local_measures
+        else:
+            local_measures = ut.dict_subset(mset.local_measures, local_keys)
+        counts = mset.counts
+        max_count = counts.max() if len(counts) else 0
+        if isinstance(indices, int):
+            indices = slice(indices)
+        if isinstance(indices, slice):
+            if any(i is not None and i < 0 for i in [indices.start, indices.stop]):
+                raise ValueError('slices of ranks must be non-negative')
+            indices = list(range(*indices.indices(max_count)))
+        sorters = ut.ensure_iterable(sorters)
+        loc_fmt = 'loc[{sorter},{rank}]({measure})'
+        feat = ut.odict([])
+        for sorter in sorters:
+            # Rows of each pair in descending order of the sorter
+            sortx = np.lexsort((-mset.local_measures[sorter], mset.pair_ids))
+            for k, vs in local_measures.items():
+                sorted_vs = vs.take(sortx)
+                for rank in indices:
+                    pos = np.full(len(mset), rank) if rank >= 0 else counts + rank
+                    valid = (pos >= 0) & (pos < counts)
+                    col = np.full(len(mset), np.nan)
+                    col[valid] = sorted_vs[mset.offsets[:-1][valid] + pos[valid]]
+                    feat[loc_fmt.format(sorter=sorter, rank=rank, measure=k)] = col
+        return feat
+
+    def make_feature_vector(
+        mset,
+        local_keys=None,
+        global_keys=None,
+        summary_ops=None,
+        sorters='ratio',
+        indices=3,
+        bin_key=None,
+        bins=None,
+    ):
+        """
+        The feature vectors of :func:`PairwiseMatch.make_feature_vector` for
+        every pair.
+
+        Returns:
+            pd.DataFrame: one row per pair, with a column per feature
+                dimension (nan where a pair does not have one)
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            global_df = pd.DataFrame(
+                mset._make_global_feature_vector(global_keys), index=range(len(mset))
+            )
+            local_feat = mset._make_local_summary_feature_vector(
+                local_keys, summary_ops, bin_key=bin_key, bins=bins
+            )
+            local_feat.update(
+                mset._make_local_top_feature_vector(
+                    local_keys, sorters=sorters, indices=indices
+                )
+            )
+        local_df = pd.DataFrame(local_feat, index=range(len(mset)))
+        feats = pd.concat([global_df, local_df], axis=1)
+        return feats
+
+    def make_feature_matrix(mset, featinfo, out=None, as_frame=False):
+        """
+        Computes the columns of a trained feature layout for every pair at
+        once and writes them into one (num_pairs, num_columns) array.
+
+        The columns are parsed a single time (see
+        :func:`AnnotPairFeatInfo.column_schema`). Each summary, top, and
+        global measure is then computed as one array over all pairs. Only
+        the names of the columns are formatted, never a dict per pair.
+        Columns a pair does not have (e.g. a rank past its number of
+        matches) are nan.
+
+        Args:
+            featinfo (AnnotPairFeatInfo | List[str]): feature columns, e.g.
+                the columns of a training frame
+            out (ndarray): optional preallocated (num_pairs, num_columns)
+                float array to fill
+            as_frame (bool): return a pd.DataFrame instead of an array
+
+        Returns:
+            ndarray | pd.DataFrame: the feature matrix
+
+        Example:
+            >>> # ENABLE_DOCTEST
+            >>> from vtool.matching import *  # NOQA
+            >>> rng = np.random.RandomState(0)
+            >>> matches = []
+            >>> for aid2 in range(2, 6):
+            >>>     match = PairwiseMatch({'aid': 1}, {'aid': aid2})
+            >>>     match.fm = rng.randint(0, 10, size=(6, 2))
+            >>>     match.fs = rng.rand(6)
+            >>>     match.local_measures['ratio'] = rng.rand(6)
+            >>>     match.global_measures['time'] = (rng.rand(), rng.rand())
+            >>>     matches.append(match)
+            >>> X = pd.DataFrame([m.make_feature_vector() for m in matches])
+            >>> featinfo = AnnotPairFeatInfo(X)
+            >>> mset = PairwiseMatchSet.from_matches(matches)
+            >>> X2 = mset.make_feature_matrix(featinfo)
+            >>> assert np.allclose(X.values, X2)
+            >>> X3 = mset.make_feature_matrix(featinfo, as_frame=True)
+            >>> assert list(X3.columns) == list(X.columns)
+        """
+        if not isinstance(featinfo, AnnotPairFeatInfo):
+            featinfo = AnnotPairFeatInfo(featinfo)
+        schema = featinfo.column_schema()
+        columns = schema['columns']
+        col_to_idx = schema['col_to_idx']
+        cfg = schema['pairfeat_cfg']
+        shape = (len(mset), len(columns))
+        if out is None:
+            out = np.empty(shape, dtype=np.float64)
+        elif out.shape != shape:
+            raise ValueError('out must have shape {}'.format(shape))
+        out.fill(np.nan)
+
+        def _fill(feat):
+            for key, vals in feat.items():
+                idx = col_to_idx.get(key, None)
+                if idx is not None:
+                    out[:, idx] = vals
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            global_keys = schema['global_keys']
+            _fill(_global_feature_columns(mset.global_measures_list, global_keys))
+            summary_ops = set(cfg['summary_ops'])
+            summary_keys = [k for k in cfg['local_keys'] if k in mset.local_measures]
+            if summary_ops and schema['unbinned']:
+                _fill(
+                    mset._make_local_summary_feature_vector(summary_keys, summary_ops)
+                )
+            if summary_ops and cfg['bin_key'] is not None:
+                _fill(
+                    mset._make_local_summary_feature_vector(
+                        summary_keys,
+                        summary_ops,
+                        bin_key=cfg['bin_key'],
+                        bins=cfg['bins'],
+                    )
+                )
+            top_keys = [k for k in schema['top_measures'] if k in mset.local_measures]
+            if top_keys and cfg['indices']:
+                _fill(
+                    mset._make_local_top_feature_vector(
+                        top_keys, sorters=cfg['sorters'], indices=cfg['indices']
+                    )
+                )
+        if as_frame:
+            return pd.DataFrame(out, columns=columns)
+        return out
+
+
+# Stored annotation values a worker can rebuild the keypoints, descriptors,
+# and chip size from with the ensure_metadata_* helpers
+_APPLY_ALL_SOURCE_KEYS = ['rchip_fpath', 'rchip', 'nchip']
+
+
+def _annot_group_key(annot):
+    """ Pairs of annotations with the same key share per-annotation data """
+    return annot['aid'] if 'aid' in annot else id(annot)
+
+
+def _apply_all_annot_data(annot, keys):
+    """
+    The plain dict of values a worker needs from annot to compute ``keys``.
+
+    Computed values are sent as they are. A value registered by a lazy
+    function from outside of this module is computed here, because that
+    function may depend on state that only this process has. Anything else is
+    rebuilt by the worker from the source keys, like
+    :func:`ensure_metadata_vsone` would do in this process.
+    """
+    stored_keys = set(annot.stored_keys())
+    data = {}
+    if 'aid' in stored_keys:
+        data['aid'] = annot['aid']
+    for key in keys:
+        if key in stored_keys:
+            data[key] = annot[key]
+        elif key in annot.reconstructable_keys():
+            func = annot._eval_funcs[key]
+            if getattr(func, '__module__', None) != __name__:
+                data[key] = annot[key]
+    if not all(key in data for key in keys):
+        for key in _APPLY_ALL_SOURCE_KEYS:
+            if key in stored_keys:
+                data[key] = annot[key]
+    return data
+
+
+def _apply_all_chunks(matches, chunksize):
+    """
+    Splits the matches into chunks of at most chunksize pairs. Pairs are
+    ordered by their annotations, so pairs that share an annotation end up in
+    the same chunk and its features and FLANN index are only built once.
+
+    Returns:
+        list: of (match_idxs, annot_keys, pair_list) tuples, where pair_list
+            indexes into annot_keys
+    """
+    keys1 = [_annot_group_key(match.annot1) for match in matches]
+    keys2 = [_annot_group_key(match.annot2) for match in matches]
+    # Keys are aids or ids, which can not always be compared to each other
+    key_to_rank = {}
+    for key in ub.flatten(zip(keys1, keys2)):
+        key_to_rank.setdefault(key, len(key_to_rank))
+    sortx = sorted(
+        range(len(matches)),
+        key=lambda x: (key_to_rank[keys1[x]], key_to_rank[keys2[x]]),
+    )
+    chunks = []
+    for match_idxs in ub.chunks(sortx, chunksize=chunksize):
+        chunk_keys = ub.flatten((keys1[x], keys2[x]) for x in match_idxs)
+        annot_keys = list(ub.unique(chunk_keys))
+        key_to_ax = {key: ax for ax, key in enumerate(annot_keys)}
+        pair_list = [(key_to_ax[keys1[x]], key_to_ax[keys2[x]]) for x in match_idxs]
+        chunks.append((match_idxs, annot_keys, pair_list))
+    return chunks
+
+
+def _apply_all_worker(annot_data_list, pair_list, cfgdict):
+    """ Runs apply_all on a chunk of pairs and returns only their arrays """
+    annots = [ut.LazyDict(data) for data in annot_data_list]
+    result_list = []
+    for ax1, ax2 in pair_list:
+        match = PairwiseMatch(annots[ax1], annots[ax2])
+        match.apply_all(cfgdict)
+        result = {
+            'fm': match.fm,
+            'fs': match.fs,
+            'fm_norm1': match.fm_norm1,
+            'fm_norm2': match.fm_norm2,
+            'H_21': match.H_21,
+            'H_12': match.H_12,
+            'local_measures': match.local_measures,
+        }
+        result_list.append(result)
+    return result_list
+
+
+def apply_all_parallel(matches, cfgdict={}, nprocs=None, chunksize=None):
+    """
+    Runs :func:`PairwiseMatch.apply_all` on many pairs in a process pool.
+
+    Pairs are split into chunks that keep pairs sharing an annotation
+    together, so each worker builds the features and FLANN index of an
+    annotation once per chunk. Workers are only sent plain dicts of arrays
+    (never the LazyDict annotations) and only send back the match arrays,
+    which are merged into the given PairwiseMatch objects.
+
+    The annotations of the given matches are not changed, so values computed
+    by the workers (e.g. features read from rchip_fpath) are computed again
+    if they are used in this process later.
+
+    Args:
+        matches (List[PairwiseMatch]): matches to apply the pipeline to
+        cfgdict (dict): config passed to apply_all
+        nprocs (int): number of worker processes. Defaults to the number of
+            cpus. If nprocs <= 1 the chunks are run in this process.
+        chunksize (int): maximum number of pairs sent to a worker at once.
+            Defaults to 4 chunks per process.
+
+    Returns:
+        List[PairwiseMatch]: the same matches, updated in place
+
+    CommandLine:
+        python -m vtool.matching apply_all_parallel
+
+    Example:
+        >>> # xdoctest: +REQUIRES(module:pyhesaff)
+        >>> from vtool.matching import *  # NOQA
+        >>> from vtool.inspect_matches import lazy_test_annot
+        >>> annots = [lazy_test_annot(fname) for fname in ['easy1.png', 'easy2.png']]
+        >>> cfgdict = {'ratio_thresh': .8}
+        >>> matches = [PairwiseMatch(annots[0], annots[1]),
+        >>>            PairwiseMatch(annots[1], annots[0])]
+        >>> apply_all_parallel(matches, cfgdict, nprocs=2)
+        >>> match = PairwiseMatch(annots[0], annots[1])
+        >>> match.apply_all(cfgdict)
+        >>> assert np.all(matches[0].fm == match.fm)
+        >>> assert np.allclose(matches[0].H_12, match.H_12)
+    """
+    if nprocs is None:
+        nprocs = ut.num_cpus()
+    nprocs = max(1, nprocs)
+    num_matches = len(matches)
+    if num_matches == 0:
+        return matches
+    if chunksize is None:
+        chunksize = max(1, int(np.ceil(num_matches / (4 * nprocs))))
+    (weight_key,) = PairwiseMatch._take_params(cfgdict, ['weight'])
+    feat_keys = ['kpts', 'vecs'] + ([] if weight_key is None else [weight_key])
+
+    # Every annot is only prepared once, even if it is in many chunks
+    key_to_annot = {}
+    key_to_keys = ub.ddict(set)
+    for match in matches:
+        key1 = _annot_group_key(match.annot1)
+        key2 = _annot_group_key(match.annot2)
+        key_to_annot.setdefault(key1, match.annot1)
+        key_to_annot.setdefault(key2, match.annot2)
+        key_to_keys[key1].update(feat_keys)
+        key_to_keys[key2].update(feat_keys + ['dlen_sqrd'])
+    key_to_data = {
+        key: _apply_all_annot_data(annot, sorted(key_to_keys[key]))
+        for key, annot in key_to_annot.items()
+    }
+
+    mode = 'process' if nprocs > 1 else 'serial'
+    chunks = _apply_all_chunks(matches, chunksize)
+    with ub.Executor(mode=mode, max_workers=nprocs) as executor:
+        jobs = [
+            executor.submit(
+                _apply_all_worker,
+                [key_to_data[key] for key in annot_keys],
+                pair_list,
+                cfgdict,
+            )
+            for match_idxs, annot_keys, pair_list in chunks
+        ]
+        for (match_idxs, _, _), job in zip(chunks, jobs):
+            for x, result in zip(match_idxs, job.result()):
+                match = matches[x]
+                for attr, value in result.items():
+                    setattr(match, attr, value)
+    return matches
+
+
+class OneVsManyIndex(ub.NiceRepr):
+    """
+    One-vs-many matching against one FLANN index over many annotations.
+
+    The vectors of the database annotations are stacked with
+    :func:`vtool.nearest_neighbors.invertible_stack` into a single index, so
+    matching a query is one ``nn_index`` call instead of one search per
+    database annotation. The neighbors are split back into one
+    :class:`PairwiseMatch` per database annotation.
+
+    The matches have the orientation of the asymmetric ``PairwiseMatch.assign``:
+    ``annot1`` is the indexed database annotation and ``annot2`` is the query,
+    so ``fm`` holds ``(db fx, query fx)`` rows and ``apply_ratio_test`` and
+    ``apply_sver`` can be used on them as usual.
+
+    Note:
+        The K nearest neighbors and the normalizer of each query feature are
+        taken over the whole database, so a database annotation only gets the
+        correspondences it wins against the others, and the normalizing
+        feature of ``fm_norm1`` may belong to another database annotation.
+        With a single database annotation this is the same as ``assign`` with
+        ``symmetric=False``. The ``symmetric`` param is ignored.
+
+    Args:
+        db_annots (List[dict]): database annotations
+        cfgdict (dict): config used to compute features of the annotations
+
+    CommandLine:
+        python -m vtool.matching OneVsManyIndex
+
+    Example:
+        >>> # xdoctest: +REQUIRES(module:pyflann)
+        >>> from vtool.matching import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> rng = np.random.RandomState(0)
+        >>> kpts = demodata.perterbed_grid_kpts(seed=0, wh_num=(10, 10))
+        >>> base = rng.randint(0, 200, size=(len(kpts), 128))
+        >>> def _annot(aid):
+        >>>     noise = rng.randint(0, 20, size=base.shape)
+        >>>     return {'aid': aid, 'kpts': kpts,
+        >>>             'vecs': (base + noise).astype(np.uint8)}
+        >>> index = OneVsManyIndex([_annot(aid) for aid in [2, 3, 4]])
+        >>> matches = index.assign(_annot(1), {'K': 1})
+        >>> assert [m.annot1['aid'] for m in matches] == [2, 3, 4]
+        >>> assert sum(map(len, matches)) == len(kpts)
+        >>> matches = [m.apply_ratio_test({'ratio_thresh': .9}) for m in matches]
+    """
+
+    def __init__(index, db_annots, cfgdict={}):
+        db_annots = [
+            annot if isinstance(annot, ut.LazyDict) else ut.LazyDict(annot)
+            for annot in db_annots
+        ]
+        for annot in db_annots:
+            ensure_metadata_feats(annot, cfgdict)
+            ensure_metadata_kpts_mats(annot)
+        index.db_annots = db_annots
+        vecs_list = [annot['vecs'] for annot in db_annots]
+        if len(vecs_list) == 0:
+            index.idx2_vec = np.empty((0, 128), dtype=np.uint8)
+            index.idx2_ax = np.empty(0, dtype=np.int32)
+            index.idx2_fx = np.empty(0, dtype=np.int32)
+        else:
+            import vtool as vt
+
+            idx2_vec, idx2_ax, idx2_fx = vt.invertible_stack(
+                vecs_list, list(range(len(db_annots)))
+            )
+            index.idx2_vec = idx2_vec
+            index.idx2_ax = idx2_ax
+            index.idx2_fx = idx2_fx
+        index._flann = None
+
+    def __nice__(index):
+        return '%d annots, %d vecs' % (len(index.db_annots), len(index.idx2_vec))
+
+    def __len__(index):
+        return len(index.db_annots)
+
+    @property
+    def flann(index):
+        """ The index over the stacked vectors, built on first use """
+        if index._flann is None and len(index.idx2_vec) > 0:
+            import vtool as vt
+
+            flann_params = {'algorithm': 'kdtree', 'trees': 8}
+            index._flann = vt.flann_cache(
+                index.idx2_vec, flann_params=flann_params, verbose=False
+            )
+        return index._flann
+
+    def assign(index, query_annot, cfgdict={}):
+        """
+        Assigns feature correspondences between a query and every database
+        annotation with a single nearest neighbor search.
+
+        Args:
+            query_annot (dict): the query annotation
+            cfgdict (dict): assign config (K, Knorm, checks, weight)
+
+        Returns:
+            List[PairwiseMatch]: a match for each database annotation (in
+                order), with the query as annot2
+        """
+        K, Knorm, checks, weight_key = PairwiseMatch._take_params(
+            cfgdict, ['K', 'Knorm', 'checks', 'weight']
+        )
+        if not isinstance(query_annot, ut.LazyDict):
+            query_annot = ut.LazyDict(query_annot)
+        ensure_metadata_feats(query_annot, cfgdict)
+        ensure_metadata_dlen_sqrd(query_annot)
+        ensure_metadata_kpts_mats(query_annot)
+
+        # Reduce K to allow some correspondences to be established
+        n_have = len(index.idx2_vec)
+        if n_have < 2:
+            assign_list = [empty_assign() for _ in index.db_annots]
+        else:
+            if n_have < K + Knorm:
+                K, Knorm = n_have - 1, 1
+            qfx_to_idx, qfx_to_dist = normalized_nearest_neighbors(
+                index.flann, query_annot['vecs'], K + Knorm, checks
+            )
+            assign_list = index._split_neighbors(qfx_to_idx, qfx_to_dist, K, Knorm)
+
+        matches = []
+        for annot, assigntup in zip(index.db_annots, assign_list):
+            match = PairwiseMatch(annot, query_annot)
+            match._set_assignment(*assigntup, weight_key=weight_key)
+            matches.append(match)
+        return matches
+
+    def _split_neighbors(index, qfx_to_idx, qfx_to_dist, K, Knorm):
+        """
+        Splits the neighbors of the query features in the stacked index into
+        the assignments of each database annotation.
+
+        Returns:
+            List[tuple]: (fm, match_dist, norm_dist, fx1_norm, fx2_norm) for
+                each database annotation, like asymmetric_correspondence
+        """
+        num_qfx = len(qfx_to_idx)
+        # The first K neighbors are matches, in (query fx, rank) order
+        match_idx = qfx_to_idx[:, 0:K].ravel()
+        match_dist = qfx_to_dist[:, 0:K].ravel()
+        match_qfx = np.repeat(np.arange(num_qfx, dtype=qfx_to_idx.dtype), K)
+        # Currently just use the last one as a normalizer
+        norm_rank = K + Knorm - 1
+        norm_idx = qfx_to_idx[:, norm_rank].take(match_qfx)
+        norm_dist = qfx_to_dist[:, norm_rank].take(match_qfx)
+
+        match_ax = index.idx2_ax.take(match_idx)
+        # A stable sort keeps the (query fx, rank) order within each annot
+        sortx = np.argsort(match_ax, kind='mergesort')
+        counts = np.bincount(match_ax, minlength=len(index.db_annots))
+        splits = np.cumsum(counts)[:-1]
+        fm = np.vstack(
+            [index.idx2_fx.take(match_idx[sortx]), match_qfx[sortx]]
+        ).T.astype(qfx_to_idx.dtype)
+        parts = [
+            np.split(arr, splits)
+            for arr in [
+                fm,
+                match_dist.take(sortx),
+                norm_dist.take(sortx),
+                index.idx2_fx.take(norm_idx.take(sortx)).astype(qfx_to_idx.dtype),
+            ]
+        ]
+        return [tup + (None,) for tup in zip(*parts)]
+
+
 def invsum(x):
     return np.sum(1 / x)
 
@@ -1090,6 +2169,37 @@ class AnnotPairFeatInfo(object):
         }
         return pairfeat_cfg, global_keys
 
+    def column_schema(featinfo):
+        """
+        Parses the columns once into what is needed to compute them for many
+        pairs (see :func:`PairwiseMatchSet.make_feature_matrix`). The result
+        is cached.
+
+        Returns:
+            dict: with the column order, the pairfeat_cfg and global_keys
+                of make_pairfeat_cfg, the local measures used by top
+                features, and whether there are unbinned summary features.
+        """
+        if getattr(featinfo, '_column_schema', None) is None:
+            pairfeat_cfg, global_keys = featinfo.make_pairfeat_cfg()
+            columns = list(featinfo.columns)
+            local_cols = featinfo.select_columns([('measure_type', '==', 'local')])
+            summary_cols = featinfo.select_columns([('measure_type', '==', 'summary')])
+            unknown = [col for col in columns if featinfo.measure_type(col) is None]
+            if unknown:
+                raise ValueError('Cannot parse feature columns {}'.format(unknown))
+            featinfo._column_schema = {
+                'columns': columns,
+                'col_to_idx': {col: idx for idx, col in enumerate(columns)},
+                'pairfeat_cfg': pairfeat_cfg,
+                'global_keys': global_keys,
+                'top_measures': sorted(set(map(featinfo.local_measure, local_cols))),
+                'unbinned': any(
+                    featinfo.summary_binkey(col) is None for col in summary_cols
+                ),
+            }
+        return featinfo._column_schema
+
     def select_columns(featinfo, criteria, op='and'):
         """
         Args:
@@ -1472,6 +2582,8 @@ def ensure_metadata_vsone(annot1, annot2, cfgdict={}):
     if symmetric:
         ensure_metadata_flann(annot2, cfgdict=cfgdict)
     ensure_metadata_dlen_sqrd(annot2)
+    ensure_metadata_kpts_mats(annot1)
+    ensure_metadata_kpts_mats(annot2)
     pass
 
 
@@ -1615,6 +2727,35 @@ def ensure_metadata_dlen_sqrd(annot):
     return annot
 
 
+def ensure_metadata_kpts_mats(annot):
+    """
+    setup lazy evaluation of the keypoint matrices used by spatial
+    verification (see :func:`vtool.spatial_verification.get_kpts_mats`), so
+    they are built once per annotation instead of once per pair
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> annot = ut.LazyDict({'kpts': demodata.get_dummy_kpts()})
+        >>> ensure_metadata_kpts_mats(annot)
+        >>> assert 'kpts_mats' not in annot._stored_results
+        >>> kpts_mats = annot['kpts_mats']
+        >>> assert annot['kpts_mats'] is kpts_mats
+        >>> print(sorted(kpts_mats.keys()))
+        ['RV', 'invVR', 'oris', 'sqrd_scales']
+    """
+    from vtool import spatial_verification as sver
+
+    if 'kpts_mats' not in annot:
+
+        def eval_kpts_mats():
+            return sver.get_kpts_mats(annot['kpts'])
+
+        annot.set_lazy_func('kpts_mats', eval_kpts_mats)
+    return annot
+
+
 def ensure_metadata_flann(annot, cfgdict):
     """ setup lazy flann evaluation """
     import vtool as vt
@@ -1647,6 +2788,18 @@ PSEUDO_MAX_VEC_COMPONENT = 512
 PSEUDO_MAX_DIST_SQRD = 2 * (PSEUDO_MAX_VEC_COMPONENT ** 2)
 PSEUDO_MAX_DIST = np.sqrt(2) * (PSEUDO_MAX_VEC_COMPONENT)
 
+# The 'auto' nn_backend uses exact brute force search when there are at most
+# this many pairs of vectors (about 1500 x 1500) and FLANN otherwise
+NN_BRUTEFORCE_MAX_PAIRS = 2 ** 21
+
+# Number of distances computed at once by the brute force search
+NN_BRUTEFORCE_BLOCK_SIZE = 2 ** 22
+
+# flag_symmetric_matches uses a sort join of the neighbor pairs from this many
+# neighbors on, where the N x K x K lookup is about as slow and takes much
+# more memory (see tests/time_matching.py)
+SYMMETRIC_JOIN_MIN_K = 32
+
 
 def empty_assign():
     fm = np.empty((0, 2), dtype=np.int32)
@@ -1657,7 +2810,22 @@ def empty_assign():
     return fm, match_dist, norm_dist, fx1_norm, fx2_norm
 
 
-def symmetric_correspondence(annot1, annot2, K, Knorm, checks, allow_shrink=True):
+def _resolve_nn_backend(nn_backend, num1, num2):
+    """
+    Returns the nearest neighbor backend used to match num1 vs num2 vectors
+    """
+    if nn_backend == 'auto':
+        if num1 * num2 <= NN_BRUTEFORCE_MAX_PAIRS:
+            return 'bruteforce'
+        return 'flann'
+    if nn_backend not in {'flann', 'bruteforce'}:
+        raise ValueError('unknown nn_backend=%r' % (nn_backend,))
+    return nn_backend
+
+
+def symmetric_correspondence(
+    annot1, annot2, K, Knorm, checks, allow_shrink=True, nn_backend='auto'
+):
     """
     Find symmetric feature corresopndences
     """
@@ -1671,13 +2839,21 @@ def symmetric_correspondence(annot1, annot2, K, Knorm, checks, allow_shrink=True
 
     num_neighbors = K + Knorm
 
-    fx1_to_fx2, fx1_to_dist = normalized_nearest_neighbors(
-        annot2['flann'], annot1['vecs'], num_neighbors, checks
-    )
+    vecs1 = annot1['vecs']
+    vecs2 = annot2['vecs']
+    nn_backend = _resolve_nn_backend(nn_backend, len(vecs1), len(vecs2))
+    if nn_backend == 'bruteforce':
+        # One distance matrix serves both directions
+        tup = bruteforce_nearest_neighbors(vecs1, vecs2, num_neighbors)
+        fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist = tup
+    else:
+        fx1_to_fx2, fx1_to_dist = normalized_nearest_neighbors(
+            annot2['flann'], vecs1, num_neighbors, checks
+        )
 
-    fx2_to_fx1, fx2_to_dist = normalized_nearest_neighbors(
-        annot1['flann'], annot2['vecs'], num_neighbors, checks
-    )
+        fx2_to_fx1, fx2_to_dist = normalized_nearest_neighbors(
+            annot1['flann'], vecs2, num_neighbors, checks
+        )
 
     # fx2_to_flags = flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2, K)
 
@@ -1691,7 +2867,9 @@ def symmetric_correspondence(annot1, annot2, K, Knorm, checks, allow_shrink=True
     return fm, match_dist, norm_dist, fx1_norm, fx2_norm
 
 
-def asymmetric_correspondence(annot1, annot2, K, Knorm, checks, allow_shrink=True):
+def asymmetric_correspondence(
+    annot1, annot2, K, Knorm, checks, allow_shrink=True, nn_backend='auto'
+):
     """
     Find symmetric feature corresopndences
     """
@@ -1705,9 +2883,17 @@ def asymmetric_correspondence(annot1, annot2, K, Knorm, checks, allow_shrink=Tru
 
     num_neighbors = K + Knorm
 
-    fx2_to_fx1, fx2_to_dist = normalized_nearest_neighbors(
-        annot1['flann'], annot2['vecs'], num_neighbors, checks
-    )
+    vecs1 = annot1['vecs']
+    vecs2 = annot2['vecs']
+    nn_backend = _resolve_nn_backend(nn_backend, len(vecs1), len(vecs2))
+    if nn_backend == 'bruteforce':
+        fx2_to_fx1, fx2_to_dist = bruteforce_nearest_neighbors(
+            vecs1, vecs2, num_neighbors, symmetric=False
+        )[0:2]
+    else:
+        fx2_to_fx1, fx2_to_dist = normalized_nearest_neighbors(
+            annot1['flann'], vecs2, num_neighbors, checks
+        )
     fx2_to_flags = np.ones((len(fx2_to_fx1), K), dtype=np.bool)
     # Assign correspondences
     assigntup = assign_unconstrained_matches(
@@ -1750,6 +2936,97 @@ def normalized_nearest_neighbors(flann1, vecs2, K, checks=800):
     return fx2_to_fx1, fx2_to_dist
 
 
+def bruteforce_nearest_neighbors(
+    vecs1, vecs2, K, symmetric=True, blocksize=None, normalize=True
+):
+    """
+    Exact K nearest neighbors between two small sets of vectors.
+
+    The squared distance matrix is computed block by block over the rows of
+    vecs2, and each block is used for the row-wise neighbors (vecs2 to vecs1)
+    and, if symmetric, the column-wise neighbors (vecs1 to vecs2), so a
+    single pass serves both directions. Ties are broken by index, so unlike
+    an approximate FLANN search the result is deterministic.
+
+    Args:
+        vecs1 (ndarray): database vectors
+        vecs2 (ndarray): query vectors
+        K (int): number of neighbors
+        symmetric (bool): if True also finds the neighbors of vecs1 in vecs2
+        blocksize (int): number of rows of vecs2 per block. Defaults to
+            blocks of about NN_BRUTEFORCE_BLOCK_SIZE distances.
+        normalize (bool): if True distances are normalized like
+            normalized_nearest_neighbors, otherwise they are squared
+
+    Returns:
+        tuple: (fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist), where the
+            last two are None if symmetric is False
+
+    CommandLine:
+        python -m vtool.matching bruteforce_nearest_neighbors
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.matching import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> vecs1 = rng.randint(0, 256, size=(100, 128)).astype(np.uint8)
+        >>> vecs2 = rng.randint(0, 256, size=(80, 128)).astype(np.uint8)
+        >>> tup = bruteforce_nearest_neighbors(vecs1, vecs2, 2, blocksize=7)
+        >>> fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist = tup
+        >>> assert fx2_to_fx1.shape == (80, 2) and fx1_to_fx2.shape == (100, 2)
+        >>> diff = vecs2[:, None, :].astype(float) - vecs1[None, :, :]
+        >>> dists = np.sqrt((diff ** 2).sum(axis=2)) / PSEUDO_MAX_DIST
+        >>> assert np.all(fx2_to_fx1 == dists.argsort(axis=1)[:, 0:2])
+        >>> assert np.all(fx1_to_fx2 == dists.T.argsort(axis=1)[:, 0:2])
+        >>> assert np.allclose(fx1_to_dist, np.sort(dists.T, axis=1)[:, 0:2])
+    """
+    from vtool import _pyflann_backend as backend
+
+    num1, num2 = len(vecs1), len(vecs2)
+    if K > num1 or (symmetric and K > num2):
+        raise MatchingError('not enough database features')
+    # Distances of uint8 vectors are exact int32 values
+    fvecs1, sqrd1 = backend._bruteforce_prepare(vecs1)
+    fvecs2, sqrd2 = backend._bruteforce_prepare(vecs2)
+    if blocksize is None:
+        blocksize = max(1, NN_BRUTEFORCE_BLOCK_SIZE // max(1, num1))
+
+    fx2_to_fx1, fx2_to_dist_sqrd = empty_neighbors(num2, K)
+    if symmetric:
+        fx1_to_fx2, fx1_to_dist_sqrd = empty_neighbors(num1, 0)
+    for start in range(0, num2, blocksize):
+        stop = min(start + blocksize, num2)
+        dists = backend._bruteforce_dist_sqrd(
+            fvecs2[start:stop], sqrd2[start:stop], fvecs1, sqrd1
+        )
+        idxs, idx_dists = backend._bruteforce_topk(dists, K)
+        fx2_to_fx1[start:stop] = idxs
+        fx2_to_dist_sqrd[start:stop] = idx_dists
+        if symmetric:
+            # Merge the neighbors of this block into the best ones so far
+            idxs, idx_dists = backend._bruteforce_topk(
+                dists.T, min(K, stop - start), offset=start
+            )
+            cand_idxs = np.hstack([fx1_to_fx2, idxs])
+            cand_dists = np.hstack([fx1_to_dist_sqrd, idx_dists])
+            order = np.lexsort((cand_idxs, cand_dists), axis=-1)[:, 0:K]
+            fx1_to_fx2 = np.take_along_axis(cand_idxs, order, axis=1)
+            fx1_to_dist_sqrd = np.take_along_axis(cand_dists, order, axis=1)
+
+    def _finalize(dist_sqrd):
+        dist_sqrd = dist_sqrd.astype(np.float64)
+        if not normalize:
+            return dist_sqrd
+        # normalized SIFT dist
+        return np.divide(np.sqrt(dist_sqrd), PSEUDO_MAX_DIST)
+
+    fx2_to_dist = _finalize(fx2_to_dist_sqrd)
+    if not symmetric:
+        return fx2_to_fx1, fx2_to_dist, None, None
+    fx1_to_dist = _finalize(fx1_to_dist_sqrd)
+    return fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist
+
+
 def assign_symmetric_matches(
     fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist, K, Knorm=None
 ):
@@ -1838,44 +3115,27 @@ def assign_symmetric_matches(
     norm_fx1 = fx2_to_fx1[match_fx2, norm_rank]
     norm_dist1 = fx2_to_dist[match_fx2, norm_rank]
 
-    # ---------
-    # REVERSE DIRECTION
-    fx1_to_flags = flag_symmetric_matches(fx1_to_fx2, fx2_to_fx1, K)
-    flat_validx1 = np.flatnonzero(fx1_to_flags)
-    match_fx1_ = np.floor_divide(flat_validx1, K, dtype=index_dtype)
-    match_rank1 = np.mod(flat_validx1, K, dtype=index_dtype)
-    flat_match_idx1 = np.ravel_multi_index(
-        (match_fx1_, match_rank1), dims=fx1_to_fx2.shape
-    )
-    match_fx2_ = fx1_to_fx2.take(flat_match_idx1)
-    # match_dist2_ = fx1_to_dist.take(flat_match_idx1)
-    fm_ = np.vstack((match_fx1_, match_fx2_)).T
-
-    flat_norm_idx2_ = np.ravel_multi_index((match_fx1_, norm_rank), dims=fx1_to_fx2.shape)
-    norm_fx2_ = fx1_to_fx2.take(flat_norm_idx2_)
-    norm_dist2_ = fx1_to_dist.take(flat_norm_idx2_)
-
     # ---------
     # Align matches with the reverse direction
 
     # Do this by enforcing a constant sorting. No lookup necessary
     sortx = np.lexsort(fm.T)
-    sortx_ = np.lexsort(fm_.T)
-    # fm2_ = fm_.take(sortx_, axis=0)
-    # assert np.all(fm2 == fm2_)
 
     a_fm = fm.take(sortx, axis=0)
 
     a_match_dist = match_dist1[sortx]
-    # assert np.all(match_dist1[sortx] == match_dist2_[sortx_])
 
     a_norm_fx1 = norm_fx1[sortx]
     a_norm_dist1 = norm_dist1[sortx]
 
-    a_norm_fx2_ = norm_fx2_[sortx_]
-    a_norm_dist2_ = norm_dist2_[sortx_]
-
-    np.minimum(a_norm_dist2_, a_norm_dist1)
+    # ---------
+    # REVERSE DIRECTION
+    # The reciprocal matches are the same in both directions, so the reverse
+    # normalizers are looked up from the fx1 of each match instead of flagging
+    # and sorting the reverse matches again
+    a_match_fx1 = a_fm.T[0]
+    a_norm_fx2_ = fx1_to_fx2[a_match_fx1, basic_norm_rank]
+    a_norm_dist2_ = fx1_to_dist[a_match_fx1, basic_norm_rank]
 
     assigntup = (a_fm, a_match_dist, a_norm_fx1, a_norm_dist1, a_norm_fx2_, a_norm_dist2_)
     return assigntup
@@ -1995,6 +3255,11 @@ def flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2, K=2):
     Returns flags indicating if the matches in fx2_to_fx1 are reciprocal
     with the matches in fx1_to_fx2.
 
+    For K >= SYMMETRIC_JOIN_MIN_K the neighbor pairs of both directions are
+    joined with a sort instead, which is O(NK log NK) and has no N x K x K
+    intermediate arrays. Below that, looking up the K x K reciprocal
+    neighbors is faster.
+
     Example:
         >>> # ENABLE_DOCTEST
         >>> from vtool.matching import *  # NOQA
@@ -2014,6 +3279,15 @@ def flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2, K=2):
         >>> result = ub.repr2(fx2_to_flagsB)
         >>> print(result)
     """
+    if K >= SYMMETRIC_JOIN_MIN_K:
+        return _flag_symmetric_join(fx2_to_fx1, fx1_to_fx2, K)
+    return _flag_symmetric_lookup(fx2_to_fx1, fx1_to_fx2, K)
+
+
+def _flag_symmetric_lookup(fx2_to_fx1, fx1_to_fx2, K):
+    """
+    flag_symmetric_matches by looking up the K x K reciprocal neighbors
+    """
     match_12 = fx1_to_fx2.T[:K].T
     match_21 = fx2_to_fx1.T[:K].T
     fx2_list = np.arange(len(match_21))
@@ -2028,6 +3302,56 @@ def flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2, K=2):
     return fx2_to_flags
 
 
+def _flag_symmetric_join(fx2_to_fx1, fx1_to_fx2, K):
+    """
+    flag_symmetric_matches as a join of the neighbor pairs of both
+    directions, encoded as integer keys, with a sort and a binary search.
+    """
+    num1 = _pair_key_base(fx2_to_fx1, fx1_to_fx2, K)
+    keys21 = _neighbor_pair_keys(fx2_to_fx1, K, num1, reverse=False)
+    keys12 = _neighbor_pair_keys(fx1_to_fx2, K, num1, reverse=True)
+    fx2_to_flags = _sorted_isin(keys21, np.sort(keys12))
+    return fx2_to_flags.reshape(len(fx2_to_fx1), K)
+
+
+def _pair_key_base(fx2_to_fx1, fx1_to_fx2, K):
+    """
+    The multiplier of fx2 in the pair keys, larger than any fx1
+    """
+    num1 = len(fx1_to_fx2)
+    if fx2_to_fx1.size > 0 and K > 0:
+        num1 = max(num1, int(fx2_to_fx1[:, 0:K].max()) + 1)
+    return num1
+
+
+def _neighbor_pair_keys(qfx_to_dfx, K, num1, reverse=False):
+    """
+    Encodes the (fx1, fx2) pairs of the top K neighbors of each row as int64
+    keys fx2 * num1 + fx1, in row major order.
+
+    Args:
+        qfx_to_dfx (ndarray): fx2_to_fx1, or fx1_to_fx2 if reverse is True
+        K (int): number of neighbors used
+        num1 (int): a number larger than any fx1
+        reverse (bool): if True the rows are fx1 and the neighbors fx2
+    """
+    rows = np.repeat(np.arange(len(qfx_to_dfx), dtype=np.int64), K)
+    nbrs = qfx_to_dfx[:, 0:K].ravel().astype(np.int64)
+    if reverse:
+        return nbrs * num1 + rows
+    return rows * num1 + nbrs
+
+
+def _sorted_isin(keys, sorted_keys):
+    """
+    Flags the keys that are in sorted_keys with a binary search
+    """
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=np.bool_)
+    pos = np.searchsorted(sorted_keys, keys)
+    return sorted_keys.take(pos, mode='clip') == keys
+
+
 if __name__ == '__main__':
     """
     CommandLine:
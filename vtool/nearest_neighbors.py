@@ -5,6 +5,8 @@ Wrapper around flann (with caching)
 python -c "import vtool, doctest; print(doctest.testmod(vtool.nearest_neighbors))"
 """
 from __future__ import absolute_import, division, print_function
+import os
+import threading
 from os.path import exists, normpath, join
 import utool as ut
 import ubelt as ub
@@ -12,6 +14,9 @@ import numpy as np
 import annoy as ann
 from vtool._pyflann_backend import FLANN_CLS, pyflann
 
+# Default byte budget of the in-process LRU of loaded FLANN indexes
+FLANN_LRU_MAX_BYTES = 2 ** 30
+
 
 class AnnoyWrapper(object):
     """
@@ -359,6 +364,127 @@ def get_flann_fpath(
     return flann_fpath
 
 
+class FlannLRU(ub.NiceRepr):
+    """
+    In process least recently used cache of loaded FLANN indexes, keyed by
+    their cfgstr (the flann_fpath of :func:`flann_cache`). It is bounded by
+    max_bytes, the size of the indexed points plus the memory the index
+    reports. Points memory mapped by flann_cache are shared with the page
+    cache and are not counted.
+
+    The cached indexes are shared by every caller, so they must not be
+    modified (e.g. with add_points).
+
+    Args:
+        max_bytes (int): size bound of the cached indexes
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.nearest_neighbors import *  # NOQA
+        >>> lru = FlannLRU(max_bytes=100)
+        >>> lru.put('a', 'index_a', 60)
+        >>> lru.put('b', 'index_b', 30)
+        >>> assert lru.get('a') == 'index_a'
+        >>> lru.put('c', 'index_c', 30)
+        >>> print(lru.get('b'), len(lru), lru.total_bytes)
+        None 2 90
+    """
+
+    def __init__(self, max_bytes=FLANN_LRU_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.num_hits = 0
+        self.num_misses = 0
+        self.total_bytes = 0
+        # key -> (flann, nbytes), least recently used first
+        self._lru = ut.odict()
+        self._lock = threading.Lock()
+
+    def __nice__(self):
+        return '%d indexes, %d bytes' % (len(self), self.total_bytes)
+
+    def __len__(self):
+        return len(self._lru)
+
+    def get(self, key):
+        """ Returns the index of key (marking it as recently used) or None """
+        with self._lock:
+            item = self._lru.pop(key, None)
+            if item is None:
+                self.num_misses += 1
+                return None
+            self._lru[key] = item
+            self.num_hits += 1
+            return item[0]
+
+    def put(self, key, flann, nbytes):
+        """ Adds an index and evicts the least recently used ones """
+        with self._lock:
+            old = self._lru.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            if nbytes > self.max_bytes:
+                return
+            self._lru[key] = (flann, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, (_, old_nbytes) = self._lru.popitem(last=False)
+                self.total_bytes -= old_nbytes
+
+    def pop(self, key):
+        with self._lock:
+            item = self._lru.pop(key, None)
+            if item is not None:
+                self.total_bytes -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self.total_bytes = 0
+
+
+# The LRU used by flann_cache by default
+FLANN_LRU = FlannLRU()
+
+
+def _flann_nbytes(flann, dpts):
+    """ Approximate memory used by an index and its points """
+    nbytes = 0 if isinstance(dpts, np.memmap) else dpts.nbytes
+    used_memory = getattr(flann, 'used_memory', None)
+    if used_memory is not None:
+        try:
+            nbytes += int(used_memory())
+        except Exception:
+            pass
+    return nbytes
+
+
+def get_flann_dpts_fpath(flann_fpath):
+    """ returns the filepath of the memory mapped points of a flann index """
+    return flann_fpath + '.dpts.npy'
+
+
+def _mmap_flann_dpts(flann_fpath, dpts, use_cache=True):
+    """
+    Returns dpts as a read-only memory map of a .npy file next to the index,
+    writing the file if it does not exist yet. Processes that map the same
+    file share one copy of the points.
+    """
+    dpts_fpath = get_flann_dpts_fpath(flann_fpath)
+    if use_cache and exists(dpts_fpath):
+        try:
+            mmap_dpts = np.load(dpts_fpath, mmap_mode='r')
+            if mmap_dpts.shape == dpts.shape and mmap_dpts.dtype == dpts.dtype:
+                return mmap_dpts
+        except (IOError, OSError, ValueError):
+            pass
+    # Write to a temporary file first so readers never see partial files
+    tmp_fpath = dpts_fpath + '.%d.tmp' % (os.getpid(),)
+    with open(tmp_fpath, 'wb') as file_:
+        np.save(file_, np.ascontiguousarray(dpts))
+    getattr(os, 'replace', os.rename)(tmp_fpath, dpts_fpath)
+    return np.load(dpts_fpath, mmap_mode='r')
+
+
 def flann_cache(
     dpts,
     cache_dir='default',
@@ -370,10 +496,41 @@ def flann_cache(
     use_data_hash=True,
     appname='vtool',
     verbose=None,
+    lru='default',
+    mmap_dpts=False,
 ):
     """
     Tries to load a cached flann index before doing anything
     from vtool.nn
+
+    Indexes are first looked up in an in-process LRU keyed by their cfgstr,
+    so a hit neither constructs a new index nor reads it from disk. Returned
+    indexes may be shared with other callers and must not be modified. If
+    the cfgstr already identifies the points, pass use_data_hash=False to
+    also skip hashing dpts.
+
+    Args:
+        lru (FlannLRU): in-process cache of loaded indexes. 'default' uses
+            FLANN_LRU and None disables it.
+        mmap_dpts (bool): if True the index is built over a read-only memory
+            map of the points stored next to the index file, so processes
+            using the same index share one copy of the points.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyflann)
+        >>> from vtool.nearest_neighbors import *  # NOQA
+        >>> import tempfile
+        >>> rng = np.random.RandomState(0)
+        >>> dpts = rng.rand(100, 128).astype(np.float32)
+        >>> cache_dir = tempfile.mkdtemp()
+        >>> lru = FlannLRU()
+        >>> kw = dict(cache_dir=cache_dir, lru=lru, mmap_dpts=True, verbose=0)
+        >>> flann1 = flann_cache(dpts, **kw)
+        >>> flann2 = flann_cache(dpts, **kw)
+        >>> assert flann1 is flann2
+        >>> print(lru.num_hits, lru.num_misses, len(lru))
+        1 1 1
     """
     if verbose is None:
         verbose = int(ut.NOT_QUIET)
@@ -393,6 +550,18 @@ def flann_cache(
         appname=appname,
         verbose=verbose,
     )
+    if lru == 'default':
+        lru = FLANN_LRU
+    if lru is not None and use_cache:
+        flann = lru.get(flann_fpath)
+        if flann is not None:
+            if verbose > 0:
+                print('...flann lru hit: %d vectors' % (len(dpts)))
+            if verbose > 1:
+                print('L___ END FLANN INDEX ')
+            return flann
+    if mmap_dpts:
+        dpts = _mmap_flann_dpts(flann_fpath, dpts, use_cache=use_cache)
     # Load the index if it exists
     flann = FLANN_CLS()
     flann.flann_fpath = flann_fpath
@@ -404,6 +573,8 @@ def flann_cache(
                 print('...flann cache hit: %d vectors' % (len(dpts)))
             if verbose > 1:
                 print('L___ END FLANN INDEX ')
+            if lru is not None:
+                lru.put(flann_fpath, flann, _flann_nbytes(flann, dpts))
             return flann
         except Exception as ex:
             ut.printex(ex, '... cannot load index', iswarning=True)
@@ -426,6 +597,8 @@ def flann_cache(
         print('flann.save_index(%r)' % ut.path_ndir_split(flann_fpath, n=2))
     if save:
         flann.save_index(flann_fpath)
+    if lru is not None:
+        lru.put(flann_fpath, flann, _flann_nbytes(flann, dpts))
     if verbose > 1:
         print('L___ END CACHED FLANN INDEX ')
     return flann
@@ -448,7 +621,8 @@ def flann_augment(
         >>> use_cache = False
         >>> save = False
     """
-    flann = flann_cache(dpts, cache_dir, cfgstr, flann_params)
+    # The augmented index must not be shared through the LRU
+    flann = flann_cache(dpts, cache_dir, cfgstr, flann_params, lru=None)
     flann.add_points(new_dpts)
     if save:
         aug_dpts = np.vstack((dpts, new_dpts))
@@ -27,9 +27,12 @@ Notes:
 """
 from __future__ import absolute_import, division, print_function
 from six.moves import range
+import os
+from os.path import join
 import warnings  # NOQA
 import six  # NOQA
 import utool as ut
+import ubelt as ub
 import numpy as np
 import numpy.linalg as npl
 import scipy.sparse as sps
@@ -37,24 +40,41 @@ import scipy.sparse.linalg as spsl
 import vtool.keypoint as ktool
 import vtool.linalg as ltool
 import vtool.distance
+import vtool.other
 from .util_math import TAU
+from vtool import sver_c_wrapper
 
-try:
-    from vtool import sver_c_wrapper
-
-    HAVE_SVER_C_WRAPPER = not ut.get_argflag('--no-c')
-except Exception as ex:
-    HAVE_SVER_C_WRAPPER = False
-    if ut.VERBOSE:
-        ut.printex(ex, 'please build the sver c wrapper (run with --rebuild-sver')
-    if False:
-        raise
+# Allows libsver to be used (disable with --no-c). It is only loaded by the
+# first call that needs it (see have_sver_c_wrapper).
+USE_SVER_C_WRAPPER = not ut.get_argflag('--no-c')
 
 
 VERBOSE_SVER = ut.get_argflag('--verb-sver')
 
+
+def have_sver_c_wrapper():
+    """
+    True if libsver is allowed and can be loaded. The first call loads it;
+    spatial verification falls back to python when this is False.
+    """
+    return USE_SVER_C_WRAPPER and sver_c_wrapper.is_available()
+
+
 SV_DTYPE = np.float64
 INDEX_DTYPE = np.int32
+# Dtype of the opt-in fast path for the affine hypothesis search. Everything
+# after the search (refinement, homography checks) stays in SV_DTYPE.
+SV_FAST_DTYPE = np.float32
+
+# Upper bound on the temporary memory used by the vectorized python
+# hypothesis tests. Hypotheses are tested in blocks that fit in this budget.
+MAX_BLOCK_BYTES = 2 ** 26
+
+# Bump when the results of spatially_verify_kpts or the layout of SverCache
+# entries change so that entries written by older versions are not reused.
+SVER_CACHE_VERSION = 2
+# Default size bound of a SverCache directory
+SVER_CACHE_MAX_BYTES = 2 ** 30
 
 
 def build_lstsqrs_Mx9(xy1_mn, xy2_mn):
@@ -356,6 +376,107 @@ def compute_homog(xy1_mn, xy2_mn):
     return H
 
 
+def compute_homog_batch(xy1_mn_list, xy2_mn_list, max_block_bytes=None):
+    """
+    Vectorized :func:`compute_homog` for a ragged batch of point sets.
+
+    Instead of one SVD of an Mx9 matrix per pair, the 9x9 normal matrix
+    ``Mx9.T.dot(Mx9)`` of every pair is accumulated from all points at once
+    (with one segmented sum over the points, not a loop over the pairs) and
+    the nullspaces are found with a single stacked eigendecomposition.
+    The normal matrix squares the condition number, so the points should be
+    normalized (as in :func:`get_normalized_affine_inliers`).
+
+    Args:
+        xy1_mn_list (list): (2, M_i) normalized xy points in image 1 per pair
+        xy2_mn_list (list): corresponding (2, M_i) points in image 2 per pair
+        max_block_bytes (int): bound on the per point terms that are summed
+            at once. Defaults to MAX_BLOCK_BYTES.
+
+    Returns:
+        ndarray[shape=(B, 3, 3)]: H_list - a homography per pair. These are
+            the same as compute_homog up to scale (and sign).
+
+    Raises:
+        ValueError: if a pair has fewer than 4 points
+
+    CommandLine:
+        python -m xdoctest vtool.spatial_verification compute_homog_batch
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.linalg as ltool
+        >>> rng = np.random.RandomState(0)
+        >>> H_true = np.array([[1.1, .1, .2], [-.1, .9, .3], [.01, .02, 1.]])
+        >>> xy1_mn_list, xy2_mn_list = [], []
+        >>> for num in [7, 30, 200]:
+        >>>     xy1 = rng.rand(2, num) * 100
+        >>>     xy2 = ltool.transform_points_with_homography(H_true, xy1)
+        >>>     xy2 += rng.randn(2, num) * .5
+        >>>     xy1_mn_list.append(ltool.whiten_xy_points(xy1)[0])
+        >>>     xy2_mn_list.append(ltool.whiten_xy_points(xy2)[0])
+        >>> H_list = compute_homog_batch(xy1_mn_list, xy2_mn_list)
+        >>> for H, xy1_mn, xy2_mn in zip(H_list, xy1_mn_list, xy2_mn_list):
+        >>>     H_ = compute_homog(xy1_mn, xy2_mn)
+        >>>     assert np.allclose(H / H[2, 2], H_ / H_[2, 2])
+        >>> # Small blocks split pairs across blocks
+        >>> H_list2 = compute_homog_batch(xy1_mn_list, xy2_mn_list, 36 * 8 * 13)
+        >>> assert np.allclose(H_list2 / H_list2[:, 2:3, 2:3], H_list / H_list[:, 2:3, 2:3])
+        >>> # Fewer than 4 points do not determine a homography
+        >>> few_pts = ([xy1_mn_list[0][:, 0:3]], [xy2_mn_list[0][:, 0:3]])
+        >>> ut.assert_raises(ValueError, compute_homog_batch, *few_pts)
+    """
+    num_pairs = len(xy1_mn_list)
+    if num_pairs == 0:
+        return np.empty((0, 3, 3), dtype=SV_DTYPE)
+    sizes = np.array([xy.shape[1] for xy in xy1_mn_list])
+    if np.any(sizes < 4):
+        # The normal matrix would not have a unique nullspace
+        raise ValueError(
+            'compute_homog_batch needs at least 4 points per pair, got sizes %r'
+            % (sizes[sizes < 4].tolist(),)
+        )
+    xy1 = np.hstack(xy1_mn_list).astype(SV_DTYPE, copy=False)
+    xy2 = np.hstack(xy2_mn_list).astype(SV_DTYPE, copy=False)
+    x1, y1 = xy1
+    u2, v2 = xy2
+    num_pts = len(x1)
+    # With a = (x1, y1, 1) the two rows of build_lstsqrs_Mx9 for a point are
+    # (0, -a, v2 * a) and (a, 0, -u2 * a), so the 3x3 blocks of the normal
+    # matrix are sums of w * outer(a, a) for the weights w = 1, u2, v2, and
+    # u2 ** 2 + v2 ** 2. Only those 4 sums are accumulated per pair.
+    a = np.vstack([x1, y1, np.ones(num_pts, dtype=SV_DTYPE)]).T
+    w = np.vstack([np.ones(num_pts, dtype=SV_DTYPE), u2, v2, u2 ** 2 + v2 ** 2]).T
+    # Sum the terms of each pair, in blocks of points so the (num_pts, 4, 3, 3)
+    # temporary stays within max_block_bytes
+    if max_block_bytes is None:
+        max_block_bytes = MAX_BLOCK_BYTES
+    block_size = max(1, max_block_bytes // (36 * a.itemsize))
+    pair_ids = np.repeat(np.arange(num_pairs), sizes)
+    sums = np.zeros((num_pairs, 4, 3, 3), dtype=SV_DTYPE)
+    for start in range(0, num_pts, block_size):
+        sl = slice(start, start + block_size)
+        aa = a[sl, :, None] * a[sl, None, :]
+        terms = w[sl, :, None, None] * aa[:, None]
+        # pair_ids is sorted, so each pair is one run of the block
+        block_pxs, run_starts = np.unique(pair_ids[sl], return_index=True)
+        sums[block_pxs] += np.add.reduceat(terms, run_starts, axis=0)
+    S0, S1, S2, S3 = sums.transpose(1, 0, 2, 3)
+    gram = np.zeros((num_pairs, 9, 9), dtype=SV_DTYPE)
+    gram[:, 0:3, 0:3] = S0
+    gram[:, 3:6, 3:6] = S0
+    gram[:, 6:9, 6:9] = S3
+    gram[:, 0:3, 6:9] = gram[:, 6:9, 0:3] = -S1
+    gram[:, 3:6, 6:9] = gram[:, 6:9, 3:6] = -S2
+    # The nullspace of Mx9 is the eigenvector of the smallest eigenvalue of
+    # the normal matrix (eigh sorts eigenvalues in ascending order)
+    evals, evecs = npl.eigh(gram)
+    h_list = evecs[:, :, 0]
+    H_list = h_list.reshape(num_pairs, 3, 3)
+    return H_list
+
+
 def testdata_matching_affine_inliers():
     import vtool.demodata as demodata
     import vtool as vt
@@ -472,8 +593,357 @@ def _test_hypothesis_inliers(
     return hypo_inliers, hypo_errors
 
 
+def _roundoff_pad(dtype):
+    """ Relative padding of bounds that must hold for tests done in dtype """
+    return max(1e-9, 1e3 * np.finfo(dtype).eps)
+
+
+def _hypothesis_block_size(num_matches, max_block_bytes=None, dtype=SV_DTYPE):
+    """
+    Number of hypotheses that can be tested against all num_matches matches
+    at once without exceeding max_block_bytes of temporary memory.
+    """
+    if max_block_bytes is None:
+        max_block_bytes = MAX_BLOCK_BYTES
+    # conservative count of the temporaries per (hypothesis, match)
+    bytes_per_hypothesis = 16 * np.dtype(dtype).itemsize * max(num_matches, 1)
+    return int(max(1, max_block_bytes // bytes_per_hypothesis))
+
+
+def _det2x2(mats):
+    """ determinants of a stack of 2x2 matrices """
+    return mats[..., 0, 0] * mats[..., 1, 1] - mats[..., 0, 1] * mats[..., 1, 0]
+
+
+def _test_hypothesis_inliers_block(
+    Aff_block,
+    xy1_m,
+    iv1_m,
+    xy2_m,
+    det2_m,
+    ori2_m,
+    xy_thresh_sqrd,
+    scale_thresh_sqrd,
+    ori_thresh,
+):
+    """
+    Vectorized version of :func:`_test_hypothesis_inliers` that tests a block
+    of B hypotheses against all M matches in a single sweep.
+
+    Args:
+        Aff_block (ndarray): (B, 3, 3) affine hypotheses
+        xy1_m (ndarray): (2, M) locations of the matches in image 1
+        iv1_m (ndarray): (M, 2, 2) shape components of invVR1s_m
+        xy2_m (ndarray): (2, M) locations of the matches in image 2
+        det2_m (ndarray): (M,) squared scales of the matches in image 2
+        ori2_m (ndarray): (M,) orientations of the matches in image 2
+
+    Returns:
+        tuple: hypo_flags, hypo_errors - (B, M) inlier flags and a tuple of
+            (B, M) xy, ori, and scale errors
+    """
+    A = Aff_block[:, 0:2, 0:2]
+    t = Aff_block[:, 0:2, 2]
+    # Map keypoint locations from image 1 onto image 2
+    xy1_mt = np.matmul(A, xy1_m)
+    xy1_mt += t[:, :, None]
+    np.subtract(xy1_mt, xy2_m[None, :, :], out=xy1_mt)
+    np.square(xy1_mt, out=xy1_mt)
+    xy_err = xy1_mt.sum(axis=1)
+    del xy1_mt
+    # Map keypoint shapes from image 1 onto image 2. Only the first row of
+    # each mapped shape is needed for the orientation, and the determinant of
+    # a product is the product of determinants.
+    _iv11_mt = np.multiply.outer(A[:, 0, 0], iv1_m[:, 0, 0])
+    _iv11_mt += np.multiply.outer(A[:, 0, 1], iv1_m[:, 1, 0])
+    _iv12_mt = np.multiply.outer(A[:, 0, 0], iv1_m[:, 0, 1])
+    _iv12_mt += np.multiply.outer(A[:, 0, 1], iv1_m[:, 1, 1])
+    _ori1_mt = np.arctan2(_iv12_mt, _iv11_mt, out=_iv12_mt)
+    np.negative(_ori1_mt, out=_ori1_mt)
+    np.mod(_ori1_mt, TAU, out=_ori1_mt)
+    del _iv11_mt
+    _det1_mt = np.multiply.outer(_det2x2(A), _det2x2(iv1_m))
+    # Check for projection errors
+    scale_err = vtool.distance.det_distance(_det1_mt, det2_m[None, :])
+    ori_err = vtool.distance.ori_distance(_ori1_mt, ori2_m[None, :], out=_ori1_mt)
+    # Mark keypoints which are inliers to each hypothosis
+    hypo_flags = np.less(xy_err, xy_thresh_sqrd)
+    hypo_flags &= np.less(ori_err, ori_thresh)
+    hypo_flags &= np.less(scale_err, scale_thresh_sqrd)
+    hypo_errors = (xy_err, ori_err, scale_err)
+    return hypo_flags, hypo_errors
+
+
+# Functions computing the per keypoint arrays stored by get_kpts_mats
+KPTS_MAT_FUNCS = ut.odict(
+    [
+        ('invVR', ktool.get_invVR_mats3x3),
+        ('RV', ktool.get_RV_mats_3x3),
+        ('oris', ktool.get_oris),
+        ('sqrd_scales', ktool.get_sqrd_scales),
+    ]
+)
+
+
+def get_kpts_mats(kpts):
+    """
+    Computes the per keypoint arrays that spatial verification derives from
+    the keypoints of an annotation.
+
+    Verifying a pair only gathers the rows of its matches from these, so an
+    annotation that is matched against many others (e.g. a query in one vs
+    many matching) only builds them once. The result can be passed as
+    kpts1_mats / kpts2_mats to :func:`spatially_verify_kpts` and is stored
+    lazily by :func:`vtool.matching.ensure_metadata_kpts_mats`.
+
+    Args:
+        kpts (ndarray): (N x 6) keypoints
+
+    Returns:
+        dict: invVR (N, 3, 3), RV (N, 3, 3), oris (N,) and sqrd_scales (N,)
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> kpts = demodata.get_dummy_kpts()
+        >>> kpts_mats = get_kpts_mats(kpts)
+        >>> fx = np.array([3, 0, 3])
+        >>> for key, func in KPTS_MAT_FUNCS.items():
+        >>>     expected = func(kpts.astype(np.float64).take(fx, axis=0))
+        >>>     assert np.all(kpts_mats[key].take(fx, axis=0) == expected)
+        >>> print(ut.repr2(ut.map_vals(np.shape, kpts_mats)))
+        {'RV': (5, 3, 3), 'invVR': (5, 3, 3), 'oris': (5,), 'sqrd_scales': (5,)}
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # Verifying with precomputed matrices gives the same result
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> fm = demodata.make_dummy_fm(len(kpts1))
+        >>> fs = np.random.RandomState(0).rand(len(fm))
+        >>> mats_kw = dict(kpts1_mats=get_kpts_mats(kpts1),
+        >>>                kpts2_mats=get_kpts_mats(kpts2))
+        >>> for refine_method in ['homog', 'homog-iter', 'affine']:
+        >>>     kw = dict(match_weights=fs, search='pruned', returnAff=True,
+        >>>               refine_method=refine_method)
+        >>>     svtup1 = spatially_verify_kpts(kpts1, kpts2, fm, **kw)
+        >>>     svtup2 = spatially_verify_kpts(kpts1, kpts2, fm, **ut.dict_union(kw, mats_kw))
+        >>>     assert np.all(svtup1[0] == svtup2[0])
+        >>>     assert np.all(svtup1[2] == svtup2[2])
+        >>>     assert np.all(svtup1[5] == svtup2[5])
+    """
+    # Cast keypoints to float64 like spatially_verify_kpts
+    kpts = kpts.astype(np.float64, casting='same_kind', copy=False)
+    kpts_mats = {key: func(kpts) for key, func in KPTS_MAT_FUNCS.items()}
+    return kpts_mats
+
+
+def _take_kpts_mats(kpts, fx, kpts_mats, keys):
+    """
+    Returns the keypoint arrays named by keys for the keypoints fx. They are
+    gathered from kpts_mats if given and computed from kpts otherwise.
+    """
+    if kpts_mats is None:
+        kpts_m = kpts.take(fx, axis=0)
+        return tuple(KPTS_MAT_FUNCS[key](kpts_m) for key in keys)
+    return tuple(kpts_mats[key].take(fx, axis=0) for key in keys)
+
+
+def _affine_hypothesis_data(
+    kpts1, kpts2, fm, dtype=SV_DTYPE, kpts1_mats=None, kpts2_mats=None
+):
+    """
+    Builds one affine hypothesis per match and the per-match components the
+    hypotheses are tested against.
+
+    Returns:
+        tuple: (Aff_mats, xy1_m, iv1_m, xy2_m, det2_m, ori2_m) all of dtype
+    """
+    # Get keypoints to project in matrix form
+    invVR1s_m, RV1s_m = _take_kpts_mats(kpts1, fm.T[0], kpts1_mats, ['invVR', 'RV'])
+    invVR2s_m, det2_m, ori2_m = _take_kpts_mats(
+        kpts2, fm.T[1], kpts2_mats, ['invVR', 'sqrd_scales', 'oris']
+    )
+    # BUILD ALL HYPOTHESIS TRANSFORMS: The transform from kp1 to kp2 is:
+    Aff_mats = np.matmul(invVR2s_m, RV1s_m)
+    # Get components to project and to test projections against
+    xy1_m = np.ascontiguousarray(ktool.get_invVR_mats_xys(invVR1s_m))
+    iv1_m = np.ascontiguousarray(invVR1s_m[:, 0:2, 0:2])
+    xy2_m = ktool.get_invVR_mats_xys(invVR2s_m)
+    hypo_data = (Aff_mats, xy1_m, iv1_m, xy2_m, det2_m, ori2_m)
+    # The components are cheap to build, only the tests are done in dtype
+    return tuple(arr.astype(dtype, copy=False) for arr in hypo_data)
+
+
+def _iter_affine_hypothesis_blocks(
+    kpts1,
+    kpts2,
+    fm,
+    xy_thresh_sqrd,
+    scale_thresh_sqrd,
+    ori_thresh,
+    max_block_bytes=None,
+    kpts1_mats=None,
+    kpts2_mats=None,
+):
+    """
+    Enumerates all affine hypotheses of the matches in memory bounded blocks.
+
+    Yields:
+        tuple: (Aff_block, hypo_flags, hypo_errors)
+    """
+    hypo_data = _affine_hypothesis_data(
+        kpts1, kpts2, fm, kpts1_mats=kpts1_mats, kpts2_mats=kpts2_mats
+    )
+    Aff_mats = hypo_data[0]
+    thresh_tup = (xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh)
+    block_size = _hypothesis_block_size(len(fm), max_block_bytes)
+    for start in range(0, len(Aff_mats), block_size):
+        Aff_block = Aff_mats[start : start + block_size]
+        hypo_flags, hypo_errors = _test_hypothesis_inliers_block(
+            Aff_block, *(hypo_data[1:] + thresh_tup)
+        )
+        yield Aff_block, hypo_flags, hypo_errors
+
+
+def _build_match_grid(xy1_m, xy2_m, det1_m, det2_m, xy_thresh_sqrd):
+    """
+    Buckets the matches by the grid cells of both of their keypoints.
+
+    Cells in image 2 are as wide as the spatial threshold. Cells in image 1 are
+    rescaled by the typical scale change between the images, so a hypothesis
+    maps a cell in image 1 to roughly one cell in image 2.
+
+    Returns:
+        dict: sortx and offsets (the matches in bucket k are
+            sortx[offsets[k]:offsets[k + 1]]), and the bounding box of each
+            bucket in both images (center1, radius1, low2, high2)
+    """
+    num_matches = xy1_m.shape[1]
+    xy_thresh = np.sqrt(xy_thresh_sqrd)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zoom = np.sqrt(np.median(det1_m / det2_m))
+    cell_size2 = max(xy_thresh, 1e-9)
+    cell_size1 = cell_size2 * zoom if np.isfinite(zoom) and zoom > 0 else cell_size2
+    cell1 = np.floor((xy1_m - xy1_m.min(axis=1)[:, None]) / cell_size1)
+    cell2 = np.floor((xy2_m - xy2_m.min(axis=1)[:, None]) / cell_size2)
+    cells = np.vstack([cell1, cell2]).T.astype(np.int64)
+    _, bucket_ids = np.unique(cells, axis=0, return_inverse=True)
+    bucket_ids = bucket_ids.ravel()
+    sortx = bucket_ids.argsort(kind='mergesort')
+    sizes = np.bincount(bucket_ids)
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    starts = offsets[:-1]
+    # Tight bounding boxes of the members of each bucket
+    xy1_s = xy1_m.take(sortx, axis=1)
+    xy2_s = xy2_m.take(sortx, axis=1)
+    low1 = np.minimum.reduceat(xy1_s, starts, axis=1)
+    high1 = np.maximum.reduceat(xy1_s, starts, axis=1)
+    low2 = np.minimum.reduceat(xy2_s, starts, axis=1)
+    high2 = np.maximum.reduceat(xy2_s, starts, axis=1)
+    grid = {
+        'sortx': sortx,
+        'offsets': offsets,
+        'sizes': sizes,
+        'center1': (low1 + high1) / 2,
+        'radius1': np.sqrt(((high1 - low1) ** 2).sum(axis=0)) / 2,
+        'low2': low2,
+        'high2': high2,
+        'num_matches': num_matches,
+    }
+    return grid
+
+
+def _test_hypothesis_weights_grid(
+    Aff_block,
+    grid,
+    fs,
+    xy1_m,
+    iv1_m,
+    xy2_m,
+    det2_m,
+    ori2_m,
+    xy_thresh_sqrd,
+    scale_thresh_sqrd,
+    ori_thresh,
+):
+    """
+    Computes the inlier weight of a block of hypotheses, only testing the
+    matches that can be within the spatial threshold.
+
+    A bucket of matches is skipped if its projected bounding box in image 1 is
+    farther than the threshold from its bounding box in image 2. The
+    remaining (hypothesis, match) pairs are tested with the cheap xy error
+    first, and only pairs passing it get the scale and orientation tests.
+
+    Returns:
+        ndarray: inlier weight of each hypothesis in the block
+    """
+    num_hypos = len(Aff_block)
+    A = Aff_block[:, 0:2, 0:2]
+    t = Aff_block[:, 0:2, 2]
+    xy_thresh = np.sqrt(xy_thresh_sqrd)
+    # Where each hypothesis maps the center of each bucket in image 1
+    centers_mt = np.matmul(A, grid['center1']) + t[:, :, None]
+    dist_lo = grid['low2'][None, :, :] - centers_mt
+    dist_hi = centers_mt - grid['high2'][None, :, :]
+    gap = np.maximum(np.maximum(dist_lo, dist_hi), 0)
+    gap_sqrd = (gap ** 2).sum(axis=1)
+    # A hypothesis moves points by at most its (frobenius) norm times the
+    # distance to the center. Pad the reach to absorb roundoff.
+    stretch = np.sqrt((A ** 2).sum(axis=(1, 2)))
+    reach = xy_thresh + stretch[:, None] * grid['radius1'][None, :]
+    reach *= 1 + _roundoff_pad(A.dtype)
+    hypo_xs, bucket_xs = np.nonzero(gap_sqrd <= reach ** 2)
+    # Expand surviving buckets into (hypothesis, match) pairs
+    counts = grid['sizes'].take(bucket_xs)
+    pair_hypo_xs = np.repeat(hypo_xs, counts)
+    # position of each pair within the sorted matches
+    pair_offsets = np.repeat(
+        grid['offsets'].take(bucket_xs) - np.cumsum(counts) + counts, counts
+    )
+    pair_match_xs = grid['sortx'].take(pair_offsets + np.arange(len(pair_hypo_xs)))
+    # Cheap spatial test
+    A_p = A.take(pair_hypo_xs, axis=0)
+    xy1_p = xy1_m.take(pair_match_xs, axis=1)
+    xy1_pt = (A_p * xy1_p.T[:, None, :]).sum(axis=2) + t.take(pair_hypo_xs, axis=0)
+    xy_err = ((xy1_pt - xy2_m.take(pair_match_xs, axis=1).T) ** 2).sum(axis=1)
+    xy_flags = xy_err < xy_thresh_sqrd
+    pair_hypo_xs = pair_hypo_xs.compress(xy_flags)
+    pair_match_xs = pair_match_xs.compress(xy_flags)
+    A_p = A_p.compress(xy_flags, axis=0)
+    # Shape tests on the spatial inliers
+    iv1_p = iv1_m.take(pair_match_xs, axis=0)
+    _iv11 = A_p[:, 0, 0] * iv1_p[:, 0, 0] + A_p[:, 0, 1] * iv1_p[:, 1, 0]
+    _iv12 = A_p[:, 0, 0] * iv1_p[:, 0, 1] + A_p[:, 0, 1] * iv1_p[:, 1, 1]
+    _ori1_pt = (-np.arctan2(_iv12, _iv11)) % TAU
+    _det1_pt = _det2x2(A_p) * _det2x2(iv1_p)
+    scale_err = vtool.distance.det_distance(_det1_pt, det2_m.take(pair_match_xs))
+    ori_err = vtool.distance.ori_distance(_ori1_pt, ori2_m.take(pair_match_xs))
+    flags = np.less(scale_err, scale_thresh_sqrd)
+    flags &= np.less(ori_err, ori_thresh)
+    weight_list = np.bincount(
+        pair_hypo_xs.compress(flags),
+        weights=fs.take(pair_match_xs.compress(flags)),
+        minlength=num_hypos,
+    )
+    return weight_list
+
+
 def get_affine_inliers(
-    kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh
+    kpts1,
+    kpts2,
+    fm,
+    fs,
+    xy_thresh_sqrd,
+    scale_thresh_sqrd,
+    ori_thresh,
+    max_block_bytes=None,
+    kpts1_mats=None,
+    kpts2_mats=None,
 ):
     """
     Estimates inliers deterministically using elliptical shapes
@@ -482,6 +952,13 @@ def get_affine_inliers(
     We transform from chip1 -> chip2
     The determinants are squared keypoint scales
 
+    Hypotheses are tested in vectorized blocks. The size of each block is
+    chosen so the temporary memory stays under max_block_bytes (defaults to
+    MAX_BLOCK_BYTES).
+
+    The keypoint matrices are gathered from kpts1_mats / kpts2_mats if they
+    are given (see :func:`get_kpts_mats`).
+
     Returns:
         tuple: aff_inliers_list, aff_errors_list, Aff_mats
 
@@ -513,85 +990,406 @@ def get_affine_inliers(
         >>> aff_inliers_list, aff_errors_list, Aff_mats = output
         >>> result = 'nInliers=%r hash=%s' % (len(aff_inliers_list), ut.hash_data(output_str))
         >>> print(result)
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # The blocked engine agrees with testing one hypothesis at a time
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> from vtool.spatial_verification import _test_hypothesis_inliers
+        >>> import vtool.demodata as demodata
+        >>> import vtool.keypoint as ktool
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> kpts1, kpts2 = kpts1.astype(np.float64), kpts2.astype(np.float64)
+        >>> fm = demodata.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> fs = np.ones(len(fm), dtype=np.float64)
+        >>> xy_thresh_sqrd = .01 * ktool.get_kpts_dlen_sqrd(kpts2)
+        >>> args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> # Force several blocks
+        >>> output = get_affine_inliers(*args, max_block_bytes=10000)
+        >>> aff_inliers_list, aff_errors_list, Aff_mats = output
+        >>> kpts1_m, kpts2_m = kpts1[fm.T[0]], kpts2[fm.T[1]]
+        >>> invVR1s_m = ktool.get_invVR_mats3x3(kpts1_m)
+        >>> xy2_m = ktool.get_xys(kpts2_m)
+        >>> det2_m = ktool.get_sqrd_scales(kpts2_m)
+        >>> ori2_m = ktool.get_oris(kpts2_m)
+        >>> for Aff, inliers, errors in zip(Aff_mats, aff_inliers_list, aff_errors_list):
+        >>>     inliers_, errors_ = _test_hypothesis_inliers(
+        >>>         Aff, invVR1s_m, xy2_m, det2_m, ori2_m, *args[4:])
+        >>>     assert np.all(inliers == inliers_)
+        >>>     assert np.allclose(errors, errors_)
     """
     # http://ipython-books.github.io/featured-01/
-    kpts1_m = kpts1.take(fm.T[0], axis=0)
-    kpts2_m = kpts2.take(fm.T[1], axis=0)
-
-    # Get keypoints to project in matrix form
-    # invVR2s_m = ktool.get_invV_mats(kpts2_m, with_trans=True, with_ori=True)
-    # invVR1s_m = ktool.get_invV_mats(kpts1_m, with_trans=True, with_ori=True)
-    invVR2s_m = ktool.get_invVR_mats3x3(kpts2_m)
-    invVR1s_m = ktool.get_invVR_mats3x3(kpts1_m)
-    RV1s_m = ktool.invert_invV_mats(invVR1s_m)  # 539 us
-    # BUILD ALL HYPOTHESIS TRANSFORMS: The transform from kp1 to kp2 is:
-    Aff_mats = np.matmul(invVR2s_m, RV1s_m)
-    # Get components to test projects against
-    xy2_m = ktool.get_xys(kpts2_m)
-    det2_m = ktool.get_sqrd_scales(kpts2_m)
-    ori2_m = ktool.get_oris(kpts2_m)
-    # SLOWER EQUIVALENT
-    # RV1s_m    = ktool.get_V_mats(kpts1_m, with_trans=True, with_ori=True)  # 5.2 ms
-    # xy2_m  = ktool.get_invVR_mats_xys(invVR2s_m)
-    # ori2_m = ktool.get_invVR_mats_oris(invVR2s_m)
-    # assert np.all(ktool.get_oris(kpts2_m) == ktool.get_invVR_mats_oris(invVR2s_m))
-    # assert np.all(ktool.get_xys(kpts2_m) == ktool.get_invVR_mats_xys(invVR2s_m))
-
-    # The previous versions of this function were all roughly comparable.
-    # The for loop one was the slowest. I'm deciding to go with the one
-    # where there is no internal function definition. It was moderately faster,
-    # and it gives us access to profile that function
-    inliers_and_errors_list = [
-        _test_hypothesis_inliers(
-            Aff,
-            invVR1s_m,
-            xy2_m,
-            det2_m,
-            ori2_m,
-            xy_thresh_sqrd,
-            scale_thresh_sqrd,
-            ori_thresh,
-        )
-        for Aff in Aff_mats
-    ]
-    aff_inliers_list = [tup[0] for tup in inliers_and_errors_list]
-    aff_errors_list = [tup[1] for tup in inliers_and_errors_list]
+    aff_inliers_list = []
+    aff_errors_list = []
+    Aff_mats_list = []
+    for Aff_block, hypo_flags, hypo_errors in _iter_affine_hypothesis_blocks(
+        kpts1,
+        kpts2,
+        fm,
+        xy_thresh_sqrd,
+        scale_thresh_sqrd,
+        ori_thresh,
+        max_block_bytes=max_block_bytes,
+        kpts1_mats=kpts1_mats,
+        kpts2_mats=kpts2_mats,
+    ):
+        aff_inliers_list.extend(np.where(flags)[0] for flags in hypo_flags)
+        aff_errors_list.extend(zip(*hypo_errors))
+        Aff_mats_list.append(Aff_block)
+    if len(Aff_mats_list) == 0:
+        Aff_mats = np.empty((0, 3, 3), dtype=SV_DTYPE)
+    else:
+        Aff_mats = np.vstack(Aff_mats_list)
     return aff_inliers_list, aff_errors_list, Aff_mats
 
 
 def get_best_affine_inliers(
-    kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh, forcepy=False
+    kpts1,
+    kpts2,
+    fm,
+    fs,
+    xy_thresh_sqrd,
+    scale_thresh,
+    ori_thresh,
+    forcepy=False,
+    search='exhaustive',
+    hypothesis_sampling=None,
+    num_hypotheses=500,
+    hypothesis_seed=0,
+    spatial_index=False,
+    dtype=SV_DTYPE,
+    kpts1_mats=None,
+    kpts2_mats=None,
+    deterministic=False,
 ):
     """ Tests each hypothesis and returns only the best transformation and inliers
+
+    Args:
+        search (str): either 'exhaustive' or 'pruned'. The pruned search
+            tests hypotheses with the largest possible inlier weight first and
+            stops once no remaining hypothesis can beat the current best. It
+            returns the same hypothesis as the exhaustive python search.
+            Match weights must be non-negative for the bound to hold;
+            otherwise the search falls back to exhaustive.
+        hypothesis_sampling (str): if 'random' or 'stratified', only
+            num_hypotheses hypotheses are tested (each still against all
+            matches). See :func:`sample_affine_hypotheses`.
+        num_hypotheses (int): hypothesis budget used by hypothesis_sampling
+        hypothesis_seed (int): seed for hypothesis_sampling
+        spatial_index (bool): if True, buckets the matches in a grid over both
+            images so each hypothesis only tests matches that can be within
+            the spatial threshold. The result is the same as without the index
+            (up to floating point ties in the inlier weights).
+        dtype (dtype): precision of the hypothesis tests, SV_DTYPE (float64)
+            or SV_FAST_DTYPE (float32). The errors and matrix are returned in
+            this dtype. See :func:`spatially_verify_kpts` for the tolerance.
+        kpts1_mats (dict): precomputed keypoint matrices of kpts1 (see
+            :func:`get_kpts_mats`). Only used by the python search.
+        kpts2_mats (dict): precomputed keypoint matrices of kpts2
+        deterministic (bool): sum the inlier weights of the python search in
+            match order (like libsver) instead of with a BLAS product, whose
+            summation order can depend on the memory layout. Hypotheses with
+            the same inliers then always have exactly the same weight. The C
+            searches are deterministic either way.
+
+    CommandLine:
+        python -m xdoctest vtool.spatial_verification get_best_affine_inliers
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> import vtool.keypoint as ktool
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> kpts1, kpts2 = kpts1.astype(np.float64), kpts2.astype(np.float64)
+        >>> rng = np.random.RandomState(0)
+        >>> fm = demodata.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> # Add noisy matches with random scales
+        >>> noise_fm = rng.randint(0, len(kpts1), size=(200, 2)).astype(np.int32)
+        >>> fm = np.vstack([fm, noise_fm])
+        >>> kpts1[:, 2:5] *= rng.rand(len(kpts1), 1) * 4 + .1
+        >>> fs = rng.rand(len(fm))
+        >>> xy_thresh_sqrd = .01 * ktool.get_kpts_dlen_sqrd(kpts2)
+        >>> args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> exhaustive = get_best_affine_inliers(*args, forcepy=True)
+        >>> pruned = get_best_affine_inliers(*args, search='pruned')
+        >>> assert np.all(exhaustive[0] == pruned[0])
+        >>> assert np.all(exhaustive[2] == pruned[2])
+        >>> indexed = get_best_affine_inliers(*args, forcepy=True, spatial_index=True)
+        >>> assert np.all(exhaustive[0] == indexed[0])
+        >>> assert np.all(exhaustive[2] == indexed[2])
     """
+    if search not in {'exhaustive', 'pruned'}:
+        raise ValueError('Unknown search=%r' % (search,))
+    hypo_subset = None
+    if hypothesis_sampling is not None and len(fm) > num_hypotheses:
+        hypo_subset = sample_affine_hypotheses(
+            fs, num_hypotheses, method=hypothesis_sampling, rng=hypothesis_seed
+        )
+    use_c = not forcepy and have_sver_c_wrapper()
+    if use_c and spatial_index and search == 'exhaustive' and hypo_subset is None:
+        return sver_c_wrapper.get_best_affine_inliers_cpp(
+            kpts1,
+            kpts2,
+            fm,
+            fs,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            spatial_index=True,
+            dtype=dtype,
+        )
+    if search == 'pruned' or hypo_subset is not None or spatial_index:
+        return _get_best_affine_inliers_blocked(
+            kpts1,
+            kpts2,
+            fm,
+            fs,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            prune=search == 'pruned',
+            hypo_subset=hypo_subset,
+            spatial_index=spatial_index,
+            dtype=dtype,
+            kpts1_mats=kpts1_mats,
+            kpts2_mats=kpts2_mats,
+            deterministic=deterministic,
+        )
     # Test each affine hypothesis
-    # get list if inliers, errors, the affine matrix for each hypothesis
-    if HAVE_SVER_C_WRAPPER and not forcepy:
-        (
-            aff_inliers_list,
-            aff_errors_list,
-            Aff_mats,
-        ) = sver_c_wrapper.get_affine_inliers_cpp(
-            kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh
+    if use_c:
+        # Only the per-hypothesis weights and the inliers of the best one are
+        # returned, so memory stays linear in the number of matches.
+        # Ties go to the smallest index (like argmax).
+        compact_out = sver_c_wrapper.get_affine_inliers_cpp(
+            kpts1,
+            kpts2,
+            fm,
+            fs,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            dtype=dtype,
+            compact=True,
+            top_k=1,
         )
+        top_inliers_list, top_errors_list, top_mats = compact_out[3:6]
+        aff_inliers = top_inliers_list[0]
+        aff_errors = top_errors_list[0]
+        Aff = top_mats[0]
+        return aff_inliers, aff_errors, Aff
     else:
-        aff_inliers_list, aff_errors_list, Aff_mats = get_affine_inliers(
-            kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh
+        return _get_best_affine_inliers_blocked(
+            kpts1,
+            kpts2,
+            fm,
+            fs,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            dtype=dtype,
+            kpts1_mats=kpts1_mats,
+            kpts2_mats=kpts2_mats,
+            deterministic=deterministic,
         )
 
-    # ut.embed()
-    # Determine the best hypothesis using the number of inliers
-    # TODO: other measures in the error lists could be used as well
-    # nInliers_list = np.array([len(inliers) for inliers in aff_inliers_list])
 
-    weight_list = np.array([fs.take(inliers).sum() for inliers in aff_inliers_list])
-    # ut.embed()
-    # sortx = weight_list.argsort()[::-1]  # sort by non-inliers
-    # best_index = sortx[0]  # chose best
-    best_index = weight_list.argmax()
-    aff_inliers = aff_inliers_list[best_index]
-    aff_errors = aff_errors_list[best_index]
+def sample_affine_hypotheses(fs, num_hypotheses, method='random', rng=None):
+    """
+    Chooses a fixed budget of matches to build affine hypotheses from.
+
+    Args:
+        fs (ndarray): match weights
+        num_hypotheses (int): number of hypotheses to choose
+        method (str): 'random' draws uniformly without replacement.
+            'stratified' splits the matches into num_hypotheses strata of
+            consecutive weight rank and draws one match from each, so strong
+            and weak matches are both represented.
+        rng (int or RandomState): seed
+
+    Returns:
+        ndarray: sorted indexes of the chosen matches
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> fs = np.linspace(0, 1, 100)
+        >>> hypo_idxs = sample_affine_hypotheses(fs, 5, 'stratified', rng=0)
+        >>> print(hypo_idxs)
+        [11 29 47 65 89]
+        >>> hypo_idxs = sample_affine_hypotheses(fs, 5, 'random', rng=0)
+        >>> print(hypo_idxs)
+        [ 2 26 55 75 86]
+    """
+    num_matches = len(fs)
+    if num_hypotheses >= num_matches:
+        return np.arange(num_matches)
+    rng = vtool.other.ensure_rng(rng)
+    if method == 'random':
+        hypo_idxs = rng.choice(num_matches, num_hypotheses, replace=False)
+    elif method == 'stratified':
+        sortx = np.argsort(-np.asarray(fs), kind='mergesort')
+        edges = np.linspace(0, num_matches, num_hypotheses + 1).astype(np.int64)
+        offsets = (rng.rand(num_hypotheses) * np.diff(edges)).astype(np.int64)
+        hypo_idxs = sortx.take(edges[:-1] + offsets)
+    else:
+        raise ValueError('Unknown hypothesis sampling method=%r' % (method,))
+    return np.sort(hypo_idxs)
+
+
+def _affine_hypothesis_upper_bounds(
+    kpts1,
+    kpts2,
+    fm,
+    fs,
+    scale_thresh,
+    kpts1_mats=None,
+    kpts2_mats=None,
+    dtype=SV_DTYPE,
+):
+    """
+    Upper bound on the inlier weight of every affine hypothesis.
+
+    The hypothesis built from match i maps the shape of keypoint j to a
+    squared scale of det1_j * det2_i / det1_i, so its scale error against
+    match j only depends on the ratios s = det1 / det2. A match can only be an
+    inlier of hypothesis i if abs(log(s_i) - log(s_j)) < log(scale_thresh).
+    Summing the weights of those matches bounds the inlier weight of the
+    hypothesis (the xy and ori tests can only remove inliers). The window is
+    widened by the roundoff of scale tests done in dtype.
+
+    Returns:
+        ndarray: bounds or None if the bound does not hold for these inputs
+    """
+    if np.any(fs < 0) or scale_thresh <= 1:
+        return None
+    (det1_m,) = _take_kpts_mats(kpts1, fm.T[0], kpts1_mats, ['sqrd_scales'])
+    (det2_m,) = _take_kpts_mats(kpts2, fm.T[1], kpts2_mats, ['sqrd_scales'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_s = np.log(det1_m / det2_m)
+    if not np.all(np.isfinite(log_s)):
+        return None
+    # Widen the window so roundoff in the scale tests never excludes a real
+    # inlier
+    pad = _roundoff_pad(dtype)
+    radius = np.log(scale_thresh) * (1 + pad) + pad
+    sortx = log_s.argsort()
+    sorted_log_s = log_s.take(sortx)
+    cumsum = np.zeros(len(fs) + 1, dtype=np.float64)
+    np.cumsum(fs.take(sortx), out=cumsum[1:])
+    lows = np.searchsorted(sorted_log_s, log_s - radius, side='left')
+    highs = np.searchsorted(sorted_log_s, log_s + radius, side='right')
+    bounds = cumsum.take(highs) - cumsum.take(lows)
+    return bounds
+
+
+def _hypothesis_weights(hypo_flags, fs, deterministic=False):
+    """
+    Inlier weight of each hypothesis given its (B, M) inlier flags. If
+    deterministic the weights are accumulated in match order, which gives
+    the same sums as libsver and does not depend on the memory layout.
+    """
+    if deterministic:
+        ordered_fs = np.where(hypo_flags, fs[None, :], 0.0)
+        return np.add.accumulate(ordered_fs, axis=1)[:, -1]
+    return np.dot(hypo_flags, fs)
+
+
+def _get_best_affine_inliers_blocked(
+    kpts1,
+    kpts2,
+    fm,
+    fs,
+    xy_thresh_sqrd,
+    scale_thresh,
+    ori_thresh,
+    max_block_bytes=None,
+    prune=False,
+    hypo_subset=None,
+    spatial_index=False,
+    dtype=SV_DTYPE,
+    kpts1_mats=None,
+    kpts2_mats=None,
+    deterministic=False,
+):
+    """
+    Python implementation of get_best_affine_inliers. Only one block of
+    hypotheses is kept in memory at a time. Ties are resolved towards the
+    hypothesis with the smallest index (like argmax).
+
+    If prune is True hypotheses are tested in order of decreasing upper bound
+    on their inlier weight and the search stops once the bound of every
+    remaining hypothesis is below the best weight found so far.
+
+    If hypo_subset is given only those hypotheses are tested.
+
+    If spatial_index is True the matches are bucketed in a grid and each
+    hypothesis only tests the buckets that can contain inliers.
+
+    The hypotheses are tested in dtype, but the inlier weights are always
+    summed in float64 (in match order if deterministic is True).
+    """
+    num_matches = len(fm)
+    fs = np.asarray(fs, dtype=np.float64)
+    hypo_data = _affine_hypothesis_data(
+        kpts1, kpts2, fm, dtype=dtype, kpts1_mats=kpts1_mats, kpts2_mats=kpts2_mats
+    )
+    Aff_mats = hypo_data[0]
+    # arguments shared by every call to the hypothesis tests
+    test_args = hypo_data[1:] + (xy_thresh_sqrd, scale_thresh, ori_thresh)
+    bounds = None
+    hypo_order = np.arange(num_matches) if hypo_subset is None else hypo_subset
+    block_size = _hypothesis_block_size(num_matches, max_block_bytes, dtype)
+    grid = None
+    if spatial_index:
+        xy1_m, iv1_m, xy2_m, det2_m = hypo_data[1:5]
+        grid = _build_match_grid(xy1_m, xy2_m, _det2x2(iv1_m), det2_m, xy_thresh_sqrd)
+    if prune:
+        bounds = _affine_hypothesis_upper_bounds(
+            kpts1, kpts2, fm, fs, scale_thresh, kpts1_mats, kpts2_mats, dtype
+        )
+    if bounds is not None:
+        # largest bound first; equal bounds in index order
+        hypo_order = hypo_order.take(
+            np.lexsort((hypo_order, -bounds.take(hypo_order)))
+        )
+        # small blocks let the search stop early
+        block_size = min(block_size, max(16, len(hypo_order) // 32))
+    best_weight = -np.inf
+    best_index = None
+    num_tested = 0
+    for start in range(0, len(hypo_order), block_size):
+        hypo_idxs = hypo_order[start : start + block_size]
+        if bounds is not None:
+            # Pad the bound against roundoff in the summations
+            if bounds[hypo_idxs[0]] * (1 + _roundoff_pad(dtype)) < best_weight:
+                break
+        num_tested += len(hypo_idxs)
+        Aff_block = Aff_mats.take(hypo_idxs, axis=0)
+        if grid is not None:
+            weight_list = _test_hypothesis_weights_grid(
+                Aff_block, grid, fs, *test_args
+            )
+        else:
+            hypo_flags, _ = _test_hypothesis_inliers_block(Aff_block, *test_args)
+            weight_list = _hypothesis_weights(hypo_flags, fs, deterministic)
+        block_weight = weight_list.max()
+        tied_xs = np.flatnonzero(weight_list == block_weight)
+        hypo_index = hypo_idxs.take(tied_xs).min()
+        if block_weight > best_weight or (
+            block_weight == best_weight and hypo_index < best_index
+        ):
+            best_weight = block_weight
+            best_index = hypo_index
+    if VERBOSE_SVER:
+        print('[sver] tested %d / %d hypotheses' % (num_tested, len(hypo_order)))
+    # Recompute the inliers and errors of the winning hypothesis
     Aff = Aff_mats[best_index]
+    hypo_flags, hypo_errors = _test_hypothesis_inliers_block(
+        Aff[None, :, :], *test_args
+    )
+    aff_inliers = np.where(hypo_flags[0])[0]
+    aff_errors = tuple(err[0] for err in hypo_errors)
     return aff_inliers, aff_errors, Aff
 
 
@@ -622,9 +1420,14 @@ def unnormalize_transform(M_prime, T1, T2):
     return M
 
 
-def estimate_refined_transform(kpts1, kpts2, fm, aff_inliers, refine_method='homog'):
+def estimate_refined_transform(
+    kpts1, kpts2, fm, aff_inliers, refine_method='homog', H_prime=None
+):
     """ estimates final transformation using normalized affine inliers
 
+    If H_prime is given it is used as the transform between the normalized
+    inliers instead of solving for it (e.g. from :func:`compute_homog_batch`).
+
     References:
         http://docs.opencv.org/2.4/modules/calib3d/doc/camera_calibration_and_3d_reconstruction.html
     """
@@ -636,7 +1439,9 @@ def estimate_refined_transform(kpts1, kpts2, fm, aff_inliers, refine_method='hom
     # homographys assume the two images are planar, or the camera is
     # rotating around the subject
 
-    if refine_method == 'homog':
+    if H_prime is not None:
+        pass
+    elif refine_method == 'homog':
         H_prime = compute_homog(xy1_man, xy2_man)
     elif refine_method == 'affine':
         H_prime = compute_affine(xy1_man, xy2_man)
@@ -671,7 +1476,16 @@ def estimate_refined_transform(kpts1, kpts2, fm, aff_inliers, refine_method='hom
 
 
 def test_homog_errors(
-    H, kpts1, kpts2, fm, xy_thresh_sqrd, scale_thresh, ori_thresh, full_homog_checks=True
+    H,
+    kpts1,
+    kpts2,
+    fm,
+    xy_thresh_sqrd,
+    scale_thresh,
+    ori_thresh,
+    full_homog_checks=True,
+    kpts1_mats=None,
+    kpts2_mats=None,
 ):
     r"""
     Test to see which keypoints the homography correctly maps
@@ -685,6 +1499,9 @@ def test_homog_errors(
         scale_thresh (float):
         ori_thresh (float):  angle in radians
         full_homog_checks (bool):
+        kpts1_mats (dict): precomputed keypoint matrices of kpts1 (see
+            :func:`get_kpts_mats`)
+        kpts2_mats (dict): precomputed keypoint matrices of kpts2
 
     Returns:
         tuple: homog_tup1
@@ -790,8 +1607,10 @@ def test_homog_errors(
     if full_homog_checks:
         # TODO: may need to use more than one reference point
         # Use reference point for scale and orientation tests
-        oris1_m = ktool.get_oris(kpts1_m)
-        scales1_m = ktool.get_scales(kpts1_m)
+        oris1_m, sqrd_scales1_m = _take_kpts_mats(
+            kpts1, fm.T[0], kpts1_mats, ['oris', 'sqrd_scales']
+        )
+        scales1_m = np.sqrt(sqrd_scales1_m)
         # Get point offsets with unit length
         dxy1_m = np.vstack((np.sin(oris1_m), -np.cos(oris1_m)))
         scaled_dxy1_m = dxy1_m * scales1_m[None, :]
@@ -806,8 +1625,9 @@ def test_homog_errors(
         # adjust for gravity vector being 0
         oris1_mt = np.arctan2(dxy1_mt[1], dxy1_mt[0]) - ktool.GRAVITY_THETA
         _det1_mt = scales1_mt ** 2
-        det2_m = ktool.get_sqrd_scales(kpts2_m)
-        ori2_m = ktool.get_oris(kpts2_m)
+        det2_m, ori2_m = _take_kpts_mats(
+            kpts2, fm.T[1], kpts2_mats, ['sqrd_scales', 'oris']
+        )
         # xy_err    = vtool.distance.L2_sqrd(xy2_m.T, _xy1_mt.T)
         scale_err = vtool.distance.det_distance(_det1_mt, det2_m)
         ori_err = vtool.distance.ori_distance(oris1_mt, ori2_m)
@@ -834,17 +1654,24 @@ def test_homog_errors(
 
 
 def test_affine_errors(
-    H, kpts1, kpts2, fm, xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh
+    H,
+    kpts1,
+    kpts2,
+    fm,
+    xy_thresh_sqrd,
+    scale_thresh_sqrd,
+    ori_thresh,
+    kpts1_mats=None,
+    kpts2_mats=None,
 ):
     """
     used for refinement as opposed to initial estimation
     """
-    kpts1_m = kpts1.take(fm.T[0], axis=0)
-    kpts2_m = kpts2.take(fm.T[1], axis=0)
-    invVR1s_m = ktool.get_invVR_mats3x3(kpts1_m)
-    xy2_m = ktool.get_xys(kpts2_m)
-    det2_m = ktool.get_sqrd_scales(kpts2_m)
-    ori2_m = ktool.get_oris(kpts2_m)
+    (invVR1s_m,) = _take_kpts_mats(kpts1, fm.T[0], kpts1_mats, ['invVR'])
+    xy2_m = ktool.get_xys(kpts2.take(fm.T[1], axis=0))
+    det2_m, ori2_m = _take_kpts_mats(
+        kpts2, fm.T[1], kpts2_mats, ['sqrd_scales', 'oris']
+    )
     refined_inliers, refined_errors = _test_hypothesis_inliers(
         H, invVR1s_m, xy2_m, det2_m, ori2_m, xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh
     )
@@ -852,21 +1679,408 @@ def test_affine_errors(
     return refined_tup1
 
 
-def refine_inliers(
-    kpts1,
-    kpts2,
-    fm,
-    aff_inliers,
-    xy_thresh_sqrd,
-    scale_thresh=2.0,
+def _homog_match_data(
+    kpts1, kpts2, fm, full_homog_checks=True, kpts1_mats=None, kpts2_mats=None
+):
+    """
+    Gathers the per-match arrays that homographies are tested against. They
+    do not depend on the homography, so they can be reused while it is being
+    refined.
+
+    Returns:
+        tuple: (pts1_m, xy2_m, det2_m, ori2_m). pts1_m holds the (3, M)
+            homogeneous locations in image 1 followed (if full_homog_checks)
+            by the (3, M) reference points one scale away along each
+            orientation. det2_m and ori2_m are None without full_homog_checks.
+    """
+    num_matches = len(fm)
+    xy1_m = ktool.get_xys(kpts1.take(fm.T[0], axis=0))
+    xy2_m = ktool.get_xys(kpts2.take(fm.T[1], axis=0)).astype(SV_DTYPE)
+    num_pts = 2 * num_matches if full_homog_checks else num_matches
+    pts1_m = np.ones((3, num_pts), dtype=SV_DTYPE)
+    pts1_m[0:2, 0:num_matches] = xy1_m
+    det2_m = ori2_m = None
+    if full_homog_checks:
+        # Use reference point for scale and orientation tests
+        oris1_m, sqrd_scales1_m = _take_kpts_mats(
+            kpts1, fm.T[0], kpts1_mats, ['oris', 'sqrd_scales']
+        )
+        scales1_m = np.sqrt(sqrd_scales1_m)
+        # numpy's sin and cos can round differently from call to call on
+        # strided input (the orientations are a column of the keypoints)
+        oris1_m = np.ascontiguousarray(oris1_m)
+        off_xy1_m = pts1_m[0:2, num_matches:]
+        np.multiply(np.sin(oris1_m), scales1_m, out=off_xy1_m[0])
+        np.multiply(np.negative(np.cos(oris1_m)), scales1_m, out=off_xy1_m[1])
+        off_xy1_m += xy1_m
+        det2_m, ori2_m = _take_kpts_mats(
+            kpts2, fm.T[1], kpts2_mats, ['sqrd_scales', 'oris']
+        )
+    return pts1_m, xy2_m, det2_m, ori2_m
+
+
+def _homog_error_buffers(num_matches, full_homog_checks=True):
+    """ Output buffers for :func:`_homog_errors_into` """
+    num_pts = 2 * num_matches if full_homog_checks else num_matches
+    buffers = {
+        'pts1_mt': np.empty((3, num_pts), dtype=SV_DTYPE),
+        'dxy': np.empty((2, num_matches), dtype=SV_DTYPE),
+        'xy_err': np.empty(num_matches, dtype=SV_DTYPE),
+        'flags': np.empty(num_matches, dtype=np.bool_),
+    }
+    if full_homog_checks:
+        buffers['ori_err'] = np.empty(num_matches, dtype=SV_DTYPE)
+        buffers['scale_err'] = np.empty(num_matches, dtype=SV_DTYPE)
+        buffers['tmp'] = np.empty(num_matches, dtype=SV_DTYPE)
+        buffers['tmp_flags'] = np.empty(num_matches, dtype=np.bool_)
+    return buffers
+
+
+def _homog_errors_into(
+    H,
+    match_data,
+    xy_thresh_sqrd,
+    scale_thresh,
+    ori_thresh,
+    full_homog_checks,
+    buffers,
+):
+    """
+    Single pass version of the error tests in :func:`test_homog_errors`. Every
+    intermediate is written into buffers, so the returned errors are views
+    that the next call with the same buffers overwrites.
+
+    Returns:
+        tuple: (refined_inliers, refined_errors)
+    """
+    pts1_m, xy2_m, det2_m, ori2_m = match_data
+    num_matches = xy2_m.shape[1]
+    # Transform the locations (and reference points) into image 2
+    pts1_mt = np.matmul(H, pts1_m, out=buffers['pts1_mt'])
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        np.divide(pts1_mt[0:2], pts1_mt[2:3], out=pts1_mt[0:2])
+    xy1_mt = pts1_mt[0:2, 0:num_matches]
+    # --- Find (Squared) Homography Distance Error ---
+    dxy = buffers['dxy']
+    xy_err = buffers['xy_err']
+    np.subtract(xy1_mt, xy2_m, out=dxy)
+    np.multiply(dxy, dxy, out=dxy)
+    np.add(dxy[0], dxy[1], out=xy_err)
+    flags = np.less(xy_err, xy_thresh_sqrd, out=buffers['flags'])
+    if not full_homog_checks:
+        refined_inliers = np.flatnonzero(flags).astype(INDEX_DTYPE)
+        return refined_inliers, (xy_err, None, None)
+    ori_err = buffers['ori_err']
+    scale_err = buffers['scale_err']
+    tmp = buffers['tmp']
+    tmp_flags = buffers['tmp_flags']
+    # The transformed offset to the reference point gives the scale and
+    # orientation of each mapped keypoint
+    np.subtract(xy1_mt, pts1_mt[0:2, num_matches:], out=dxy)
+    np.arctan2(dxy[1], dxy[0], out=ori_err)
+    # adjust for gravity vector being 0
+    np.subtract(ori_err, ktool.GRAVITY_THETA, out=ori_err)
+    # cyclic distance to the orientations in image 2
+    np.subtract(ori_err, ori2_m, out=ori_err)
+    np.abs(ori_err, out=ori_err)
+    np.mod(ori_err, TAU, out=ori_err)
+    np.subtract(TAU, ori_err, out=tmp)
+    np.minimum(ori_err, tmp, out=ori_err)
+    # ratio of the squared scales, flipped to be at least 1
+    np.multiply(dxy, dxy, out=dxy)
+    np.add(dxy[0], dxy[1], out=scale_err)
+    np.divide(scale_err, det2_m, out=scale_err)
+    np.reciprocal(scale_err, out=tmp)
+    np.maximum(scale_err, tmp, out=scale_err)
+    flags &= np.less(ori_err, ori_thresh, out=tmp_flags)
+    flags &= np.less(scale_err, scale_thresh, out=tmp_flags)
+    refined_inliers = np.flatnonzero(flags).astype(INDEX_DTYPE)
+    refined_errors = (xy_err, ori_err, scale_err)
+    return refined_inliers, refined_errors
+
+
+def test_homog_errors_fused(
+    H,
+    kpts1,
+    kpts2,
+    fm,
+    xy_thresh_sqrd,
+    scale_thresh,
+    ori_thresh,
+    full_homog_checks=True,
+    kpts1_mats=None,
+    kpts2_mats=None,
+):
+    """
+    Fused version of :func:`test_homog_errors` (which is kept as the
+    reference). The xy, orientation, and scale errors and the inlier mask are
+    computed in one pass over the matches with preallocated buffers instead of
+    a temporary for every step.
+
+    The errors agree with the reference to roundoff (the scale and
+    orientation are taken from the offset to the reference point directly
+    instead of normalizing it first), so only matches within roundoff of a
+    threshold can change.
+
+    Returns:
+        tuple: homog_tup1 - (refined_inliers, refined_errors, H)
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> fm = demodata.make_dummy_fm(len(kpts1))
+        >>> H = np.array([[1.05, .02, 3], [-.03, .98, -2], [1e-4, 2e-5, 1]])
+        >>> xy_thresh_sqrd = .01 * ktool.get_kpts_dlen_sqrd(kpts2)
+        >>> args = (H, kpts1, kpts2, fm, xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> for full_homog_checks in [True, False]:
+        >>>     ref = test_homog_errors(*args, full_homog_checks=full_homog_checks)
+        >>>     fused = test_homog_errors_fused(*args, full_homog_checks=full_homog_checks)
+        >>>     assert np.all(ref[0] == fused[0])
+        >>>     for err1, err2 in zip(ref[1], fused[1]):
+        >>>         assert (err1 is None and err2 is None) or np.allclose(err1, err2)
+        >>>     print(len(fused[0]))
+        63
+        64
+    """
+    match_data = _homog_match_data(
+        kpts1, kpts2, fm, full_homog_checks, kpts1_mats, kpts2_mats
+    )
+    buffers = _homog_error_buffers(len(fm), full_homog_checks)
+    refined_inliers, refined_errors = _homog_errors_into(
+        H,
+        match_data,
+        xy_thresh_sqrd,
+        scale_thresh,
+        ori_thresh,
+        full_homog_checks,
+        buffers,
+    )
+    homog_tup1 = (refined_inliers, refined_errors, H)
+    return homog_tup1
+
+
+def test_affine_errors_fused(
+    H,
+    kpts1,
+    kpts2,
+    fm,
+    xy_thresh_sqrd,
+    scale_thresh_sqrd,
+    ori_thresh,
+    kpts1_mats=None,
+    kpts2_mats=None,
+):
+    """
+    Fused version of :func:`test_affine_errors` (which is kept as the
+    reference). Maps the matches with the vectorized hypothesis test instead
+    of a 3x3 matrix product per match.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> fm = demodata.make_dummy_fm(len(kpts1))
+        >>> H = np.array([[1.05, .02, 3], [-.03, .98, -2], [0, 0, 1]])
+        >>> xy_thresh_sqrd = .01 * ktool.get_kpts_dlen_sqrd(kpts2)
+        >>> args = (H, kpts1, kpts2, fm, xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> ref = test_affine_errors(*args)
+        >>> fused = test_affine_errors_fused(*args)
+        >>> assert np.all(ref[0] == fused[0])
+        >>> assert np.allclose(ref[1], fused[1])
+        >>> print(len(fused[0]))
+        63
+    """
+    (invVR1s_m,) = _take_kpts_mats(kpts1, fm.T[0], kpts1_mats, ['invVR'])
+    det2_m, ori2_m = _take_kpts_mats(
+        kpts2, fm.T[1], kpts2_mats, ['sqrd_scales', 'oris']
+    )
+    xy1_m = np.ascontiguousarray(ktool.get_invVR_mats_xys(invVR1s_m))
+    iv1_m = np.ascontiguousarray(invVR1s_m[:, 0:2, 0:2])
+    xy2_m = ktool.get_xys(kpts2.take(fm.T[1], axis=0))
+    hypo_flags, hypo_errors = _test_hypothesis_inliers_block(
+        H[None, :, :],
+        xy1_m,
+        iv1_m,
+        xy2_m,
+        det2_m,
+        ori2_m,
+        xy_thresh_sqrd,
+        scale_thresh_sqrd,
+        ori_thresh,
+    )
+    refined_inliers = np.flatnonzero(hypo_flags[0])
+    refined_errors = tuple(errs[0] for errs in hypo_errors)
+    refined_tup1 = (refined_inliers, refined_errors, H)
+    return refined_tup1
+
+
+def _whiten_xy_points_into(xy_m, inliers, out):
+    """
+    Same as ltool.whiten_xy_points on xy_m.take(inliers, axis=1), but writes
+    the normalized points into out (a (2, len(inliers)) buffer).
+    """
+    np.take(xy_m, inliers, axis=1, out=out)
+    mu_xy = out.mean(1)  # center of mass
+    std_xy = out.std(1)
+    std_xy[std_xy == 0] = 1  # prevent divide by zero
+    out -= mu_xy[:, None]
+    out /= std_xy[:, None]
+    tx, ty = -mu_xy / std_xy
+    sx, sy = 1 / std_xy
+    T = np.array([(sx, 0, tx), (0, sy, ty), (0, 0, 1)])
+    return T
+
+
+def _fill_lstsqrs_Mx9(xy1_mn, xy2_mn, out):
+    """ Vectorized build_lstsqrs_Mx9 that writes into a (2 * M, 9) buffer """
+    x1_mn, y1_mn = xy1_mn
+    x2_mn, y2_mn = xy2_mn
+    rows1 = out[0::2]
+    rows2 = out[1::2]
+    rows1[:, 0:3] = 0
+    np.negative(x1_mn, out=rows1[:, 3])
+    np.negative(y1_mn, out=rows1[:, 4])
+    rows1[:, 5] = -1
+    np.multiply(y2_mn, x1_mn, out=rows1[:, 6])
+    np.multiply(y2_mn, y1_mn, out=rows1[:, 7])
+    rows1[:, 8] = y2_mn
+    rows2[:, 0] = x1_mn
+    rows2[:, 1] = y1_mn
+    rows2[:, 2] = 1
+    rows2[:, 3:6] = 0
+    np.multiply(x2_mn, x1_mn, out=rows2[:, 6])
+    np.multiply(x2_mn, y1_mn, out=rows2[:, 7])
+    np.negative(rows2[:, 6:8], out=rows2[:, 6:8])
+    np.negative(x2_mn, out=rows2[:, 8])
+    return out
+
+
+def _refine_homog_iter(
+    kpts1,
+    kpts2,
+    fm,
+    aff_inliers,
+    xy_thresh_sqrd,
+    scale_thresh,
+    ori_thresh,
+    full_homog_checks,
+    max_iters,
+    H_prime=None,
+    kpts1_mats=None,
+    kpts2_mats=None,
+):
+    """
+    Re-estimates the homography from its own inliers until the inlier set
+    stops changing or max_iters homographies have been estimated. The first
+    iteration is the same as refine_method='homog'.
+
+    The normalized points and the least squares matrix are views into
+    buffers sized for all of the matches, so they are not reallocated
+    between iterations.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> import vtool.keypoint as ktool
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> fm = demodata.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> aff_inliers = np.arange(0, len(fm), 2)
+        >>> xy_thresh_sqrd = .01 * ktool.get_kpts_dlen_sqrd(kpts2)
+        >>> args = (kpts1, kpts2, fm, aff_inliers, xy_thresh_sqrd)
+        >>> homog_tup = refine_inliers(*args, refine_method='homog')
+        >>> iter_tup = refine_inliers(*args, refine_method='homog-iter')
+        >>> once_tup = refine_inliers(*args, refine_method='homog-iter',
+        >>>                           max_refine_iters=1)
+        >>> assert np.all(once_tup[0] == homog_tup[0])
+        >>> assert np.allclose(once_tup[2], homog_tup[2])
+        >>> assert len(iter_tup[0]) >= len(homog_tup[0])
+    """
+    num_matches = len(fm)
+    # The matches are gathered once and the homographies are tested with
+    # the fused error test into the same buffers every iteration
+    match_data = _homog_match_data(
+        kpts1, kpts2, fm, full_homog_checks, kpts1_mats, kpts2_mats
+    )
+    error_buffers = _homog_error_buffers(num_matches, full_homog_checks)
+    xy1_m = match_data[0][0:2, 0:num_matches]
+    xy2_m = match_data[1]
+    xy1_buf = np.empty((2, num_matches), dtype=SV_DTYPE)
+    xy2_buf = np.empty((2, num_matches), dtype=SV_DTYPE)
+    Mx9_buf = np.empty((2 * num_matches, 9), dtype=SV_DTYPE)
+    inliers = aff_inliers
+    homog_tup = None
+    for count in range(max(1, max_iters)):
+        num_inliers = len(inliers)
+        if count > 0 and num_inliers < 7:
+            # Too few inliers to estimate another homography
+            break
+        xy1_man = xy1_buf[:, :num_inliers]
+        xy2_man = xy2_buf[:, :num_inliers]
+        T1 = _whiten_xy_points_into(xy1_m, inliers, xy1_man)
+        T2 = _whiten_xy_points_into(xy2_m, inliers, xy2_man)
+        if count == 0 and H_prime is not None:
+            H_prime_ = H_prime
+        else:
+            Mx9 = _fill_lstsqrs_Mx9(xy1_man, xy2_man, Mx9_buf[: 2 * num_inliers])
+            # Only the right singular vectors are needed
+            V = npl.svd(Mx9, full_matrices=len(Mx9) < 9)[2]
+            H_prime_ = V[8].reshape(3, 3)
+        H = unnormalize_transform(H_prime_, T1, T2)
+        if npl.matrix_rank(H) != 3:
+            if count == 0:
+                raise npl.LinAlgError('Rank defficient homography ')
+            break
+        refined_inliers, refined_errors = _homog_errors_into(
+            H,
+            match_data,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            full_homog_checks,
+            error_buffers,
+        )
+        homog_tup = (refined_inliers, refined_errors, H)
+        if len(refined_inliers) == num_inliers and np.all(refined_inliers == inliers):
+            break
+        inliers = refined_inliers
+    if VERBOSE_SVER:
+        print('[sver] homog-iter stopped after %d iterations' % (count + 1,))
+    return homog_tup
+
+
+def refine_inliers(
+    kpts1,
+    kpts2,
+    fm,
+    aff_inliers,
+    xy_thresh_sqrd,
+    scale_thresh=2.0,
     ori_thresh=1.57,
     full_homog_checks=True,
     refine_method='homog',
+    H_prime=None,
+    max_refine_iters=5,
+    kpts1_mats=None,
+    kpts2_mats=None,
 ):
     """
     Given a set of hypothesis inliers, computes a homography and refines inliers
     returned homography maps image1 space into image2 space
 
+    H_prime is an optional precomputed transform between the normalized
+    inliers (see :func:`estimate_refined_transform`).
+
+    If refine_method is 'homog-iter' the homography is re-estimated from its
+    own inliers until they stop changing (at most max_refine_iters times).
+
+    The keypoint matrices used by the error tests are gathered from
+    kpts1_mats / kpts2_mats if they are given (see :func:`get_kpts_mats`).
+
     CommandLine:
         python -m vtool.spatial_verification --test-refine_inliers
         python -m vtool.spatial_verification --test-refine_inliers:0
@@ -900,11 +2114,26 @@ def refine_inliers(
         >>> ut.show_if_requested()
 
     """
+    if refine_method == 'homog-iter':
+        return _refine_homog_iter(
+            kpts1,
+            kpts2,
+            fm,
+            aff_inliers,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            full_homog_checks,
+            max_refine_iters,
+            H_prime=H_prime,
+            kpts1_mats=kpts1_mats,
+            kpts2_mats=kpts2_mats,
+        )
     H = estimate_refined_transform(
-        kpts1, kpts2, fm, aff_inliers, refine_method=refine_method
+        kpts1, kpts2, fm, aff_inliers, refine_method=refine_method, H_prime=H_prime
     )
     if refine_method.endswith('homog'):
-        homog_tup1 = test_homog_errors(
+        homog_tup1 = test_homog_errors_fused(
             H,
             kpts1,
             kpts2,
@@ -913,33 +2142,232 @@ def refine_inliers(
             scale_thresh,
             ori_thresh,
             full_homog_checks,
+            kpts1_mats=kpts1_mats,
+            kpts2_mats=kpts2_mats,
         )
     # elif refine_method == 'cv2-homog':
     #    homog_tup1 = test_homog_errors(H, kpts1, kpts2, fm, xy_thresh_sqrd,
     #                                   scale_thresh, ori_thresh, full_homog_checks)
     elif refine_method == 'affine':
-        homog_tup1 = test_affine_errors(
-            H, kpts1, kpts2, fm, xy_thresh_sqrd, scale_thresh, ori_thresh
+        homog_tup1 = test_affine_errors_fused(
+            H,
+            kpts1,
+            kpts2,
+            fm,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            kpts1_mats=kpts1_mats,
+            kpts2_mats=kpts2_mats,
         )
     return homog_tup1
 
 
 def get_best_affine_inliers_(
-    kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh
+    kpts1,
+    kpts2,
+    fm,
+    fs,
+    xy_thresh_sqrd,
+    scale_thresh,
+    ori_thresh,
+    num_threads=None,
+    search='exhaustive',
+    hypothesis_sampling=None,
+    num_hypotheses=500,
+    hypothesis_seed=0,
+    spatial_index=False,
+    dtype=SV_DTYPE,
+    kpts1_mats=None,
+    kpts2_mats=None,
+    deterministic=False,
 ):
-    if HAVE_SVER_C_WRAPPER:
+    if search != 'exhaustive' or (
+        hypothesis_sampling is not None and len(fm) > num_hypotheses
+    ):
+        aff_inliers, aff_errors, Aff = get_best_affine_inliers(
+            kpts1,
+            kpts2,
+            fm,
+            fs,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            search=search,
+            hypothesis_sampling=hypothesis_sampling,
+            num_hypotheses=num_hypotheses,
+            hypothesis_seed=hypothesis_seed,
+            spatial_index=spatial_index,
+            dtype=dtype,
+            kpts1_mats=kpts1_mats,
+            kpts2_mats=kpts2_mats,
+            deterministic=deterministic,
+        )
+    elif have_sver_c_wrapper():
         aff_inliers, aff_errors, Aff = sver_c_wrapper.get_best_affine_inliers_cpp(
-            kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh
+            kpts1,
+            kpts2,
+            fm,
+            fs,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            num_threads=num_threads,
+            spatial_index=spatial_index,
+            dtype=dtype,
+            deterministic=deterministic,
         )
     else:
         if ut.NOT_QUIET:
             print('WARNING: sver has not been compiled')
         aff_inliers, aff_errors, Aff = get_best_affine_inliers(
-            kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh
+            kpts1,
+            kpts2,
+            fm,
+            fs,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            spatial_index=spatial_index,
+            dtype=dtype,
+            kpts1_mats=kpts1_mats,
+            kpts2_mats=kpts2_mats,
+            deterministic=deterministic,
         )
+    return _cast_affine_hypothesis(aff_inliers, aff_errors, Aff)
+
+
+def _cast_affine_hypothesis(aff_inliers, aff_errors, Aff):
+    """ Returns the errors and matrix of a fast path search in SV_DTYPE """
+    if Aff.dtype != SV_DTYPE:
+        aff_errors = tuple(errs.astype(SV_DTYPE) for errs in aff_errors)
+        Aff = Aff.astype(SV_DTYPE)
     return aff_inliers, aff_errors, Aff
 
 
+def get_best_affine_inliers_nested(
+    kpts1,
+    kpts2,
+    fm,
+    fs,
+    match_levels,
+    num_levels,
+    xy_thresh_sqrd,
+    scale_thresh,
+    ori_thresh,
+    num_threads=None,
+    forcepy=False,
+    dtype=SV_DTYPE,
+    max_block_bytes=None,
+    kpts1_mats=None,
+    kpts2_mats=None,
+):
+    """
+    Best affine hypothesis of each of several nested subsets of the matches.
+
+    Level ``b`` consists of the matches with ``match_levels <= b`` (e.g. the
+    matches that pass successively looser ratio thresholds). Each hypothesis is
+    tested against the matches once, and the inlier weights of every level are
+    read off the same tests instead of searching each subset from scratch.
+
+    Both implementations return the same result as
+    :func:`get_best_affine_inliers_` on each subset, and ties between
+    hypotheses go to the first one (like argmax).
+
+    Args:
+        match_levels (ndarray): first level each match is part of. Matches
+            with a level >= num_levels are not part of any level.
+        num_levels (int): number of levels
+
+    Returns:
+        list: an (aff_inliers, aff_errors, Aff) tuple for each level, indexed
+            relative to ``fm[match_levels <= level]``, or None if the level has
+            no matches
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> import vtool.keypoint as ktool
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> kpts1, kpts2 = kpts1.astype(np.float64), kpts2.astype(np.float64)
+        >>> rng = np.random.RandomState(0)
+        >>> fm = demodata.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> fs = rng.rand(len(fm))
+        >>> match_levels = rng.randint(0, 5, size=len(fm))
+        >>> xy_thresh_sqrd = .01 * ktool.get_kpts_dlen_sqrd(kpts2)
+        >>> args = (xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> c_out = get_best_affine_inliers_nested(
+        >>>     kpts1, kpts2, fm, fs, match_levels, 4, *args)
+        >>> py_out = get_best_affine_inliers_nested(
+        >>>     kpts1, kpts2, fm, fs, match_levels, 4, *args, forcepy=True,
+        >>>     max_block_bytes=10000)
+        >>> for level in range(4):
+        >>>     flags = match_levels <= level
+        >>>     ref = get_best_affine_inliers(
+        >>>         kpts1, kpts2, fm[flags], fs[flags], *args, forcepy=True)
+        >>>     assert np.all(py_out[level][0] == ref[0])
+        >>>     assert np.allclose(py_out[level][2], ref[2])
+        >>>     assert np.all(c_out[level][0] == ref[0])
+        >>> print([len(out[0]) for out in c_out])
+        [13, 24, 42, 59]
+    """
+    if not forcepy and have_sver_c_wrapper():
+        level_outs = sver_c_wrapper.get_best_affine_inliers_nested_cpp(
+            kpts1,
+            kpts2,
+            fm,
+            fs,
+            match_levels,
+            num_levels,
+            xy_thresh_sqrd,
+            scale_thresh,
+            ori_thresh,
+            num_threads=num_threads,
+            dtype=dtype,
+        )
+        return [
+            None if out is None else _cast_affine_hypothesis(*out)
+            for out in level_outs
+        ]
+    match_levels = np.asarray(match_levels)
+    level_range = np.arange(num_levels)
+    # level_flags[j, b] is True if match j is part of level b
+    level_flags = match_levels[:, None] <= level_range[None, :]
+    level_fs = np.where(level_flags, np.asarray(fs, dtype=np.float64)[:, None], 0)
+    hypo_data = _affine_hypothesis_data(
+        kpts1, kpts2, fm, dtype=dtype, kpts1_mats=kpts1_mats, kpts2_mats=kpts2_mats
+    )
+    Aff_mats = hypo_data[0]
+    thresh_tup = (xy_thresh_sqrd, scale_thresh, ori_thresh)
+    # Accumulate the inlier weights of every hypothesis at every level
+    level_weights = np.empty((len(fm), num_levels), dtype=np.float64)
+    block_size = _hypothesis_block_size(len(fm), max_block_bytes, dtype=dtype)
+    for start in range(0, len(Aff_mats), block_size):
+        Aff_block = Aff_mats[start : start + block_size]
+        hypo_flags, _ = _test_hypothesis_inliers_block(
+            Aff_block, *(hypo_data[1:] + thresh_tup)
+        )
+        level_weights[start : start + len(Aff_block)] = hypo_flags.dot(level_fs)
+    # Only the hypotheses of a level's own matches compete at that level
+    level_weights[~level_flags] = -np.inf
+    best_idxs = level_weights.argmax(axis=0)
+    best_flags, best_errors = _test_hypothesis_inliers_block(
+        Aff_mats[best_idxs], *(hypo_data[1:] + thresh_tup)
+    )
+    level_outs = []
+    for level in level_range:
+        flags = level_flags[:, level]
+        if not np.any(flags):
+            level_outs.append(None)
+            continue
+        aff_inliers = np.where(best_flags[level][flags])[0]
+        aff_errors = tuple(errs[level][flags] for errs in best_errors)
+        Aff = Aff_mats[best_idxs[level]]
+        level_outs.append(_cast_affine_hypothesis(aff_inliers, aff_errors, Aff))
+    return level_outs
+
+
 def spatially_verify_kpts(
     kpts1,
     kpts2,
@@ -954,12 +2382,26 @@ def spatially_verify_kpts(
     full_homog_checks=True,
     refine_method='homog',
     max_nInliers=5000,
+    num_threads=None,
+    search='exhaustive',
+    hypothesis_sampling=None,
+    num_hypotheses=500,
+    hypothesis_seed=0,
+    spatial_index=False,
+    dtype=SV_DTYPE,
+    max_refine_iters=5,
+    kpts1_mats=None,
+    kpts2_mats=None,
+    deterministic=False,
 ):
     """
     Driver function
     Spatially validates feature matches
 
-    FIXME: there is a non-determenism here
+    The C hypothesis search sums the inlier weights in match order and gives
+    ties to the hypothesis with the smallest index, so its results are bit
+    for bit reproducible for any num_threads. The python search sums the
+    weights with a BLAS product unless deterministic=True.
 
     Returned homography maps image1 space into image2 space.
 
@@ -974,7 +2416,42 @@ def spatially_verify_kpts(
         dlen_sqrd2 (float): diagonal length squared of image/chip 2
         min_nInliers (int): default=4
         returnAff (bool): returns best affine hypothesis as well
+        refine_method (str): 'homog', 'homog-iter', 'affine', or one of the
+            cv2 methods. 'homog-iter' re-estimates the homography from its own
+            inliers until they stop changing.
         max_nInliers (int): homog is not considered after this threshold
+        num_threads (int): number of threads the C library uses to test the
+            affine hypotheses. Defaults to the OpenMP default.
+        search (str): 'exhaustive' or 'pruned' affine hypothesis search
+            (see :func:`get_best_affine_inliers`)
+        hypothesis_sampling (str): None, 'random', or 'stratified'. If set,
+            pairs with more than num_hypotheses matches only test a sample of
+            num_hypotheses affine hypotheses.
+        num_hypotheses (int): hypothesis budget for hypothesis_sampling
+        hypothesis_seed (int): seed for hypothesis_sampling
+        spatial_index (bool): use a grid index over the matches so each
+            hypothesis only tests matches near its projected locations
+        dtype (dtype): precision of the affine hypothesis search. Pass
+            SV_FAST_DTYPE (float32) to opt into the faster single precision
+            search; refinement always runs in float64. Tolerance versus
+            float64: the errors agree to about 1e-6 relative, so only matches
+            whose error is within that of a threshold can flip, and the
+            chosen hypothesis only changes when two hypotheses have nearly
+            the same inlier weight. The inlier sets typically differ by a
+            few matches at most.
+        max_refine_iters (int): maximum number of homographies estimated by
+            refine_method='homog-iter'
+        kpts1_mats (dict): keypoint matrices of all of kpts1 from
+            :func:`get_kpts_mats`. If given, the python hypothesis search and
+            the refinement only gather the rows of the matches instead of
+            rebuilding them for every pair.
+        kpts2_mats (dict): keypoint matrices of all of kpts2
+        deterministic (bool): only changes the python hypothesis search,
+            which then sums the inlier weights in match order (like libsver)
+            instead of with a BLAS product whose summation order can depend
+            on the memory layout. The C search gives the same result either
+            way; with deterministic=True it recomputes the inliers of the
+            winner instead of keeping a copy per thread, which saves memory.
 
     Returns:
         tuple : (refined_inliers, refined_errors, H, aff_inliers, aff_errors, Aff) if success else None
@@ -1047,9 +2524,75 @@ def spatially_verify_kpts(
     # Determine the best hypothesis transformation and get its inliers
     xy_thresh_sqrd = dlen_sqrd2 * xy_thresh
     aff_inliers, aff_errors, Aff = get_best_affine_inliers_(
-        kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh
+        kpts1,
+        kpts2,
+        fm,
+        fs,
+        xy_thresh_sqrd,
+        scale_thresh,
+        ori_thresh,
+        num_threads=num_threads,
+        search=search,
+        hypothesis_sampling=hypothesis_sampling,
+        num_hypotheses=num_hypotheses,
+        hypothesis_seed=hypothesis_seed,
+        spatial_index=spatial_index,
+        dtype=dtype,
+        kpts1_mats=kpts1_mats,
+        kpts2_mats=kpts2_mats,
+        deterministic=deterministic,
     )
     # print(aff_inliers)
+    svtup = _verify_affine_hypothesis(
+        kpts1,
+        kpts2,
+        fm,
+        aff_inliers,
+        aff_errors,
+        Aff,
+        xy_thresh,
+        dlen_sqrd2,
+        scale_thresh,
+        ori_thresh,
+        min_nInliers,
+        returnAff,
+        full_homog_checks,
+        refine_method,
+        max_nInliers,
+        max_refine_iters=max_refine_iters,
+        kpts1_mats=kpts1_mats,
+        kpts2_mats=kpts2_mats,
+    )
+    return svtup
+
+
+def _verify_affine_hypothesis(
+    kpts1,
+    kpts2,
+    fm,
+    aff_inliers,
+    aff_errors,
+    Aff,
+    xy_thresh,
+    dlen_sqrd2,
+    scale_thresh,
+    ori_thresh,
+    min_nInliers,
+    returnAff,
+    full_homog_checks,
+    refine_method,
+    max_nInliers,
+    H_prime=None,
+    max_refine_iters=5,
+    kpts1_mats=None,
+    kpts2_mats=None,
+):
+    """
+    Checks the best affine hypothesis of a pair and refines its inliers.
+    Shared by :func:`spatially_verify_kpts` and
+    :func:`spatially_verify_kpts_batch`.
+    """
+    xy_thresh_sqrd = dlen_sqrd2 * xy_thresh
 
     # Return if there are not enough inliers to compute homography
     if len(aff_inliers) < min_nInliers:
@@ -1061,7 +2604,8 @@ def spatially_verify_kpts(
             )
         svtup = None
         return svtup
-    if (refine_method.endswith('homog') and len(aff_inliers) < 7) or len(aff_inliers) < 4:
+    is_homog = refine_method.endswith('homog') or refine_method == 'homog-iter'
+    if (is_homog and len(aff_inliers) < 7) or len(aff_inliers) < 4:
         # Test fundamental param
         # need to have 4 or more inliers to comopute an affine
         # and need at least 7 to compute a homography
@@ -1091,6 +2635,10 @@ def spatially_verify_kpts(
             ori_thresh,
             full_homog_checks,
             refine_method=refine_method,
+            H_prime=H_prime,
+            max_refine_iters=max_refine_iters,
+            kpts1_mats=kpts1_mats,
+            kpts2_mats=kpts2_mats,
         )
         # print(refined_inliers)
     except npl.LinAlgError as ex:
@@ -1137,6 +2685,705 @@ def spatially_verify_kpts(
         return svtup
 
 
+def spatially_verify_kpts_batch(
+    kpts1_list,
+    kpts2_list,
+    fm_list,
+    xy_thresh=0.01,
+    scale_thresh=2.0,
+    ori_thresh=TAU / 4.0,
+    dlen_sqrd2_list=None,
+    min_nInliers=4,
+    match_weights_list=None,
+    returnAff=False,
+    full_homog_checks=True,
+    refine_method='homog',
+    max_nInliers=5000,
+    fm_offsets=None,
+    num_threads=None,
+    spatial_index=False,
+    dtype=SV_DTYPE,
+    max_refine_iters=5,
+    kpts1_mats_list=None,
+    kpts2_mats_list=None,
+    deterministic=False,
+):
+    """
+    Spatially validates the feature matches of many annotation pairs.
+
+    Equivalent to calling :func:`spatially_verify_kpts` on each pair, but the
+    affine hypothesis search for all pairs happens in a single call into the C
+    library (which releases the GIL). Keypoint arrays that are shared between
+    pairs (e.g. a single query matched against many database annotations) are
+    only copied once. With refine_method='homog' (or the first iteration of
+    'homog-iter') the homographies of all pairs are solved together with
+    :func:`compute_homog_batch`.
+
+    Args:
+        kpts1_list (list): keypoints in image 1 of each pair
+        kpts2_list (list): keypoints in image 2 of each pair
+        fm_list (list or ndarray): feature matches of each pair. If
+            fm_offsets is given this is a single stacked (N, 2) array and the
+            matches of pair i are fm_list[fm_offsets[i]:fm_offsets[i + 1]].
+        xy_thresh (float):
+        scale_thresh (float):
+        ori_thresh (float):
+        dlen_sqrd2_list (list): diagonal length squared of each image 2.
+            Computed from the matched keypoints if None.
+        min_nInliers (int): default=4
+        match_weights_list (list or ndarray): match weights of each pair
+            (stacked like fm_list if fm_offsets is given). Defaults to ones.
+        returnAff (bool): returns best affine hypothesis as well
+        full_homog_checks (bool):
+        refine_method (str):
+        max_nInliers (int): homog is not considered after this threshold
+        fm_offsets (ndarray): optional CSR offsets of length num_pairs + 1
+        num_threads (int): number of threads the C library uses to test the
+            affine hypotheses of each pair. Defaults to the OpenMP default.
+        spatial_index (bool): use a grid index over the matches of each pair
+        dtype (dtype): precision of the affine hypothesis search (see
+            :func:`spatially_verify_kpts`)
+        max_refine_iters (int): see :func:`spatially_verify_kpts`
+        kpts1_mats_list (list): optional keypoint matrices of each kpts1 (see
+            :func:`get_kpts_mats`). Pairs that share keypoints can share these.
+        kpts2_mats_list (list): optional keypoint matrices of each kpts2
+        deterministic (bool): see :func:`spatially_verify_kpts`
+
+    Returns:
+        list: an svtup (or None on failure) for each pair
+
+    CommandLine:
+        python -m xdoctest vtool.spatial_verification spatially_verify_kpts_batch
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *
+        >>> import vtool.demodata as demodata
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> rng = np.random.RandomState(0)
+        >>> fm = demodata.make_dummy_fm(len(kpts1))
+        >>> fm_list = [fm, fm[rng.rand(len(fm)) > .3], fm[0:0], fm[0:3]]
+        >>> fs_list = [rng.rand(len(fm_)) for fm_ in fm_list]
+        >>> kpts1_list = [kpts1] * len(fm_list)
+        >>> kpts2_list = [kpts2] * len(fm_list)
+        >>> svtup_list = spatially_verify_kpts_batch(
+        >>>     kpts1_list, kpts2_list, fm_list, match_weights_list=fs_list,
+        >>>     returnAff=True)
+        >>> for fm_, fs_, svtup in zip(fm_list, fs_list, svtup_list):
+        >>>     svtup_ = spatially_verify_kpts(kpts1, kpts2, fm_, match_weights=fs_,
+        >>>                                    returnAff=True)
+        >>>     assert (svtup is None) == (svtup_ is None)
+        >>>     if svtup is not None:
+        >>>         assert np.all(svtup[0] == svtup_[0])
+        >>>         assert np.all(svtup[3] == svtup_[3])
+        >>>         assert np.allclose(svtup[2], svtup_[2])
+        >>> # The same pairs with CSR stacked matches
+        >>> fm_offsets = np.cumsum([0] + list(map(len, fm_list)))
+        >>> svtup_list2 = spatially_verify_kpts_batch(
+        >>>     kpts1_list, kpts2_list, np.vstack(fm_list),
+        >>>     match_weights_list=np.hstack(fs_list), returnAff=True,
+        >>>     fm_offsets=fm_offsets)
+        >>> print([None if svtup is None else len(svtup[0]) for svtup in svtup_list2])
+        [63, 45, None, None]
+    """
+    if fm_offsets is not None:
+        fm_flat = fm_list
+        fm_list = [fm_flat[start:stop] for start, stop in ut.itertwo(fm_offsets)]
+        if match_weights_list is not None:
+            fs_flat = match_weights_list
+            match_weights_list = [
+                fs_flat[start:stop] for start, stop in ut.itertwo(fm_offsets)
+            ]
+    num_pairs = len(fm_list)
+    assert len(kpts1_list) == num_pairs and len(kpts2_list) == num_pairs
+    if match_weights_list is None:
+        match_weights_list = [np.ones(len(fm), dtype=np.float64) for fm in fm_list]
+    if dlen_sqrd2_list is None:
+        dlen_sqrd2_list = [
+            ktool.get_kpts_dlen_sqrd(kpts2.take(fm.T[1], axis=0)) if len(fm) else 0.0
+            for kpts2, fm in zip(kpts2_list, fm_list)
+        ]
+    xy_thresh_sqrd_list = [dlen_sqrd2 * xy_thresh for dlen_sqrd2 in dlen_sqrd2_list]
+    # Cast keypoints to float64 to avoid numerical issues. Casting each unique
+    # array once keeps shared keypoints shared.
+    id_to_kpts = {
+        id(kpts): kpts.astype(np.float64, casting='same_kind', copy=False)
+        for kpts in ut.flatten([kpts1_list, kpts2_list])
+    }
+    kpts1_list = [id_to_kpts[id(kpts1)] for kpts1 in kpts1_list]
+    kpts2_list = [id_to_kpts[id(kpts2)] for kpts2 in kpts2_list]
+    if kpts1_mats_list is None:
+        kpts1_mats_list = [None] * num_pairs
+    if kpts2_mats_list is None:
+        kpts2_mats_list = [None] * num_pairs
+    # Determine the best hypothesis transformation of every pair at once
+    if have_sver_c_wrapper():
+        affine_list = sver_c_wrapper.get_best_affine_inliers_batch_cpp(
+            kpts1_list,
+            kpts2_list,
+            fm_list,
+            match_weights_list,
+            xy_thresh_sqrd_list,
+            scale_thresh,
+            ori_thresh,
+            num_threads=num_threads,
+            spatial_index=spatial_index,
+            dtype=dtype,
+            deterministic=deterministic,
+        )
+        affine_list = [_cast_affine_hypothesis(*affine) for affine in affine_list]
+    else:
+        affine_list = [
+            get_best_affine_inliers_(
+                kpts1,
+                kpts2,
+                fm,
+                fs,
+                xy_thresh_sqrd,
+                scale_thresh,
+                ori_thresh,
+                spatial_index=spatial_index,
+                dtype=dtype,
+                kpts1_mats=kpts1_mats,
+                kpts2_mats=kpts2_mats,
+                deterministic=deterministic,
+            )
+            if len(fm)
+            else None
+            for kpts1, kpts2, fm, fs, xy_thresh_sqrd, kpts1_mats, kpts2_mats in zip(
+                kpts1_list,
+                kpts2_list,
+                fm_list,
+                match_weights_list,
+                xy_thresh_sqrd_list,
+                kpts1_mats_list,
+                kpts2_mats_list,
+            )
+        ]
+    # Solve the homographies of every pair that will be refined at once
+    H_prime_list = [None] * num_pairs
+    if refine_method in {'homog', 'homog-iter'}:
+        refine_pxs = [
+            px
+            for px in range(num_pairs)
+            if len(fm_list[px])
+            and max(min_nInliers, 7) <= len(affine_list[px][0]) < max_nInliers
+        ]
+        normtup_list = [
+            get_normalized_affine_inliers(
+                kpts1_list[px], kpts2_list[px], fm_list[px], affine_list[px][0]
+            )
+            for px in refine_pxs
+        ]
+        H_primes = compute_homog_batch(
+            [normtup[0] for normtup in normtup_list],
+            [normtup[1] for normtup in normtup_list],
+        )
+        for px, H_prime in zip(refine_pxs, H_primes):
+            H_prime_list[px] = H_prime
+    svtup_list = []
+    for px in range(num_pairs):
+        if len(fm_list[px]) == 0:
+            svtup_list.append(None)
+            continue
+        aff_inliers, aff_errors, Aff = affine_list[px]
+        svtup = _verify_affine_hypothesis(
+            kpts1_list[px],
+            kpts2_list[px],
+            fm_list[px],
+            aff_inliers,
+            aff_errors,
+            Aff,
+            xy_thresh,
+            dlen_sqrd2_list[px],
+            scale_thresh,
+            ori_thresh,
+            min_nInliers,
+            returnAff,
+            full_homog_checks,
+            refine_method,
+            max_nInliers,
+            H_prime=H_prime_list[px],
+            max_refine_iters=max_refine_iters,
+            kpts1_mats=kpts1_mats_list[px],
+            kpts2_mats=kpts2_mats_list[px],
+        )
+        svtup_list.append(svtup)
+    return svtup_list
+
+
+def spatially_verify_kpts_nested(
+    kpts1,
+    kpts2,
+    fm,
+    match_levels,
+    num_levels,
+    xy_thresh=0.01,
+    scale_thresh=2.0,
+    ori_thresh=TAU / 4.0,
+    dlen_sqrd2=None,
+    min_nInliers=4,
+    match_weights=None,
+    returnAff=False,
+    full_homog_checks=True,
+    refine_method='homog',
+    max_nInliers=5000,
+    num_threads=None,
+    dtype=SV_DTYPE,
+    max_refine_iters=5,
+    kpts1_mats=None,
+    kpts2_mats=None,
+):
+    """
+    Spatially validates nested subsets of the feature matches of one pair.
+
+    Equivalent to calling :func:`spatially_verify_kpts` on
+    ``fm[match_levels <= level]`` for every level, but the affine hypotheses
+    are only tested once for the largest subset (see
+    :func:`get_best_affine_inliers_nested`). This is how
+    :func:`vtool.matching.PairwiseMatch.sver_flags` verifies the bins of a
+    ratio threshold sweep.
+
+    Args:
+        match_levels (ndarray): first level each match is part of. Matches
+            with a level >= num_levels are not verified.
+        num_levels (int): number of levels
+        dlen_sqrd2 (float): diagonal length squared of image/chip 2. If None
+            it is computed from the matches of the largest level and used for
+            every level.
+
+    See :func:`spatially_verify_kpts` for the other arguments.
+
+    Returns:
+        list: an svtup (or None on failure) for each level, indexed relative
+            to the matches of that level
+
+    CommandLine:
+        python -m xdoctest vtool.spatial_verification spatially_verify_kpts_nested
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *
+        >>> import vtool.demodata as demodata
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> rng = np.random.RandomState(0)
+        >>> fm = demodata.make_dummy_fm(len(kpts1))
+        >>> fs = rng.rand(len(fm))
+        >>> match_levels = rng.randint(0, 5, size=len(fm))
+        >>> dlen_sqrd2 = ktool.get_kpts_dlen_sqrd(kpts2)
+        >>> svtup_list = spatially_verify_kpts_nested(
+        >>>     kpts1, kpts2, fm, match_levels, 4, dlen_sqrd2=dlen_sqrd2,
+        >>>     match_weights=fs, returnAff=True)
+        >>> for level, svtup in enumerate(svtup_list):
+        >>>     flags = match_levels <= level
+        >>>     svtup_ = spatially_verify_kpts(
+        >>>         kpts1, kpts2, fm[flags], dlen_sqrd2=dlen_sqrd2,
+        >>>         match_weights=fs[flags], returnAff=True, num_threads=1)
+        >>>     assert np.all(svtup[0] == svtup_[0])
+        >>>     assert np.all(svtup[3] == svtup_[3])
+        >>>     assert np.allclose(svtup[2], svtup_[2])
+        >>> print([len(svtup[0]) for svtup in svtup_list])
+        [17, 24, 42, 59]
+    """
+    match_levels = np.asarray(match_levels)
+    level_flags_list = [match_levels <= level for level in range(num_levels)]
+    # Cast keypoints to float64 to avoid numerical issues
+    kpts1 = kpts1.astype(np.float64, casting='same_kind', copy=False)
+    kpts2 = kpts2.astype(np.float64, casting='same_kind', copy=False)
+    assert match_weights is not None, 'provide at least ones please for match_weights'
+    fs = match_weights
+    # Only the matches of some level take part
+    used_flags = match_levels < num_levels
+    if not np.all(used_flags):
+        fm = fm.compress(used_flags, axis=0)
+        fs = fs.compress(used_flags)
+        match_levels = match_levels.compress(used_flags)
+        level_flags_list = [flags.compress(used_flags) for flags in level_flags_list]
+    if len(fm) == 0:
+        return [None] * num_levels
+    if dlen_sqrd2 is None:
+        kpts2_m = kpts2.take(fm.T[1], axis=0)
+        dlen_sqrd2 = ktool.get_kpts_dlen_sqrd(kpts2_m)
+    xy_thresh_sqrd = dlen_sqrd2 * xy_thresh
+    level_affines = get_best_affine_inliers_nested(
+        kpts1,
+        kpts2,
+        fm,
+        fs,
+        match_levels,
+        num_levels,
+        xy_thresh_sqrd,
+        scale_thresh,
+        ori_thresh,
+        num_threads=num_threads,
+        dtype=dtype,
+        kpts1_mats=kpts1_mats,
+        kpts2_mats=kpts2_mats,
+    )
+    svtup_list = []
+    for level_flags, affine in zip(level_flags_list, level_affines):
+        if affine is None:
+            svtup_list.append(None)
+            continue
+        aff_inliers, aff_errors, Aff = affine
+        svtup = _verify_affine_hypothesis(
+            kpts1,
+            kpts2,
+            fm.compress(level_flags, axis=0),
+            aff_inliers,
+            aff_errors,
+            Aff,
+            xy_thresh,
+            dlen_sqrd2,
+            scale_thresh,
+            ori_thresh,
+            min_nInliers,
+            returnAff,
+            full_homog_checks,
+            refine_method,
+            max_nInliers,
+            max_refine_iters=max_refine_iters,
+            kpts1_mats=kpts1_mats,
+            kpts2_mats=kpts2_mats,
+        )
+        svtup_list.append(svtup)
+    return svtup_list
+
+
+# spatially_verify_kpts arguments that do not change its result
+_SVER_CACHE_IGNORE_KEYS = {'returnAff', 'num_threads', 'kpts1_mats', 'kpts2_mats'}
+# Length of the int64 header of a SverCache entry
+_SVER_CACHE_HEADER_LEN = 8
+# Storage dtypes of the inlier indexes and the errors of a SverCache entry
+_SVER_CACHE_INDEX_DTYPE = np.dtype(np.int32)
+_SVER_CACHE_ERROR_DTYPE = np.dtype(np.float32)
+
+
+def _svtup_to_array(svtup, num_matches):
+    """
+    Packs a spatially_verify_kpts result (with returnAff=True) into one flat
+    byte array: an int64 header, H and Aff as float64, the refined and affine
+    inlier indexes as int32, and then every error array that is not None as
+    float32. Each section starts at a multiple of its itemsize, so the loaded
+    sections are views of the (memory mapped) buffer.
+    """
+    header = np.zeros(_SVER_CACHE_HEADER_LEN, dtype=np.int64)
+    header[0:3] = (SVER_CACHE_VERSION, svtup is not None, num_matches)
+    if svtup is None:
+        return header.view(np.uint8)
+    if num_matches > np.iinfo(_SVER_CACHE_INDEX_DTYPE).max:
+        raise ValueError('too many matches to cache: %d' % (num_matches,))
+    refined_inliers, refined_errors, H, aff_inliers, aff_errors, Aff = svtup
+    errors = list(refined_errors) + list(aff_errors)
+    has_errors = [err is not None for err in errors]
+    header[3:8] = (
+        len(refined_inliers),
+        len(aff_inliers),
+        np.dot(has_errors, 2 ** np.arange(len(errors))),
+        np.dtype(refined_inliers.dtype).itemsize,
+        np.dtype(aff_inliers.dtype).itemsize,
+    )
+    parts = [
+        header,
+        np.asarray(H, dtype=np.float64).ravel(),
+        np.asarray(Aff, dtype=np.float64).ravel(),
+        np.asarray(refined_inliers, dtype=_SVER_CACHE_INDEX_DTYPE),
+        np.asarray(aff_inliers, dtype=_SVER_CACHE_INDEX_DTYPE),
+    ]
+    parts.extend(
+        np.asarray(err, dtype=_SVER_CACHE_ERROR_DTYPE)
+        for err in errors
+        if err is not None
+    )
+    return np.hstack([part.view(np.uint8) for part in parts])
+
+
+def _svtup_from_array(data):
+    """
+    Inverse of :func:`_svtup_to_array`. The errors are float32 views into
+    data.
+
+    Raises:
+        ValueError: if data was written by another SVER_CACHE_VERSION
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> from vtool.spatial_verification import _svtup_to_array, _svtup_from_array
+        >>> import vtool.demodata as demodata
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> fm = demodata.make_dummy_fm(len(kpts1))
+        >>> fs = np.ones(len(fm))
+        >>> svtup = spatially_verify_kpts(kpts1, kpts2, fm, match_weights=fs,
+        >>>                               returnAff=True, full_homog_checks=False)
+        >>> svtup2 = _svtup_from_array(_svtup_to_array(svtup, len(fm)))
+        >>> profile = ut.list_type_profile(svtup, with_dtype=False)
+        >>> assert profile == ut.list_type_profile(svtup2, with_dtype=False)
+        >>> assert all(np.all(a == b) for a, b in zip(svtup[0:4:3], svtup2[0:4:3]))
+        >>> assert svtup2[1][0].dtype == np.float32
+        >>> assert np.all(svtup2[1][0] == svtup[1][0].astype(np.float32))
+        >>> assert _svtup_from_array(_svtup_to_array(None, len(fm))) is None
+        >>> print(ut.list_type_profile(svtup2, with_dtype=False))
+        tuple(numpy.ndarray, tuple(numpy.ndarray, NoneType, NoneType), numpy.ndarray, numpy.ndarray, tuple(numpy.ndarray*3), numpy.ndarray)
+    """
+    data = np.asarray(data)
+    if data.dtype != np.uint8 or len(data) < 8 * _SVER_CACHE_HEADER_LEN:
+        raise ValueError('stale sver cache entry')
+    header = data[0 : 8 * _SVER_CACHE_HEADER_LEN].view(np.int64)
+    if header[0] != SVER_CACHE_VERSION:
+        raise ValueError('stale sver cache entry')
+    if not header[1]:
+        return None
+    num_matches, num_refined, num_aff, mask = header[2:6]
+    index_dtypes = [np.dtype('int%d' % (8 * size)) for size in header[6:8]]
+
+    def _take(offset, dtype, num):
+        stop = offset + num * dtype.itemsize
+        return data[offset:stop].view(dtype), stop
+
+    offset = 8 * _SVER_CACHE_HEADER_LEN
+    mats, offset = _take(offset, np.dtype(np.float64), 18)
+    H = np.array(mats[0:9]).reshape(3, 3)
+    Aff = np.array(mats[9:18]).reshape(3, 3)
+    refined_inliers, offset = _take(offset, _SVER_CACHE_INDEX_DTYPE, num_refined)
+    refined_inliers = refined_inliers.astype(index_dtypes[0])
+    aff_inliers, offset = _take(offset, _SVER_CACHE_INDEX_DTYPE, num_aff)
+    aff_inliers = aff_inliers.astype(index_dtypes[1])
+    errors = []
+    for x in range(6):
+        if mask & (1 << x):
+            err, offset = _take(offset, _SVER_CACHE_ERROR_DTYPE, num_matches)
+            errors.append(err)
+        else:
+            errors.append(None)
+    svtup = (
+        refined_inliers,
+        tuple(errors[0:3]),
+        H,
+        aff_inliers,
+        tuple(errors[3:6]),
+        Aff,
+    )
+    return svtup
+
+
+class SverCache(ub.NiceRepr):
+    """
+    Persistent on disk cache of spatial verification results, analogous to
+    the flann index cache in :func:`vtool.nearest_neighbors.flann_cache`.
+
+    Results are keyed by a hash of the matched keypoints, the match weights,
+    and every argument of :func:`spatially_verify_kpts` that changes the
+    result. Each result is stored as a single .npy file that is memory mapped
+    on load, so the errors of a hit are read-only views of the file. The
+    inlier indexes are stored as int32 and the errors as float32, which is
+    precise enough for thresholding and scoring and halves the files. The
+    directory is bounded to max_bytes by evicting the least recently used
+    results (by modification time, which a hit updates).
+
+    Results of the C search are reproducible for any num_threads. Pass
+    deterministic=True when libsver may be unavailable, so the python search
+    also reproduces the cached results exactly.
+
+    Args:
+        cache_dir (str): directory of the results. 'default' uses a
+            directory in the application cache of appname.
+        max_bytes (int): size bound of the directory
+        mmap_mode (str): passed to np.load. Use None to read results into
+            memory.
+        appname (str): application name of the default cache_dir
+        verbose (int): verbosity
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.spatial_verification import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> import tempfile
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> fm = demodata.make_dummy_fm(len(kpts1))
+        >>> fs = np.ones(len(fm))
+        >>> sver_cache = SverCache(cache_dir=tempfile.mkdtemp())
+        >>> kw = dict(match_weights=fs, deterministic=True)
+        >>> svtup1 = spatially_verify_kpts_cached(kpts1, kpts2, fm, sver_cache, **kw)
+        >>> svtup2 = spatially_verify_kpts_cached(kpts1, kpts2, fm, sver_cache, **kw)
+        >>> assert np.all(svtup1[0] == svtup2[0]) and np.all(svtup1[2] == svtup2[2])
+        >>> print(sver_cache.num_hits, sver_cache.num_misses, len(sver_cache))
+        1 1 1
+        >>> sver_cache.clear()
+        >>> print(len(sver_cache))
+        0
+    """
+
+    def __init__(
+        self,
+        cache_dir='default',
+        max_bytes=SVER_CACHE_MAX_BYTES,
+        mmap_mode='r',
+        appname='vtool',
+        verbose=None,
+    ):
+        if verbose is None:
+            verbose = int(ut.VERBOSE)
+        if cache_dir == 'default':
+            cache_dir = join(ub.ensure_app_cache_dir(appname), 'sver_cache')
+        self.cache_dir = ub.ensuredir(cache_dir)
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        self.verbose = verbose
+        self.num_hits = 0
+        self.num_misses = 0
+        # fname -> nbytes of every entry, least recently used first
+        self._lru = None
+        self._total_bytes = 0
+
+    def __nice__(self):
+        return '%r, %d entries' % (self.cache_dir, len(self))
+
+    def __len__(self):
+        return len(self._get_lru())
+
+    def _get_lru(self):
+        """ Scans the directory the first time it is needed """
+        if self._lru is None:
+            stats = []
+            for fname in os.listdir(self.cache_dir):
+                if fname.startswith('sver_') and fname.endswith('.npy'):
+                    stat = os.stat(join(self.cache_dir, fname))
+                    stats.append((stat.st_mtime, fname, stat.st_size))
+            self._lru = ut.odict((fname, size) for _, fname, size in sorted(stats))
+            self._total_bytes = sum(self._lru.values())
+        return self._lru
+
+    def get_cfgstr(self, kpts1, kpts2, fm, sver_kw):
+        """
+        Hash of everything the result of spatially_verify_kpts(kpts1, kpts2,
+        fm, **sver_kw) depends on. Only the matched keypoints are hashed.
+        """
+        default_kw = ut.get_func_kwargs(spatially_verify_kpts)
+        unknown = set(sver_kw) - set(default_kw)
+        if unknown:
+            raise TypeError('Unknown spatially_verify_kpts args %r' % (sorted(unknown),))
+        sver_kw = ut.dict_union(default_kw, sver_kw)
+        fm = np.asarray(fm)
+        kpts1_m = kpts1.take(fm.T[0], axis=0).astype(np.float64)
+        kpts2_m = kpts2.take(fm.T[1], axis=0).astype(np.float64)
+        match_weights = sver_kw.pop('match_weights')
+        if match_weights is not None:
+            match_weights = np.asarray(match_weights, dtype=np.float64)
+        sver_kw['dtype'] = np.dtype(sver_kw['dtype']).name
+        cfg_items = sorted(
+            (key, val)
+            for key, val in sver_kw.items()
+            if key not in _SVER_CACHE_IGNORE_KEYS
+        )
+        data = [SVER_CACHE_VERSION, kpts1_m, kpts2_m, match_weights, cfg_items]
+        return ub.hash_data(data, hasher='sha1')
+
+    def _fpath(self, cfgstr):
+        return join(self.cache_dir, 'sver_' + cfgstr + '.npy')
+
+    def load(self, cfgstr):
+        """
+        Returns:
+            tuple: (hit, svtup). svtup is None on a miss and for cached
+                failures.
+        """
+        lru = self._get_lru()
+        fname = 'sver_' + cfgstr + '.npy'
+        fpath = self._fpath(cfgstr)
+        try:
+            data = np.load(fpath, mmap_mode=self.mmap_mode)
+            svtup = _svtup_from_array(data)
+        except (IOError, OSError, ValueError):
+            self.num_misses += 1
+            return False, None
+        self.num_hits += 1
+        # Mark as recently used
+        try:
+            os.utime(fpath, None)
+        except OSError:
+            pass
+        if fname in lru:
+            lru[fname] = lru.pop(fname)
+        return True, svtup
+
+    def save(self, cfgstr, svtup, num_matches):
+        """
+        Writes a result (computed with returnAff=True) and evicts old ones.
+
+        Returns:
+            ndarray: the packed result that was written
+        """
+        lru = self._get_lru()
+        fname = 'sver_' + cfgstr + '.npy'
+        fpath = self._fpath(cfgstr)
+        data = _svtup_to_array(svtup, num_matches)
+        # Write to a temporary file first so readers never see partial files
+        tmp_fpath = fpath + '.%d.tmp' % (os.getpid(),)
+        with open(tmp_fpath, 'wb') as file_:
+            np.save(file_, data)
+        getattr(os, 'replace', os.rename)(tmp_fpath, fpath)
+        nbytes = os.path.getsize(fpath)
+        self._total_bytes += nbytes - lru.pop(fname, 0)
+        lru[fname] = nbytes
+        self._evict()
+        return data
+
+    def _evict(self):
+        """ Removes the least recently used results until under max_bytes """
+        lru = self._get_lru()
+        while self._total_bytes > self.max_bytes and len(lru) > 1:
+            fname = next(iter(lru))
+            self._total_bytes -= lru.pop(fname)
+            try:
+                os.remove(join(self.cache_dir, fname))
+            except OSError:
+                pass
+            if self.verbose > 1:
+                print('[sver_cache] evicted %s' % (fname,))
+
+    def clear(self):
+        """ Removes every cached result """
+        for fname in list(self._get_lru()):
+            try:
+                os.remove(join(self.cache_dir, fname))
+            except OSError:
+                pass
+        self._lru = None
+
+
+def spatially_verify_kpts_cached(kpts1, kpts2, fm, sver_cache, **kwargs):
+    """
+    Same as spatially_verify_kpts(kpts1, kpts2, fm, **kwargs), but the result
+    is looked up in (and written to) sver_cache. The arguments of
+    spatially_verify_kpts must be given by keyword.
+
+    Args:
+        sver_cache (SverCache): result cache
+
+    Returns:
+        tuple: the result of :func:`spatially_verify_kpts`, with the errors
+            in float32 as they are stored in the cache
+    """
+    if len(fm) == 0:
+        return spatially_verify_kpts(kpts1, kpts2, fm, **kwargs)
+    cfgstr = sver_cache.get_cfgstr(kpts1, kpts2, fm, kwargs)
+    hit, svtup = sver_cache.load(cfgstr)
+    if not hit:
+        sver_kw = ut.dict_union(kwargs, {'returnAff': True})
+        svtup = spatially_verify_kpts(kpts1, kpts2, fm, **sver_kw)
+        # Return what a hit would, so the error dtype does not depend on it
+        svtup = _svtup_from_array(sver_cache.save(cfgstr, svtup, len(fm)))
+    if svtup is not None and not kwargs.get('returnAff', False):
+        # Like _verify_affine_hypothesis, which only returns the affine
+        # hypothesis without returnAff if it skipped the refinement
+        default_kw = ut.get_func_kwargs(spatially_verify_kpts)
+        max_nInliers = kwargs.get('max_nInliers', default_kw['max_nInliers'])
+        if len(svtup[3]) < max_nInliers:
+            svtup = svtup[0:3] + (None, None, None)
+    return svtup
+
+
 if __name__ == '__main__':
     """
     CommandLine:
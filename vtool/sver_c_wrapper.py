@@ -3,20 +3,22 @@
 """
 wraps c implementations slower parts of spatial verification
 
+libsver is loaded on first use. Build it in the source tree with build().
+
 CommandLine:
-    python -m vtool.sver_c_wrapper --rebuild-sver
-    python -m vtool.sver_c_wrapper --rebuild-sver --allexamples
+    python -c "import vtool.sver_c_wrapper; vtool.sver_c_wrapper.build()"
     python -m vtool.sver_c_wrapper --allexamples
-
-    python -m vtool.sver_c_wrapper --test-test_sver_wrapper --rebuild-sver
 """
 from __future__ import absolute_import, division, print_function
 import ctypes as C
+import threading
+import warnings
 import numpy as np
 import utool as ut
 import ubelt as ub
 from os.path import dirname, join, realpath
 from vtool.other import asserteq, compare_implementations  # NOQA
+from vtool.util_math import TAU  # NOQA
 
 c_double_p = C.POINTER(C.c_double)
 
@@ -28,118 +30,373 @@ fs_dtype = np.float64
 FLAGS_RW = 'aligned, c_contiguous, writeable'
 FLAGS_RO = 'aligned, c_contiguous'
 
+# libsver is instantiated for these keypoint / score / error dtypes. float32
+# halves the memory traffic of the hypothesis loops; the thresholds and the
+# inlier weights are always passed as doubles.
+FLOAT_DTYPES = (np.float64, np.float32)
+
 kpts_t = np.ctypeslib.ndpointer(dtype=kpts_dtype, ndim=2, flags=FLAGS_RO)
 fm_t = np.ctypeslib.ndpointer(dtype=fm_dtype, ndim=2, flags=FLAGS_RO)
 fs_t = np.ctypeslib.ndpointer(dtype=fs_dtype, ndim=1, flags=FLAGS_RO)
+offsets_t = np.ctypeslib.ndpointer(dtype=fm_dtype, ndim=1, flags=FLAGS_RO)
+threshs_t = np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags=FLAGS_RO)
 
 
 def inliers_t(ndim):
     return np.ctypeslib.ndpointer(dtype=np.bool, ndim=ndim, flags=FLAGS_RW)
 
 
-def errs_t(ndim):
-    return np.ctypeslib.ndpointer(dtype=np.float64, ndim=ndim, flags=FLAGS_RW)
-
-
-def mats_t(ndim):
-    return np.ctypeslib.ndpointer(dtype=np.float64, ndim=ndim, flags=FLAGS_RW)
+def errs_t(ndim, dtype=np.float64):
+    return np.ctypeslib.ndpointer(dtype=dtype, ndim=ndim, flags=FLAGS_RW)
 
 
-dpath = dirname(__file__)
+def mats_t(ndim, dtype=np.float64):
+    return np.ctypeslib.ndpointer(dtype=dtype, ndim=ndim, flags=FLAGS_RW)
 
 
-lib_fname_cand = list(
-    ub.find_path(
-        name='libsver' + ut.util_cplat.get_lib_ext(),
-        path=[join(dpath, 'lib'), dpath],
-        exact=False,
-    )
-)
-
-if len(lib_fname_cand):
-    if len(lib_fname_cand) > 1:
-        print('multiple libsver candidates: {}'.format(lib_fname_cand))
-    lib_fname = lib_fname_cand[0]
-else:
-    raise Exception('cannot find path')
-    lib_fname = None
-
-
-if __name__ != '__main__':
-    if ub.argflag('--rebuild-sver'):  # and __name__ != '__main__':
-        USE_CMAKE = True
-        if USE_CMAKE:
-            root_dir = realpath(dirname(__file__))
-            repo_dir = dirname(root_dir)
-            ut.std_build_command(repo_dir)
-        else:
-            cpp_fname = join(dpath, 'sver.cpp')
-            cflags = '-shared -fPIC -O2 -ffast-math'
-            cmd_fmtstr = (
-                'g++ -Wall -Wextra {cpp_fname} -lopencv_core {cflags} -o {lib_fname}'
+def _float_dtype(dtype):
+    """ Checks that libsver has an instantiation for ``dtype`` """
+    dtype = np.dtype(dtype)
+    if dtype not in FLOAT_DTYPES:
+        raise ValueError(
+            'libsver supports dtypes {}, got {}'.format(
+                [np.dtype(d).name for d in FLOAT_DTYPES], dtype
             )
-            cmd_str = cmd_fmtstr.format(**locals())
-            ut.cmd(cmd_str)
+        )
+    return dtype
 
-    try:
-        c_sver = C.cdll[lib_fname]
-    except Exception:
-        print('Failed to open lib_fname = %r' % (lib_fname,))
-        ut.checkpath(lib_fname, verbose=True)
-        raise
-    c_getaffineinliers = c_sver['get_affine_inliers']
-    c_getaffineinliers.restype = C.c_int
-    # for every affine hypothesis, for every keypoint pair (is
-    #  it an inlier, the error triples, the hypothesis itself)
-    c_getaffineinliers.argtypes = [
-        kpts_t,
+
+def _affine_inliers_argtypes(dtype):
+    kpts_t_ = np.ctypeslib.ndpointer(dtype=dtype, ndim=2, flags=FLAGS_RO)
+    fs_t_ = np.ctypeslib.ndpointer(dtype=dtype, ndim=1, flags=FLAGS_RO)
+    return [
+        kpts_t_,
         C.c_size_t,
-        kpts_t,
+        kpts_t_,
         C.c_size_t,
         fm_t,
-        fs_t,
+        fs_t_,
         C.c_size_t,
         C.c_double,
         C.c_double,
         C.c_double,
+        C.c_int,
         inliers_t(2),
-        errs_t(3),
-        mats_t(3),
+        errs_t(3, dtype),
+        mats_t(3, dtype),
     ]
-    # for the best affine hypothesis, for every keypoint pair
-    #  (is it an inlier, the error triples (transposed?), the
-    #   hypothesis itself)
-    c_getbestaffineinliers = c_sver['get_best_affine_inliers']
-    c_getbestaffineinliers.restype = C.c_int
-    c_getbestaffineinliers.argtypes = [
-        kpts_t,
+
+
+def _best_affine_inliers_argtypes(dtype):
+    kpts_t_ = np.ctypeslib.ndpointer(dtype=dtype, ndim=2, flags=FLAGS_RO)
+    fs_t_ = np.ctypeslib.ndpointer(dtype=dtype, ndim=1, flags=FLAGS_RO)
+    return [
+        kpts_t_,
+        C.c_size_t,
+        kpts_t_,
         C.c_size_t,
-        kpts_t,
+        fm_t,
+        fs_t_,
         C.c_size_t,
+        C.c_double,
+        C.c_double,
+        C.c_double,
+        C.c_int,
+        C.c_bool,
+        C.c_bool,
+        inliers_t(1),
+        errs_t(2, dtype),
+        mats_t(2, dtype),
+    ]
+
+
+def _affine_inlier_scores_argtypes(dtype):
+    kpts_t_ = np.ctypeslib.ndpointer(dtype=dtype, ndim=2, flags=FLAGS_RO)
+    fs_t_ = np.ctypeslib.ndpointer(dtype=dtype, ndim=1, flags=FLAGS_RO)
+    counts_t = np.ctypeslib.ndpointer(dtype=fm_dtype, ndim=1, flags=FLAGS_RW)
+    return [
+        kpts_t_,
+        kpts_t_,
         fm_t,
-        fs_t,
+        fs_t_,
         C.c_size_t,
         C.c_double,
         C.c_double,
         C.c_double,
+        C.c_int,
+        C.c_size_t,
+        counts_t,
+        errs_t(1),
+        counts_t,
+        inliers_t(2),
+        errs_t(3, dtype),
+        mats_t(3, dtype),
+    ]
+
+
+def _best_affine_inliers_batch_argtypes(dtype):
+    kpts_t_ = np.ctypeslib.ndpointer(dtype=dtype, ndim=2, flags=FLAGS_RO)
+    fs_t_ = np.ctypeslib.ndpointer(dtype=dtype, ndim=1, flags=FLAGS_RO)
+    return [
+        kpts_t_,
+        offsets_t,
+        kpts_t_,
+        offsets_t,
+        fm_t,
+        fs_t_,
+        offsets_t,
+        C.c_size_t,
+        threshs_t,
+        C.c_double,
+        C.c_double,
+        C.c_int,
+        C.c_bool,
+        C.c_bool,
         inliers_t(1),
-        errs_t(2),
-        mats_t(2),
+        errs_t(1, dtype),
+        mats_t(3, dtype),
+        errs_t(1),
+    ]
+
+
+def _best_affine_inliers_nested_argtypes(dtype):
+    kpts_t_ = np.ctypeslib.ndpointer(dtype=dtype, ndim=2, flags=FLAGS_RO)
+    fs_t_ = np.ctypeslib.ndpointer(dtype=dtype, ndim=1, flags=FLAGS_RO)
+    idxs_t = np.ctypeslib.ndpointer(dtype=fm_dtype, ndim=1, flags=FLAGS_RW)
+    return [
+        kpts_t_,
+        kpts_t_,
+        fm_t,
+        fs_t_,
+        offsets_t,
+        C.c_size_t,
+        C.c_size_t,
+        C.c_double,
+        C.c_double,
+        C.c_double,
+        C.c_int,
+        idxs_t,
+        inliers_t(2),
+        errs_t(3, dtype),
+        mats_t(3, dtype),
+        errs_t(1),
     ]
 
 
+dpath = dirname(__file__)
+
+# Must match SVER_ABI_VERSION in sver.cpp. A libsver with another version was
+# built from older source and is treated like a missing library.
+SVER_ABI_VERSION = 2
+
+# libsver entry points: name -> (argtypes for a dtype, restype). Each one also
+# has a float32 instantiation named with an _f32 suffix.
+CFUNC_SIGNATURES = {
+    # for every affine hypothesis, for every keypoint pair (is
+    #  it an inlier, the error triples, the hypothesis itself)
+    'get_affine_inliers': (_affine_inliers_argtypes, C.c_int),
+    # for the best affine hypothesis, for every keypoint pair
+    #  (is it an inlier, the error triples (transposed?), the
+    #   hypothesis itself)
+    'get_best_affine_inliers': (_best_affine_inliers_argtypes, C.c_int),
+    # for many (kpts1, kpts2, fm, fs) pairs stacked CSR-style, the best affine
+    #  hypothesis of each pair (flat inlier flags, flat error triples, one
+    #  matrix and one inlier weight per pair)
+    'get_best_affine_inliers_batch': (_best_affine_inliers_batch_argtypes, None),
+    # for every affine hypothesis only the number of inliers and the inlier
+    #  weight, plus the inliers, errors, and matrices of the top k hypotheses
+    'get_affine_inlier_scores': (_affine_inlier_scores_argtypes, None),
+    # for subsets of the matches nested by level, the best affine hypothesis
+    #  of every level (index, inlier flags, error triples, matrix, weight)
+    'get_best_affine_inliers_nested': (_best_affine_inliers_nested_argtypes, None),
+}
+
+# libsver is found and loaded on the first call into it (see load_lib), so
+# importing vtool never touches the shared library.
+lib_fname = None
+c_sver = None
+load_error = None
+_cfuncs = {}
+_lib_lock = threading.Lock()
+
+
+def find_lib_fname(refresh=False):
+    """
+    Returns the path to libsver, or None if it is not built. The search is
+    only done once unless refresh is True.
+    """
+    global lib_fname
+    if lib_fname is None or refresh:
+        lib_fname_cand = list(
+            ub.find_path(
+                name='libsver' + ut.util_cplat.get_lib_ext(),
+                path=[join(dpath, 'lib'), dpath],
+                exact=False,
+            )
+        )
+        if len(lib_fname_cand) > 1:
+            print('multiple libsver candidates: {}'.format(lib_fname_cand))
+        lib_fname = lib_fname_cand[0] if len(lib_fname_cand) else None
+    return lib_fname
+
+
+def load_lib(refresh=False):
+    """
+    Loads libsver and sets up its entry points. The library (or the error
+    that prevented loading it) is cached, so this is cheap after the first
+    call.
+
+    Raises:
+        OSError: if libsver is not built, cannot be loaded, or was built from
+            another version of sver.cpp
+        AttributeError: if libsver lacks one of the entry points
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.sver_c_wrapper import *  # NOQA
+        >>> assert load_lib() is load_lib()
+        >>> assert is_available()
+    """
+    global c_sver, load_error
+    if c_sver is not None and not refresh:
+        return c_sver
+    with _lib_lock:
+        if refresh:
+            c_sver = load_error = None
+        if c_sver is not None:
+            return c_sver
+        if load_error is not None:
+            raise load_error
+        try:
+            fname = find_lib_fname(refresh=refresh)
+            if fname is None:
+                raise OSError(
+                    'cannot find libsver in {}'.format([join(dpath, 'lib'), dpath])
+                )
+            lib = C.cdll[fname]
+            lib.sver_abi_version.restype = C.c_int
+            lib.sver_abi_version.argtypes = []
+            abi_version = lib.sver_abi_version()
+            if abi_version != SVER_ABI_VERSION:
+                raise OSError(
+                    '{} has ABI version {}, expected {}'.format(
+                        fname, abi_version, SVER_ABI_VERSION
+                    )
+                )
+            cfuncs = {}
+            for name, (argtypes_func, restype) in CFUNC_SIGNATURES.items():
+                for suffix, dtype in [('', np.float64), ('_f32', np.float32)]:
+                    c_func = lib[name + suffix]
+                    c_func.restype = restype
+                    c_func.argtypes = argtypes_func(dtype)
+                    cfuncs[name + suffix] = c_func
+        except (OSError, AttributeError) as ex:
+            load_error = ex
+            warnings.warn(
+                'libsver could not be loaded ({}). Spatial verification will use '
+                'the slower python implementation. Run '
+                'vtool.sver_c_wrapper.build() to build it.'.format(ex)
+            )
+            raise
+        _cfuncs.clear()
+        _cfuncs.update(cfuncs)
+        c_sver = lib
+    return c_sver
+
+
+def is_available():
+    """
+    True if libsver can be used. Callers check this to fall back to python;
+    the reason libsver is unavailable is kept in ``load_error``.
+    """
+    try:
+        load_lib()
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+def build():
+    """
+    Builds libsver in the source tree with CMake and loads it.
+
+    A libsver that was already loaded by this process is not replaced, so
+    rebuilds only take effect in new processes.
+
+    CommandLine:
+        python -c "import vtool.sver_c_wrapper; vtool.sver_c_wrapper.build()"
+    """
+    repo_dir = dirname(realpath(dpath))
+    ut.std_build_command(repo_dir)
+    if c_sver is None:
+        return load_lib(refresh=True)
+    return c_sver
+
+
+def _cfunc(name, dtype):
+    """ The libsver entry point ``name`` instantiated for ``dtype`` """
+    load_lib()
+    return _cfuncs[name + '_f32' if dtype == np.float32 else name]
+
+
+def _num_threads_arg(num_threads):
+    """ None (or any non-positive value) lets libsver use the OpenMP default """
+    return 0 if num_threads is None else int(num_threads)
+
+
 def get_affine_inliers_cpp(
-    kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh
+    kpts1,
+    kpts2,
+    fm,
+    fs,
+    xy_thresh_sqrd,
+    scale_thresh_sqrd,
+    ori_thresh,
+    num_threads=None,
+    dtype=np.float64,
+    compact=False,
+    top_k=0,
 ):
+    """
+    Tests every affine hypothesis in libsver.
+
+    The default output is dense: an (M, M) inlier matrix, (M, 3, M) errors,
+    and (M, 3, 3) matrices for M matches. With compact=True only O(M) memory
+    is used (see :func:`get_affine_inlier_scores_cpp`).
+
+    Args:
+        dtype (dtype): float64 or float32. The keypoints and scores are cast to
+            this type and the errors and matrices are returned in it.
+        compact (bool): if True, returns get_affine_inlier_scores_cpp output
+        top_k (int): number of best hypotheses returned in compact mode
+    """
+    if compact:
+        return get_affine_inlier_scores_cpp(
+            kpts1,
+            kpts2,
+            fm,
+            fs,
+            xy_thresh_sqrd,
+            scale_thresh_sqrd,
+            ori_thresh,
+            top_k=top_k,
+            num_threads=num_threads,
+            dtype=dtype,
+        )
     # np.ascontiguousarray(kpts1)
     # with ut.Timer('PreC'):
+    dtype = _float_dtype(dtype)
+    c_func = _cfunc('get_affine_inliers', dtype)
+    kpts1 = np.ascontiguousarray(kpts1, dtype=dtype)
+    kpts2 = np.ascontiguousarray(kpts2, dtype=dtype)
+    fs = np.ascontiguousarray(fs, dtype=dtype)
     num_matches = len(fm)
     fm = np.ascontiguousarray(fm, dtype=fm_dtype)
     out_inlier_flags = np.empty((num_matches, num_matches), np.bool)
-    out_errors = np.empty((num_matches, 3, num_matches), np.float64)
-    out_mats = np.empty((num_matches, 3, 3), np.float64)
+    out_errors = np.empty((num_matches, 3, num_matches), dtype)
+    out_mats = np.empty((num_matches, 3, 3), dtype)
     # with ut.Timer('C'):
-    c_getaffineinliers(
+    c_func(
         kpts1,
         kpts1.size,
         kpts2,
@@ -150,6 +407,7 @@ def get_affine_inliers_cpp(
         xy_thresh_sqrd,
         scale_thresh_sqrd,
         ori_thresh,
+        _num_threads_arg(num_threads),
         out_inlier_flags,
         out_errors,
         out_mats,
@@ -160,17 +418,178 @@ def get_affine_inliers_cpp(
     return out_inliers, out_errors, out_mats
 
 
+def get_affine_inlier_scores_cpp(
+    kpts1,
+    kpts2,
+    fm,
+    fs,
+    xy_thresh_sqrd,
+    scale_thresh_sqrd,
+    ori_thresh,
+    top_k=0,
+    num_threads=None,
+    dtype=np.float64,
+):
+    """
+    Tests every affine hypothesis in libsver, but only keeps the number of
+    inliers and the inlier weight of each one. The inliers of the top_k
+    hypotheses with the largest weight (ties go to the smaller index, like
+    argmax) are also returned.
+
+    Args:
+        top_k (int): number of best hypotheses to return inliers for
+        num_threads (int): number of threads used to test hypotheses
+        dtype (dtype): float64 or float32
+
+    Returns:
+        tuple: (nInliers_list, weight_list, top_hypo_idxs, top_inliers_list,
+            top_errors_list, top_mats). The first two have one entry per
+            hypothesis; the rest have one entry per top hypothesis, best
+            first, in the format of :func:`get_affine_inliers_cpp`.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.sver_c_wrapper import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> import vtool.keypoint as ktool
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> kpts1, kpts2 = kpts1.astype(np.float64), kpts2.astype(np.float64)
+        >>> fm = demodata.make_dummy_fm(len(kpts1))
+        >>> fs = np.random.RandomState(0).rand(len(fm))
+        >>> xy_thresh_sqrd = ktool.get_kpts_dlen_sqrd(kpts2) * .01
+        >>> args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> inliers_list, errors_list, mats = get_affine_inliers_cpp(*args)
+        >>> compact_out = get_affine_inliers_cpp(*args, compact=True, top_k=3)
+        >>> nInliers_list, weight_list, top_idxs = compact_out[0:3]
+        >>> top_inliers_list, top_errors_list, top_mats = compact_out[3:6]
+        >>> assert np.all(nInliers_list == list(map(len, inliers_list)))
+        >>> assert np.allclose(weight_list, [fs[x].sum() for x in inliers_list])
+        >>> assert top_idxs[0] == weight_list.argmax()
+        >>> assert np.all(weight_list[top_idxs[:-1]] >= weight_list[top_idxs[1:]])
+        >>> for x, idx in enumerate(top_idxs):
+        >>>     assert np.all(top_inliers_list[x] == inliers_list[idx])
+        >>>     assert np.allclose(top_errors_list[x], errors_list[idx])
+        >>>     assert np.allclose(top_mats[x], mats[idx])
+    """
+    dtype = _float_dtype(dtype)
+    c_func = _cfunc('get_affine_inlier_scores', dtype)
+    kpts1 = np.ascontiguousarray(kpts1, dtype=dtype)
+    kpts2 = np.ascontiguousarray(kpts2, dtype=dtype)
+    fs = np.ascontiguousarray(fs, dtype=dtype)
+    fm = np.ascontiguousarray(fm, dtype=fm_dtype)
+    num_matches = len(fm)
+    top_k = int(max(0, min(top_k, num_matches)))
+    out_counts = np.empty(num_matches, fm_dtype)
+    out_weights = np.empty(num_matches, np.float64)
+    out_top_idxs = np.empty(top_k, fm_dtype)
+    out_top_flags = np.empty((top_k, num_matches), np.bool_)
+    out_top_errors = np.empty((top_k, 3, num_matches), dtype)
+    out_top_mats = np.empty((top_k, 3, 3), dtype)
+    c_func(
+        kpts1,
+        kpts2,
+        fm,
+        fs,
+        num_matches,
+        xy_thresh_sqrd,
+        scale_thresh_sqrd,
+        ori_thresh,
+        _num_threads_arg(num_threads),
+        top_k,
+        out_counts,
+        out_weights,
+        out_top_idxs,
+        out_top_flags,
+        out_top_errors,
+        out_top_mats,
+    )
+    top_inliers_list = [np.where(row)[0] for row in out_top_flags]
+    top_errors_list = list(map(tuple, out_top_errors))
+    return (
+        out_counts,
+        out_weights,
+        out_top_idxs,
+        top_inliers_list,
+        top_errors_list,
+        out_top_mats,
+    )
+
+
 def get_best_affine_inliers_cpp(
-    kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh
+    kpts1,
+    kpts2,
+    fm,
+    fs,
+    xy_thresh_sqrd,
+    scale_thresh_sqrd,
+    ori_thresh,
+    num_threads=None,
+    spatial_index=False,
+    dtype=np.float64,
+    deterministic=False,
 ):
+    """
+    Tests every affine hypothesis in libsver and returns only the best one.
+
+    Args:
+        num_threads (int): number of threads used to test hypotheses. Defaults
+            to the OpenMP default (OMP_NUM_THREADS). The ctypes call releases
+            the GIL, so python threads can run while this is working.
+        spatial_index (bool): bucket the matches in a grid so each hypothesis
+            only tests matches that can be within the spatial threshold
+        dtype (dtype): float64 or float32. The hypotheses are tested in this
+            precision and the errors and matrix are returned in it.
+        deterministic (bool): choose the best hypothesis after all of them
+            are tested and recompute its inliers and errors, instead of
+            copying them out of every thread. Both searches sum the weights in
+            match order and give ties to the smallest index (like argmax), so
+            they return the same result for any num_threads; this only saves
+            the per-thread buffers.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.sver_c_wrapper import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> import vtool.keypoint as ktool
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> kpts1, kpts2 = kpts1.astype(np.float64), kpts2.astype(np.float64)
+        >>> fm = demodata.make_dummy_fm(len(kpts1))
+        >>> fs = np.random.RandomState(0).rand(len(fm))
+        >>> xy_thresh_sqrd = ktool.get_kpts_dlen_sqrd(kpts2) * .01
+        >>> args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> serial_out = get_best_affine_inliers_cpp(*args, num_threads=1)
+        >>> parallel_out = get_best_affine_inliers_cpp(*args, num_threads=4)
+        >>> assert np.all(serial_out[0] == parallel_out[0])
+        >>> assert np.allclose(serial_out[2], parallel_out[2])
+        >>> indexed_out = get_best_affine_inliers_cpp(*args, spatial_index=True)
+        >>> assert np.all(serial_out[0] == indexed_out[0])
+        >>> assert np.all(serial_out[1][0] == indexed_out[1][0])
+        >>> empty_args = (kpts1, kpts2, np.empty((0, 2), int), np.empty(0)) + args[4:]
+        >>> for flag in [False, True]:
+        >>>     empty_out = get_best_affine_inliers_cpp(*empty_args, spatial_index=flag)
+        >>>     assert len(empty_out[0]) == 0 and empty_out[1][0].shape == (0,)
+        >>> f32_out = get_best_affine_inliers_cpp(*args, dtype=np.float32)
+        >>> assert f32_out[2].dtype == np.float32
+        >>> assert len(np.setxor1d(serial_out[0], f32_out[0])) <= 1
+        >>> det_outs = [get_best_affine_inliers_cpp(*args, num_threads=n, deterministic=True)
+        >>>             for n in [1, 4]]
+        >>> assert np.all(det_outs[0][0] == det_outs[1][0])
+        >>> assert np.all(det_outs[0][2] == det_outs[1][2])
+        >>> assert all(np.all(e1 == e2) for e1, e2 in zip(det_outs[0][1], det_outs[1][1]))
+    """
     # np.ascontiguousarray(kpts1)
     # with ut.Timer('PreC'):
+    dtype = _float_dtype(dtype)
+    c_func = _cfunc('get_best_affine_inliers', dtype)
+    kpts1 = np.ascontiguousarray(kpts1, dtype=dtype)
+    kpts2 = np.ascontiguousarray(kpts2, dtype=dtype)
+    fs = np.ascontiguousarray(fs, dtype=dtype)
     fm = np.ascontiguousarray(fm, dtype=fm_dtype)
     out_inlier_flags = np.empty((len(fm),), np.bool)
-    out_errors = np.empty((3, len(fm)), np.float64)
-    out_mat = np.empty((3, 3), np.float64)
+    out_errors = np.empty((3, len(fm)), dtype)
+    out_mat = np.empty((3, 3), dtype)
     # with ut.Timer('C'):
-    c_getbestaffineinliers(
+    c_func(
         kpts1,
         6 * len(kpts1),
         kpts2,
@@ -181,6 +600,9 @@ def get_best_affine_inliers_cpp(
         xy_thresh_sqrd,
         scale_thresh_sqrd,
         ori_thresh,
+        _num_threads_arg(num_threads),
+        spatial_index,
+        deterministic,
         out_inlier_flags,
         out_errors,
         out_mat,
@@ -191,6 +613,243 @@ def get_best_affine_inliers_cpp(
     return out_inliers, out_errors, out_mat
 
 
+def get_best_affine_inliers_nested_cpp(
+    kpts1,
+    kpts2,
+    fm,
+    fs,
+    match_levels,
+    num_levels,
+    xy_thresh_sqrd,
+    scale_thresh_sqrd,
+    ori_thresh,
+    num_threads=None,
+    dtype=np.float64,
+):
+    """
+    Best affine hypothesis of each of several nested subsets of the matches.
+
+    Level ``b`` consists of the matches with ``match_levels <= b``. Every
+    hypothesis is tested once and its inlier weight is accumulated for every
+    level, so this returns the same hypotheses as calling
+    :func:`get_best_affine_inliers_cpp` on each subset with num_threads=1.
+
+    Args:
+        match_levels (ndarray): first level each match is part of. Matches
+            with a level >= num_levels are not part of any level.
+        num_levels (int): number of levels
+
+    Returns:
+        list: an (aff_inliers, aff_errors, Aff) tuple for each level, indexed
+            relative to the matches of that level, or None if the level has no
+            matches
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.sver_c_wrapper import *  # NOQA
+        >>> import vtool.demodata as demodata
+        >>> import vtool.keypoint as ktool
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> kpts1, kpts2 = kpts1.astype(np.float64), kpts2.astype(np.float64)
+        >>> fm = demodata.make_dummy_fm(len(kpts1))
+        >>> rng = np.random.RandomState(0)
+        >>> fs = rng.rand(len(fm))
+        >>> match_levels = rng.randint(0, 4, size=len(fm))
+        >>> xy_thresh_sqrd = ktool.get_kpts_dlen_sqrd(kpts2) * .01
+        >>> threshs = (xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> nested_out = get_best_affine_inliers_nested_cpp(
+        >>>     kpts1, kpts2, fm, fs, match_levels, 4, *threshs)
+        >>> for level, out in enumerate(nested_out):
+        >>>     flags = match_levels <= level
+        >>>     out_ = get_best_affine_inliers_cpp(
+        >>>         kpts1, kpts2, fm[flags], fs[flags], *threshs, num_threads=1)
+        >>>     assert np.all(out[0] == out_[0])
+        >>>     assert np.all(np.array(out[1]) == np.array(out_[1]))
+        >>>     assert np.all(out[2] == out_[2])
+        >>> print([len(out[0]) for out in nested_out])
+        [11, 23, 45, 63]
+    """
+    dtype = _float_dtype(dtype)
+    c_func = _cfunc('get_best_affine_inliers_nested', dtype)
+    kpts1 = np.ascontiguousarray(kpts1, dtype=dtype)
+    kpts2 = np.ascontiguousarray(kpts2, dtype=dtype)
+    fs = np.ascontiguousarray(fs, dtype=dtype)
+    fm = np.ascontiguousarray(fm, dtype=fm_dtype)
+    match_levels = np.ascontiguousarray(
+        np.minimum(match_levels, num_levels), dtype=fm_dtype
+    )
+    num_matches = len(fm)
+    out_best_idxs = np.empty(num_levels, fm_dtype)
+    out_inlier_flags = np.empty((num_levels, num_matches), np.bool_)
+    out_errors = np.empty((num_levels, 3, num_matches), dtype)
+    out_mats = np.empty((num_levels, 3, 3), dtype)
+    out_weights = np.empty(num_levels, np.float64)
+    c_func(
+        kpts1,
+        kpts2,
+        fm,
+        fs,
+        match_levels,
+        num_matches,
+        num_levels,
+        xy_thresh_sqrd,
+        scale_thresh_sqrd,
+        ori_thresh,
+        _num_threads_arg(num_threads),
+        out_best_idxs,
+        out_inlier_flags,
+        out_errors,
+        out_mats,
+        out_weights,
+    )
+    level_outs = []
+    for level in range(num_levels):
+        level_flags = match_levels <= level
+        if not np.any(level_flags):
+            level_outs.append(None)
+            continue
+        out_inliers = np.where(out_inlier_flags[level][level_flags])[0]
+        out_errors_ = tuple(out_errors[level][:, level_flags])
+        level_outs.append((out_inliers, out_errors_, out_mats[level]))
+    return level_outs
+
+
+def _stack_unique_kpts(kpts_list, dtype=kpts_dtype):
+    """
+    Stacks keypoint arrays into one contiguous buffer. Arrays that are passed
+    more than once (e.g. the query annotation in one-vs-many matching) are
+    only stored once.
+
+    Returns:
+        tuple: (kpts_flat, kpts_offsets) where the keypoints of the i-th item
+            start at row kpts_offsets[i] of kpts_flat
+    """
+    id_to_offset = {}
+    unique_kpts = []
+    offsets = np.empty(len(kpts_list), dtype=fm_dtype)
+    total = 0
+    for ix, kpts in enumerate(kpts_list):
+        key = id(kpts)
+        if key not in id_to_offset:
+            id_to_offset[key] = total
+            unique_kpts.append(kpts)
+            total += len(kpts)
+        offsets[ix] = id_to_offset[key]
+    if total == 0:
+        kpts_flat = np.zeros((1, 6), dtype=dtype)
+    else:
+        kpts_flat = np.ascontiguousarray(np.vstack(unique_kpts), dtype=dtype)
+    return kpts_flat, offsets
+
+
+def get_best_affine_inliers_batch_cpp(
+    kpts1_list,
+    kpts2_list,
+    fm_list,
+    fs_list,
+    xy_thresh_sqrd_list,
+    scale_thresh_sqrd,
+    ori_thresh,
+    num_threads=None,
+    spatial_index=False,
+    dtype=np.float64,
+    deterministic=False,
+):
+    """
+    Finds the best affine hypothesis for many pairs of keypoints with a single
+    call into libsver. The loop over pairs runs natively with the GIL released.
+
+    Args:
+        kpts1_list (list): keypoints in image 1 for each pair
+        kpts2_list (list): keypoints in image 2 for each pair
+        fm_list (list): feature matches for each pair
+        fs_list (list): feature scores for each pair
+        xy_thresh_sqrd_list (list): squared spatial threshold for each pair
+        scale_thresh_sqrd (float):
+        ori_thresh (float):
+        num_threads (int): number of threads used to test the hypotheses of
+            a pair. Defaults to the OpenMP default (OMP_NUM_THREADS).
+        spatial_index (bool): bucket the matches of each pair in a grid
+        dtype (dtype): float64 or float32 (see get_best_affine_inliers_cpp)
+        deterministic (bool): see get_best_affine_inliers_cpp
+
+    Returns:
+        list: an (aff_inliers, aff_errors, Aff) tuple for each pair
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool.sver_c_wrapper import *  # NOQA
+        >>> import vtool.spatial_verification as sver
+        >>> import vtool.demodata as demodata
+        >>> import vtool.keypoint as ktool
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((30, 30))
+        >>> kpts1, kpts2 = kpts1.astype(np.float64), kpts2.astype(np.float64)
+        >>> rng = np.random.RandomState(0)
+        >>> fm1 = demodata.make_dummy_fm(len(kpts1))
+        >>> fm2 = fm1[rng.rand(len(fm1)) > .3]
+        >>> fs1, fs2 = rng.rand(len(fm1)), rng.rand(len(fm2))
+        >>> xy_thresh_sqrd = ktool.get_kpts_dlen_sqrd(kpts2) * .01
+        >>> scale_thresh, ori_thresh = 2.0, TAU / 4
+        >>> batch_out = get_best_affine_inliers_batch_cpp(
+        >>>     [kpts1, kpts1], [kpts2, kpts2], [fm1, fm2], [fs1, fs2],
+        >>>     [xy_thresh_sqrd, xy_thresh_sqrd], scale_thresh, ori_thresh)
+        >>> single_out = get_best_affine_inliers_cpp(
+        >>>     kpts1, kpts2, fm2, fs2, xy_thresh_sqrd, scale_thresh, ori_thresh)
+        >>> assert np.all(batch_out[1][0] == single_out[0])
+        >>> assert np.allclose(batch_out[1][2], single_out[2])
+    """
+    num_pairs = len(fm_list)
+    if num_pairs == 0:
+        return []
+    dtype = _float_dtype(dtype)
+    c_func = _cfunc('get_best_affine_inliers_batch', dtype)
+    kpts1_flat, kpts1_offsets = _stack_unique_kpts(kpts1_list, dtype)
+    kpts2_flat, kpts2_offsets = _stack_unique_kpts(kpts2_list, dtype)
+    num_matches_list = [len(fm) for fm in fm_list]
+    fm_offsets = np.zeros(num_pairs + 1, dtype=fm_dtype)
+    np.cumsum(num_matches_list, out=fm_offsets[1:])
+    total = int(fm_offsets[-1])
+    if total == 0:
+        fm_flat = np.zeros((1, 2), dtype=fm_dtype)
+        fs_flat = np.zeros(1, dtype=dtype)
+    else:
+        fm_flat = np.ascontiguousarray(np.vstack(fm_list), dtype=fm_dtype)
+        fs_flat = np.ascontiguousarray(np.hstack(fs_list), dtype=dtype)
+    xy_thresh_sqrd_arr = np.ascontiguousarray(xy_thresh_sqrd_list, dtype=np.float64)
+    out_inlier_flags = np.zeros(max(total, 1), np.bool_)
+    out_errors = np.zeros(max(3 * total, 1), dtype)
+    out_mats = np.tile(np.eye(3, dtype=dtype), (num_pairs, 1, 1))
+    out_weights = np.zeros(num_pairs, np.float64)
+    c_func(
+        kpts1_flat,
+        kpts1_offsets,
+        kpts2_flat,
+        kpts2_offsets,
+        fm_flat,
+        fs_flat,
+        fm_offsets,
+        num_pairs,
+        xy_thresh_sqrd_arr,
+        scale_thresh_sqrd,
+        ori_thresh,
+        _num_threads_arg(num_threads),
+        spatial_index,
+        deterministic,
+        out_inlier_flags,
+        out_errors,
+        out_mats,
+        out_weights,
+    )
+    output_list = []
+    for px in range(num_pairs):
+        start, stop = fm_offsets[px], fm_offsets[px + 1]
+        num = stop - start
+        aff_inliers = np.where(out_inlier_flags[start:stop])[0]
+        aff_errors = tuple(out_errors[3 * start : 3 * stop].reshape(3, num))
+        output_list.append((aff_inliers, aff_errors, out_mats[px]))
+    return output_list
+
+
 def call_hello():
     lib = C.cdll['./sver.so']
     hello = lib['hello_world']